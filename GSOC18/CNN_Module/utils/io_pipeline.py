@@ -1,7 +1,14 @@
 import tensorflow as tf
+import os
+import json
+import fnmatch
 import multiprocessing
+from functools import partial
 ncpu=multiprocessing.cpu_count()
 
+#Shape of the full (uncropped) image (height,width,depth)
+full_image_shape=(514,513,40)
+
 def _binary_parse_function_cifar(serialized_example_protocol):
     '''
     DESCRIPTION:
@@ -106,25 +113,33 @@ def _binary_parse_function_label(serialized_example_protocol):
     return label,event
 
 
-def _binary_parse_function_example(serialized_example_protocol):
+def _binary_parse_function_example(serialized_example_protocol,
+                                    image_shape=full_image_shape,
+                                    with_roi_origin=False):
     '''
     DESCRIPTION:
         This function will deserialize, decompress and then transform
         the image and label in the appropriate shape based on the (new) merged
         structure of the dataset.
+        image_shape is the (height,width,depth) of the saved image, which is
+        smaller than the full image when the dataset is made of the
+        region of interest (roi) around the shower. In that case the
+        (row,column) origin of the roi in the full image is also given
+        as third element if with_roi_origin is set. The posx,posy labels
+        of such dataset are relative to the roi, as the image.
     '''
     #Parsing the exampe from the binary format
     features={
         'image':    tf.FixedLenFeature((),tf.string),
         'label':    tf.FixedLenFeature((),tf.string)
     }
+    if with_roi_origin==True:
+        features['roi_origin']=tf.FixedLenFeature([2],tf.int64)
     parsed_feature=tf.parse_single_example(serialized_example_protocol,
                                             features)
 
     #Now setting the appropriate tranformation (decoding and reshape)
-    height=514
-    width=513
-    depth=40
+    height,width,depth=image_shape
     #Decoding the image from biary
     image=tf.decode_raw(parsed_feature['image'],tf.float32)#BEWARE of dtype
     image.set_shape([depth*height*width])
@@ -139,8 +154,205 @@ def _binary_parse_function_example(serialized_example_protocol):
     label=tf.reshape(label,[target_len,])
 
     #Returing the example tuple finally
+    if with_roi_origin==True:
+        return image,label,parsed_feature['roi_origin']
     return image,label
 
+def _binary_parse_function_sparse_batch(serialized_example_batch,
+                                        image_shape=full_image_shape,
+                                        with_roi_origin=False):
+    '''
+    DESCRIPTION:
+        This function will parse a whole batch of examples saved in the
+        sparse format (see compute_energy_map with image_format='sparse')
+        where only the non zero pixels of the image are saved as
+        (flat index,energy) pairs. The pixels of all the examples of the
+        batch are scattered back to the dense image in one go.
+        The flat index is in the same (c-order) as the dense image i.e
+        index=(row*width+column)*depth+layer.
+    USAGE:
+        INPUT:
+            serialized_example_batch : a batch (vector) of serialized example
+            image_shape              : the (height,width,depth) of saved image
+            with_roi_origin          : to also give the origin of the roi
+                                        (see _binary_parse_function_example)
+
+    DONT USE it directly. To be mapped after batching the dataset.
+    '''
+    features={
+        'image_index':  tf.VarLenFeature(tf.int64),
+        'image_energy': tf.VarLenFeature(tf.float32),
+        'label':        tf.FixedLenFeature((),tf.string)
+    }
+    if with_roi_origin==True:
+        features['roi_origin']=tf.FixedLenFeature([2],tf.int64)
+    parsed_feature=tf.parse_example(serialized_example_batch,features)
+
+    height,width,depth=image_shape
+    #Scattering the non zero pixels of all the examples of batch
+    image_index=parsed_feature['image_index']
+    image_energy=parsed_feature['image_energy']
+    batch_size=tf.shape(serialized_example_batch,out_type=tf.int64)[0]
+    scatter_index=tf.stack([image_index.indices[:,0],image_index.values],
+                            axis=1)
+    image=tf.scatter_nd(scatter_index,image_energy.values,
+                        tf.stack([batch_size,height*width*depth]))
+    image=tf.reshape(image,[-1,height,width,depth])
+
+    #Now decoding the label
+    target_len=6
+    label=tf.decode_raw(parsed_feature['label'],tf.float32)
+    label=tf.reshape(label,[-1,target_len])
+    label.set_shape(image.shape[:1].concatenate([target_len]))
+
+    if with_roi_origin==True:
+        return image,label,parsed_feature['roi_origin']
+    return image,label
+
+def _parse_and_batch_dataset(dataset,mini_batch_size,image_format,
+                            num_parallel_batches,drop_remainder,
+                            image_shape=full_image_shape,
+                            with_roi_origin=False):
+    '''
+    DESCRIPTION:
+        Decodes and batches the dataset of serialized examples according
+        to the format in which the images are saved.
+            dense  : each example is decoded (fused map and batch)
+            sparse : the examples are batched first and the whole batch
+                        is densified at once.
+    '''
+    if image_format=='dense':
+        parse_function=partial(_binary_parse_function_example,
+                                image_shape=image_shape,
+                                with_roi_origin=with_roi_origin)
+        dataset=dataset.apply(
+                tf.contrib.data.map_and_batch(parse_function,
+                                            mini_batch_size,
+                                            num_parallel_batches=num_parallel_batches,
+                                            drop_remainder=drop_remainder)
+        )
+    elif image_format=='sparse':
+        dataset=dataset.batch(mini_batch_size,drop_remainder=drop_remainder)
+        parse_function=partial(_binary_parse_function_sparse_batch,
+                                image_shape=image_shape,
+                                with_roi_origin=with_roi_origin)
+        dataset=dataset.map(parse_function,
+                            num_parallel_calls=num_parallel_batches)
+    else:
+        raise ValueError('Unknown image format: %s'%(image_format))
+
+    return dataset
+
+def get_shard_manifest_filename(filename_pattern):
+    '''
+    DESCRIPTION:
+        The manifest of the sharded dataset of the filename pattern (eg.
+        dataset/zside_0/train/*.tfrecords), found next to the train and
+        valid directories (dataset/zside_0/manifest.json), or None if the
+        dataset was not made in shards.
+    '''
+    split_dir=os.path.dirname(filename_pattern)
+    manifest_filename=os.path.join(os.path.dirname(split_dir),
+                                    'manifest.json')
+    if not os.path.exists(manifest_filename):
+        return None
+
+    return manifest_filename
+
+def read_shard_manifest(manifest_filename,filename_pattern=None):
+    '''
+    DESCRIPTION:
+        Reads the shards listed in the manifest of a sharded dataset
+        (see ShardedRecordWriter of the interpolation) whose full path
+        matches the filename pattern (all if None).
+    USAGE:
+        INPUT:
+            manifest_filename   : the manifest.json of the dataset directory
+                                    (see get_shard_manifest_filename)
+            filename_pattern    : the pattern (eg. dataset/zside_0/train/*)
+                                    of the shards to select
+        OUTPUT:
+            shards              : sorted list of (shard filename,shard info)
+                                    the info being the dict of events,bytes,
+                                    image_shape,dtype,image_format and
+                                    compression of the shard
+    '''
+    with open(manifest_filename,'r') as manifest_file:
+        manifest=json.load(manifest_file)
+    dataset_dir=os.path.dirname(manifest_filename)
+    shards=[]
+    for shard_name,shard_info in sorted(manifest['shards'].items()):
+        shard_filename=os.path.join(dataset_dir,shard_name)
+        if filename_pattern is None or \
+                fnmatch.fnmatch(shard_filename,filename_pattern):
+            shards.append((shard_filename,shard_info))
+
+    return shards
+
+def get_steps_per_epoch(manifest_filename,filename_pattern,mini_batch_size,
+                        drop_remainder=True):
+    '''
+    DESCRIPTION:
+        The exact number of minibatches in one epoch of the shards of the
+        manifest matching the filename pattern (the partial minibatch at
+        the end being dropped or not as in the pipeline).
+    '''
+    no_events=sum(shard_info['events'] for _,shard_info in
+                    read_shard_manifest(manifest_filename,filename_pattern))
+    if drop_remainder==True:
+        return no_events//mini_batch_size
+    return -(-no_events//mini_batch_size)
+
+def _get_shard_dataset(manifest_filename,filename_pattern,comp_type,
+                        image_format,image_shape):
+    '''
+    DESCRIPTION:
+        Makes the dataset of the serialized examples of the shards of the
+        manifest matching the filename pattern, checking that they were
+        made with the given image_format and image_shape.
+        The shards are read in parallel with one reader per shard (upto
+        20) and fed to the readers largest first: the shards of the same
+        number of events (the full ones) in a new random order each epoch,
+        then the smaller last ones. So all the readers stay busy until the
+        end of the epoch instead of finishing on one large file.
+    '''
+    shards=read_shard_manifest(manifest_filename,filename_pattern)
+    if len(shards)==0:
+        raise ValueError('No shard of %s in %s'%(filename_pattern,
+                                                manifest_filename))
+    for shard_filename,shard_info in shards:
+        if shard_info['image_format']!=image_format or \
+                tuple(shard_info['image_shape'])!=tuple(image_shape) or \
+                shard_info['compression']!=comp_type:
+            raise ValueError('Shard %s has %s images of shape %s (%s) '\
+                            'instead of %s images of shape %s (%s)'%(
+                                shard_filename,shard_info['image_format'],
+                                shard_info['image_shape'],
+                                shard_info['compression'],image_format,
+                                list(image_shape),comp_type))
+
+    #Grouping the shards by their number of events, largest first
+    shard_groups={}
+    for shard_filename,shard_info in shards:
+        shard_groups.setdefault(shard_info['events'],[]).append(
+                                                        shard_filename)
+    files=None
+    for no_events in sorted(shard_groups.keys(),reverse=True):
+        group_files=tf.data.Dataset.from_tensor_slices(
+                                    shard_groups[no_events])
+        group_files=group_files.shuffle(len(shard_groups[no_events]))
+        files=group_files if files is None else files.concatenate(
+                                                            group_files)
+
+    dataset=files.apply(tf.contrib.data.parallel_interleave(
+                                lambda x:tf.data.TFRecordDataset(x,
+                                            compression_type=comp_type),
+                                cycle_length=min(20,len(shards)),
+                                sloppy=True)
+                            )
+
+    return dataset
+
 ################# TRAIN DATASET PIPELINE #####################
 def parse_tfrecords_file_v1(train_image_filename_list,train_label_filename_list,
                         test_image_filename_list,test_label_filename_list,
@@ -270,26 +482,42 @@ def parse_tfrecords_file_v2(train_filename_pattern,test_filename_pattern,
     return iterator,train_iter_init_op,None
 
 def parse_tfrecords_file(train_filename_pattern,test_filename_pattern,
-                        mini_batch_size,shuffle_buffer_size):
+                        mini_batch_size,shuffle_buffer_size,
+                        image_format='dense',image_shape=full_image_shape,
+                        manifest_filename=None):
     '''
     DESCRIPTION:
         This will be the new version of the io pipeline based on the
         the the suggestion mentioned in the input pipeline performance
         guide.
+        The image_format ('dense' or 'sparse') and the image_shape (smaller
+        than full image if cropped to region of interest) should be the
+        one with which the dataset was created by compute_energy_map.
+        If the manifest_filename of a sharded dataset is given, the shards
+        matching the patterns are read from it in a balanced way
+        (see _get_shard_dataset).
     '''
     comp_type='ZLIB'
-    #Giving the file pattern to read the dataset from
-    #Making the train dataset
-    train_files=tf.data.Dataset.list_files(train_filename_pattern)
-    train_dataset=train_files.apply(tf.contrib.data.parallel_interleave(
+    if manifest_filename is not None:
+        train_dataset=_get_shard_dataset(manifest_filename,
+                                        train_filename_pattern,comp_type,
+                                        image_format,image_shape)
+        test_dataset=_get_shard_dataset(manifest_filename,
+                                        test_filename_pattern,comp_type,
+                                        image_format,image_shape)
+    else:
+        #Giving the file pattern to read the dataset from
+        #Making the train dataset
+        train_files=tf.data.Dataset.list_files(train_filename_pattern)
+        train_dataset=train_files.apply(tf.contrib.data.parallel_interleave(
                                 lambda x:tf.data.TFRecordDataset(x,
                                             compression_type=comp_type),
                                 cycle_length=20,
                                 sloppy=True)
                             )
-    #Making the test dataset
-    test_files=tf.data.Dataset.list_files(test_filename_pattern)
-    test_dataset=test_files.apply(tf.contrib.data.parallel_interleave(
+        #Making the test dataset
+        test_files=tf.data.Dataset.list_files(test_filename_pattern)
+        test_dataset=test_files.apply(tf.contrib.data.parallel_interleave(
                                 lambda x:tf.data.TFRecordDataset(x,
                                             compression_type=comp_type),
                                 cycle_length=20,
@@ -305,20 +533,17 @@ def parse_tfrecords_file(train_filename_pattern,test_filename_pattern,
     #                                 num_parallel_calls=ncpu)
     # train_dataset=train_dataset.batch(mini_batch_size)
 
-    #Applying the fused map and batch operator to train dataset
-    train_dataset=train_dataset.apply(
-            tf.contrib.data.map_and_batch(_binary_parse_function_example,
-                                            mini_batch_size,
+    #Decoding and batching the train and test dataset
+    train_dataset=_parse_and_batch_dataset(train_dataset,mini_batch_size,
+                                            image_format,
                                             num_parallel_batches=10,
-                                            drop_remainder=True)
-    )
-    #Applying the fused map and batch operator to test dataset
-    test_dataset=test_dataset.apply(
-            tf.contrib.data.map_and_batch(_binary_parse_function_example,
-                                            mini_batch_size,
+                                            drop_remainder=True,
+                                            image_shape=image_shape)
+    test_dataset=_parse_and_batch_dataset(test_dataset,mini_batch_size,
+                                            image_format,
                                             num_parallel_batches=10,
-                                            drop_remainder=True)
-    )
+                                            drop_remainder=True,
+                                            image_shape=image_shape)
 
     #Prefetching the dataset for train dataset
     train_dataset=train_dataset.prefetch(3)
@@ -386,7 +611,9 @@ def parse_tfrecords_file_inference_v1(test_image_filename_list,
     return one_shot_iterator
 
 def parse_tfrecords_file_inference(infer_filename_pattern,
-                                    mini_batch_size):
+                                    mini_batch_size,image_format='dense',
+                                    image_shape=full_image_shape,
+                                    with_roi_origin=False):
     '''
     DESCRIPTION:
         This function will make the one-shot iterator for making
@@ -397,6 +624,12 @@ def parse_tfrecords_file_inference(infer_filename_pattern,
                                     make the inference on.
         mini_batch_size         : the size of the minibatch where we will
                                     make the inference parallely
+        image_format            : the format ('dense' or 'sparse') in which
+                                    the images were saved
+        image_shape             : the shape of the saved images
+        with_roi_origin         : to also give the origin of the region of
+                                    interest in the full image (as third
+                                    element) to get back global coordinates
     '''
     comp_type='ZLIB'
     #Reading the tfrecord files,decompress it and make ready for furthur processing
@@ -410,11 +643,12 @@ def parse_tfrecords_file_inference(infer_filename_pattern,
                                     )
 
     #Now mapping and then making the batches in fused form
-    infer_dataset=infer_dataset.apply(
-            tf.contrib.data.map_and_batch(_binary_parse_function_example,
-                                        mini_batch_size,
-                                        num_parallel_batches=4)
-    )
+    infer_dataset=_parse_and_batch_dataset(infer_dataset,mini_batch_size,
+                                            image_format,
+                                            num_parallel_batches=4,
+                                            drop_remainder=False,
+                                            image_shape=image_shape,
+                                            with_roi_origin=with_roi_origin)
 
     #Prefetching to do software pipeline (but the above num_parallel_batch make
     #it sort of redundant. Have to confirm that)
@@ -1,7 +1,9 @@
 import math
 from copy import deepcopy
+import numpy as np
 import attr
 from attr.validators import instance_of
+from multiprocessing import Pool
 from shapely.geometry import Point, Polygon, MultiPolygon
 from shapely.affinity import rotate as shapely_rotate 
 
@@ -40,12 +42,177 @@ def rotate(cell, angle, origin='center'):
     rotated_cell.vertices = shapely_rotate(cell.vertices, angle, origin)
     return rotated_cell
 
+def _rotation_matrix(angle):
+    # same rounding as shapely.affinity.rotate
+    angle = angle*math.pi/180.
+    cosp = math.cos(angle)
+    sinp = math.sin(angle)
+    if abs(cosp) < 2.5e-16:
+        cosp = 0.
+    if abs(sinp) < 2.5e-16:
+        sinp = 0.
+    return cosp, sinp
+
+def _rotate_xy(xy, cosp, sinp, x0, y0):
+    # same operations as shapely.affinity.affine_transform, (...,2) arrays
+    xoff = x0 - x0*cosp + y0*sinp
+    yoff = y0 - x0*sinp - y0*cosp
+    rotated = np.empty_like(xy)
+    rotated[...,0] = cosp*xy[...,0] + (-sinp)*xy[...,1] + xoff
+    rotated[...,1] = sinp*xy[...,0] + cosp*xy[...,1] + yoff
+    return rotated
+
+
+class CellArray(object):
+    '''
+    Struct of arrays version of a list of Cell: one array per attribute,
+    the centers as a (N,2) array and the vertices as a (N,V,2) array padded
+    with nan (n_vertices gives the number of vertices of each cell).
+    The shapely polygons are only made on demand (polygons, to_cells).
+    '''
+    int_fields = ['id', 'layer', 'subdet', 'zside', 'module', 'ieta', 'iphi', 'cell']
+
+    def __init__(self, id, layer, subdet, zside, module, center, vertices,
+            n_vertices=None, ieta=0, iphi=0, cell=0):
+        self.id = np.asarray(id, dtype=np.int64).reshape((-1,))
+        size = len(self.id)
+        # scalar attributes are broadcast to all the cells
+        for name,value in zip(self.int_fields[1:], [layer, subdet, zside, module, ieta, iphi, cell]):
+            setattr(self, name, np.array(np.broadcast_to(np.asarray(value, dtype=np.int64), (size,))))
+        self.center = np.asarray(center, dtype=np.float64).reshape((size,2))
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        if self.vertices.ndim!=3:
+            self.vertices = self.vertices.reshape((size,-1,2))
+        if n_vertices is None:
+            n_vertices = np.sum(~np.isnan(self.vertices[:,:,0]), axis=1)
+        self.n_vertices = np.asarray(n_vertices, dtype=np.int64).reshape((size,))
+        self._polygons = None
+
+    @classmethod
+    def from_cells(cls, cells):
+        cells = list(cells)
+        coords = [cell.vertices.exterior.coords[:-1] for cell in cells]
+        n_vertices = np.array([len(c) for c in coords], dtype=np.int64)
+        vertices = np.full((len(cells),max([0]+list(n_vertices)),2), np.nan)
+        for i,c in enumerate(coords):
+            vertices[i,:len(c)] = c
+        columns = dict([(name, [getattr(cell, name) for cell in cells]) for name in cls.int_fields])
+        cell_array = cls(center=[cell.center.coords[0] for cell in cells],
+                vertices=vertices, n_vertices=n_vertices, **columns)
+        cell_array._polygons = [cell.vertices for cell in cells]
+        return cell_array
+
+    @classmethod
+    def concatenate(cls, cell_arrays):
+        max_vertices = max([array.vertices.shape[1] for array in cell_arrays])
+        vertices = []
+        for array in cell_arrays:
+            padded = np.full((len(array),max_vertices,2), np.nan)
+            padded[:,:array.vertices.shape[1]] = array.vertices
+            vertices.append(padded)
+        columns = dict([(name, np.concatenate([getattr(array, name) for array in cell_arrays]))
+            for name in cls.int_fields])
+        return cls(center=np.concatenate([array.center for array in cell_arrays]),
+                vertices=np.concatenate(vertices),
+                n_vertices=np.concatenate([array.n_vertices for array in cell_arrays]),
+                **columns)
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, index):
+        # a Cell for an integer index, a CellArray for a slice or an index array
+        if isinstance(index, (int, long, np.integer)):
+            return self._cell(index)
+        return self.select(index)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._cell(i)
+
+    def _cell(self, i):
+        return Cell(id=int(self.id[i]),
+                layer=int(self.layer[i]),
+                subdet=int(self.subdet[i]),
+                zside=int(self.zside[i]),
+                module=int(self.module[i]),
+                center=Point(self.center[i]),
+                vertices=self.polygons()[i],
+                ieta=int(self.ieta[i]),
+                iphi=int(self.iphi[i]),
+                cell=int(self.cell[i]))
+
+    def to_cells(self):
+        return list(self)
+
+    def polygons(self):
+        if self._polygons is None:
+            self._polygons = [Polygon(vertices[:n]) for vertices,n in zip(self.vertices, self.n_vertices)]
+        return self._polygons
+
+    def copy(self):
+        columns = dict([(name, getattr(self, name).copy()) for name in self.int_fields])
+        return CellArray(center=self.center.copy(), vertices=self.vertices.copy(),
+                n_vertices=self.n_vertices.copy(), **columns)
+
+    def select(self, index):
+        index = np.arange(len(self))[index]
+        columns = dict([(name, getattr(self, name)[index]) for name in self.int_fields])
+        selected = CellArray(center=self.center[index], vertices=self.vertices[index],
+                n_vertices=self.n_vertices[index], **columns)
+        if self._polygons is not None:
+            selected._polygons = [self._polygons[i] for i in index]
+        return selected
+
+    def filter(self, mask):
+        return self.select(np.asarray(mask, dtype=np.bool_))
+
+    def translate(self, xoff=0., yoff=0.):
+        translated = self.copy()
+        translated.center += (xoff, yoff)
+        translated.vertices += (xoff, yoff)
+        return translated
+
+    def rotate(self, angle, origin='center'):
+        # same as rotate() of each cell: origin is a point, a (N,2) array
+        # of one point per cell, or 'center' to rotate the vertices of each
+        # cell around its bounding box center
+        cosp, sinp = _rotation_matrix(angle)
+        rotated = self.copy()
+        if isinstance(origin, str) and origin=='center':
+            x0 = (np.nanmin(self.vertices[:,:,0], axis=1)+np.nanmax(self.vertices[:,:,0], axis=1))/2.
+            y0 = (np.nanmin(self.vertices[:,:,1], axis=1)+np.nanmax(self.vertices[:,:,1], axis=1))/2.
+            rotated.vertices = _rotate_xy(self.vertices, cosp, sinp, x0[:,None], y0[:,None])
+            return rotated
+        if hasattr(origin, 'coords'):
+            origin = origin.coords[0]
+        origin = np.asarray(origin, dtype=np.float64)
+        if origin.ndim==2:
+            rotated.center = _rotate_xy(self.center, cosp, sinp, origin[:,0], origin[:,1])
+            rotated.vertices = _rotate_xy(self.vertices, cosp, sinp, origin[:,0,None], origin[:,1,None])
+        else:
+            rotated.center = _rotate_xy(self.center, cosp, sinp, origin[0], origin[1])
+            rotated.vertices = _rotate_xy(self.vertices, cosp, sinp, origin[0], origin[1])
+        return rotated
+
+
+def cell_columns(cells):
+    # positions, polygons and ids of a list of Cell or of a CellArray
+    if isinstance(cells, CellArray):
+        return cells.center, cells.polygons(), cells.id.tolist()
+    positions = np.array([cell.center.coords[0] for cell in cells])
+    polygons = [cell.vertices for cell in cells]
+    ids = [cell.id for cell in cells]
+    return positions, polygons, ids
+
 def merge(cells):
-    margin = min([cell.vertices.length for cell in cells])/1000.
+    return merge_polygons([cell.vertices for cell in cells])
+
+def merge_polygons(polygons, margin=None):
+    if margin is None:
+        margin = min([polygon.length for polygon in polygons])/1000.
     # inflate cells to make sure neighbour cells are covering each other
-    cells_inflated = []
-    for cell in cells:
-        cells_inflated.append(cell.vertices.buffer(margin))
+    cells_inflated = [polygon.buffer(margin) for polygon in polygons]
     # Merge cells 
     mergedcell = cells_inflated[0] 
     for cell in cells_inflated[1:]:
@@ -55,3 +222,94 @@ def merge(cells):
     if mergedcell.__class__==MultiPolygon:
         mergedcell = mergedcell[0]
     return mergedcell
+
+def outline(polygons, quantum=None):
+    # Outline of polygons tiling a region exactly, as the cells of a regular
+    # (ieta,iphi) grid: neighbour polygons have the same vertices (within
+    # quantum, by default perimeter/10000), so their common edges cancel and
+    # the remaining edges are chained in a single ring.
+    # Returns None if this is not the case
+    if quantum is None:
+        quantum = min([polygon.length for polygon in polygons])/10000.
+    edges = {}
+    points = []
+    grid = {}
+    def point_key(x, y):
+        # same key for the points closer than quantum
+        kx, ky = int(math.floor(x/quantum)), int(math.floor(y/quantum))
+        for square in [(kx+dx,ky+dy) for dx in (-1,0,1) for dy in (-1,0,1)]:
+            for key in grid.get(square, []):
+                if math.hypot(points[key][0]-x, points[key][1]-y)<=quantum:
+                    return key
+        points.append((x,y))
+        grid.setdefault((kx,ky), []).append(len(points)-1)
+        return len(points)-1
+    area = 0.
+    for polygon in polygons:
+        coords = polygon.exterior.coords[:-1]
+        signed_area = sum([x0*y1-x1*y0 for (x0,y0),(x1,y1) in zip(coords, coords[1:]+coords[:1])])/2.
+        area += abs(signed_area)
+        if signed_area<0.:
+            coords = coords[::-1]
+        keys = [point_key(x, y) for x,y in coords]
+        for start,end in zip(keys, keys[1:]+keys[:1]):
+            if start==end:
+                continue
+            if (end,start) in edges:
+                del edges[(end,start)]
+            else:
+                edges[(start,end)] = True
+    next_point = {}
+    for start,end in edges:
+        if start in next_point:
+            return None
+        next_point[start] = end
+    if len(next_point)<3:
+        return None
+    start = next(iter(next_point))
+    ring = [start]
+    while next_point[ring[-1]]!=start:
+        ring.append(next_point[ring[-1]])
+        if len(ring)>len(next_point):
+            return None
+    if len(ring)!=len(next_point):
+        return None
+    # remove the vertices in the middle of a straight (or back and forth) line
+    ring = [points[key] for key in ring]
+    removed = True
+    while removed and len(ring)>3:
+        removed = False
+        for i in xrange(len(ring)):
+            (x0,y0),(x1,y1),(x2,y2) = ring[i-1], ring[i], ring[(i+1)%len(ring)]
+            cross = (x1-x0)*(y2-y1) - (y1-y0)*(x2-x1)
+            if abs(cross)<=1e-9*math.hypot(x1-x0,y1-y0)*math.hypot(x2-x1,y2-y1):
+                del ring[i]
+                removed = True
+                break
+    mergedcell = Polygon(ring)
+    # the cells must cover exactly the outline
+    if not mergedcell.is_valid or abs(mergedcell.area-area)>area*1e-9:
+        return None
+    return mergedcell
+
+def _merge_group(arguments):
+    polygons, exact_tiling = arguments
+    if exact_tiling:
+        mergedcell = outline(polygons)
+        if mergedcell is not None:
+            return mergedcell
+    return merge_polygons(polygons)
+
+def merge_groups(groups, processes=1, exact_tiling=False):
+    # Same as merge for each group (list of list of Cell), spread over
+    # several processes if requested. With exact_tiling the cells of each
+    # group tile it exactly (regular grid) and the merged cell is directly
+    # their outline (merge is used if the outline cannot be built)
+    arguments = [([cell.vertices for cell in cells], exact_tiling) for cells in groups]
+    if processes>1:
+        pool = Pool(processes)
+        merged = pool.map(_merge_group, arguments, chunksize=max(1, len(arguments)/(4*processes)))
+        pool.close()
+        pool.join()
+        return merged
+    return map(_merge_group, arguments)
@@ -1,9 +1,18 @@
+import os
 import math
+import glob
+import hashlib
+import tempfile
 import numpy as np
-from root_numpy import root2array
+try:
+    from root_numpy import root2array
+except ImportError:
+    # the cached geometry columns (see read_geometry_columns) are read
+    # without ROOT
+    root2array = None
 from shapely.geometry import Polygon, Point
 from shapely.affinity import translate
-from geometry.cell import Cell, hexagon
+from geometry.cell import Cell, CellArray, hexagon
 from geometry.generators import HexagonGenerator, GridGenerator, delete_point, shift_point
 
 # Constants
@@ -159,8 +168,99 @@ def cell_vertices(x, y, wafertype, cell):
     vertices = cell_transform(cell)(hexagon_generator[wafertype](cell_center))
     return vertices
 
+# Bulk (array) version of cell_vertices for whole layers
+max_cell_vertices = 6
+# half cell shapes, in the order of priority of CenterCorrector/CellTransform
+half_cell_shapes = ['left', 'topleft', 'topright', 'bottomright', 'bottomleft', 'right']
+# vertices of the hexagon kept for each shape (full cell last)
+half_cell_kept_vertices = [
+        [1,2,3,4],
+        [2,3,4,5],
+        [0,3,4,5],
+        [0,1,2,5],
+        [0,1,2,3],
+        [0,1,4,5],
+        [0,1,2,3,4,5],
+        ]
+full_cell_shape = len(half_cell_shapes)
+
+def _half_cell_shifts(edge):
+    # barycenter to hexagon center shift of each shape, as in CenterCorrector
+    shift = edge*sqrt3t2o9
+    return np.array([
+        (-shift, 0.),
+        (-shift*cos60, shift*sin60),
+        (shift*cos60, shift*sin60),
+        (shift*cos60, -shift*sin60),
+        (-shift*cos60, -shift*sin60),
+        (shift, 0.),
+        (0., 0.),
+        ])
+
+def _half_cell_shape_table(params):
+    # shape of each cell index (0-255), the first matching shape wins
+    table = np.full(cell_mask+1, full_cell_shape, dtype=np.int8)
+    for shape in reversed(range(len(half_cell_shapes))):
+        table[params['half_cells_edge_'+half_cell_shapes[shape]]] = shape
+    return table
+
+cell_shape_table = {
+        -1:_half_cell_shape_table(large_cells),
+        1:_half_cell_shape_table(small_cells),
+        }
+cell_shape_shifts = {
+        -1:_half_cell_shifts(large_cells['cell_corner_size']),
+        1:_half_cell_shifts(small_cells['cell_corner_size']),
+        }
+
+def cell_vertex_array(x, y, wafertype, cell):
+    # Vertices of the cells (same as cell_vertices) as a (N,6,2) array padded
+    # with nan and the number of vertices of each cell (0 for unknown wafer
+    # types). The half cells of each shape are made at once with masks.
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    wafertype = np.asarray(wafertype)
+    cell = np.asarray(cell)
+    vertices = np.full((len(x),max_cell_vertices,2), np.nan)
+    n_vertices = np.zeros(len(x), dtype=np.int8)
+    for wtype,generator in hexagon_generator.items():
+        in_type = (wafertype==wtype)
+        if not np.any(in_type):
+            continue
+        hexagon = np.array(generator.vertices)
+        shapes = cell_shape_table[wtype][cell[in_type] & cell_mask]
+        shifts = cell_shape_shifts[wtype]
+        for shape,kept in enumerate(half_cell_kept_vertices):
+            selected = np.flatnonzero(in_type)[shapes==shape]
+            if len(selected)==0:
+                continue
+            center_x = x[selected]+shifts[shape,0]
+            center_y = y[selected]+shifts[shape,1]
+            vertices[selected,:len(kept),0] = center_x[:,None]+hexagon[kept,0]
+            vertices[selected,:len(kept),1] = center_y[:,None]+hexagon[kept,1]
+            n_vertices[selected] = len(kept)
+    return vertices, n_vertices
+
+def layer_cell_array(wafer, wafertype, cell, x, y, vertices, n_vertices, subdet, layer):
+    # CellArray of the cells of a layer from their columns and vertex arrays
+    # (see cell_vertex_array), the shapely Polygon, Point and Cell of each
+    # cell being only made on demand (iterating, indexing, polygons)
+    unknown = np.flatnonzero(n_vertices==0)
+    if len(unknown)>0:
+        # same error as cell_vertices
+        raise KeyError(int(wafertype[unknown[0]]))
+    return CellArray(id=compute_id(np.asarray(wafer, dtype=np.int64),
+                np.asarray(cell, dtype=np.int64)),
+            layer=layer,
+            subdet=subdet,
+            zside=1,
+            module=wafer,
+            center=np.stack([x, y], axis=1),
+            vertices=vertices,
+            n_vertices=n_vertices)
+
 def read_geometry(filename, treename, subdet, layer, wafer=-1):
-    # Read cells from one layer
+    # Read cells from one layer, as a CellArray
     selection = "zside==1 && layer=={0} && subdet=={1}".format(layer,subdet)
     if wafer!=-1:
         selection += ' && wafer=={}'.format(wafer)
@@ -169,21 +269,149 @@ def read_geometry(filename, treename, subdet, layer, wafer=-1):
             'x', 'y']
     cells = root2array(filename, treename=treename, branches=branches, selection=selection)
     # Create cell shapes
-    output_cells = []
-    for cell in cells:
-        vertices = cell_vertices(cell['x'], cell['y'], cell['wafertype'], cell['cell']) 
-        barycenter = Point((cell['x'],cell['y']))
-        output_cells.append(Cell(
-            #  id=int(cell['id']),
-            id=int(compute_id(cell['wafer'], cell['cell'])),
-            layer=layer,
-            subdet=subdet,
-            zside=1,
-            module=int(cell['wafer']),
-            center=barycenter,
-            vertices=vertices
-            ))
-    return output_cells
+    vertex_array, n_vertices = cell_vertex_array(cells['x'], cells['y'],
+            cells['wafertype'], cells['cell'])
+    return layer_cell_array(cells['wafer'], cells['wafertype'], cells['cell'],
+            cells['x'], cells['y'], vertex_array, n_vertices, subdet, layer)
+
+# columns of the geometry tree kept in the cache
+geometry_branches = ['id', 'subdet', 'layer',
+        'wafer', 'wafertype', 'cell',
+        'x', 'y']
+# to be incremented whenever the content of the cache changes
+geometry_cache_version = 2
+
+
+class GeometryColumns(object):
+    '''
+    Columns of the cells (zside==1) of the whole geometry tree, sorted by
+    (subdet,layer) so the cells of a layer are a contiguous slice.
+    '''
+    def __init__(self, columns):
+        self.columns = columns
+        # (subdet,layer) -> (start,stop) of the slice of the layer
+        self._slices = {}
+        subdet = columns['subdet']
+        layer = columns['layer']
+        if len(subdet)>0:
+            change = np.flatnonzero((subdet[1:]!=subdet[:-1]) | (layer[1:]!=layer[:-1]))+1
+            starts = np.concatenate([[0],change])
+            stops = np.concatenate([change,[len(subdet)]])
+            for start,stop in zip(starts,stops):
+                self._slices[(int(subdet[start]),int(layer[start]))] = (start,stop)
+
+    def layers(self):
+        return sorted(self._slices.keys())
+
+    def layer_columns(self, subdet, layer):
+        start,stop = self._slices.get((subdet,layer), (0,0))
+        return dict([(name, array[start:stop]) for name,array in self.columns.items()])
+
+    def cell_array(self, subdet, layer, wafer=-1):
+        # Same cells as read_geometry, as a CellArray (no shapely object)
+        columns = self.layer_columns(subdet, layer)
+        selected = np.arange(len(columns['id']))
+        if wafer!=-1:
+            selected = np.flatnonzero(columns['wafer']==wafer)
+        return layer_cell_array(columns['wafer'][selected],
+                columns['wafertype'][selected], columns['cell'][selected],
+                columns['x'][selected], columns['y'][selected],
+                columns['vertices'][selected], columns['n_vertices'][selected],
+                subdet, layer)
+
+    def cells(self, subdet, layer, wafer=-1):
+        # Same cells as read_geometry (the CellArray makes the Cell objects
+        # only when iterated or indexed)
+        return self.cell_array(subdet, layer, wafer)
+
+
+def geometry_file_hash(filename, block_size=2**20):
+    # sha1 (hex) of the contents of the geometry file, read in blocks (also
+    # the geometry hash keying the coefficient bundles)
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fhandle:
+        block = fhandle.read(block_size)
+        while len(block)>0:
+            sha1.update(block)
+            block = fhandle.read(block_size)
+    return sha1.hexdigest()
+
+def geometry_cache_filename(filename, treename, cache_dir, source_hash='*'):
+    # the cache of each content of the geometry file has its own name
+    name = '{}_{}_{}.npz'.format(os.path.splitext(os.path.basename(filename))[0],
+            treename.replace('/','_'), source_hash)
+    return os.path.join(cache_dir, name)
+
+def read_geometry_columns(filename, treename, cache_dir='geometry_cache/',
+        source_hash=None):
+    # Read the tree once for all the layers and keep the columns in a
+    # .npz cache named by the hash of the geometry file contents (hashed
+    # here unless the caller already has its source_hash)
+    if source_hash is None and os.path.exists(filename):
+        source_hash = geometry_file_hash(filename)
+    if source_hash is not None:
+        cache_filename = geometry_cache_filename(filename, treename, cache_dir,
+                source_hash)
+    else:
+        # only the cache is there, taking the latest one made for this name
+        caches = sorted(glob.glob(geometry_cache_filename(filename, treename, cache_dir)),
+                key=os.path.getmtime)
+        cache_filename = caches[-1] if len(caches)>0 else None
+    if cache_filename is not None and os.path.exists(cache_filename):
+        cache = np.load(cache_filename)
+        columns = dict([(name, cache[name]) for name in cache.files])
+        cache.close()
+        valid = ('cache_version' in columns and
+                int(columns.pop('cache_version'))==geometry_cache_version)
+        cached_hash = str(columns.pop('source_hash', ''))
+        if source_hash is not None:
+            valid &= (cached_hash==source_hash)
+        if valid:
+            return GeometryColumns(columns)
+    if root2array is None:
+        raise ImportError('root_numpy is needed to read {}'.format(filename))
+
+    cells = root2array(filename, treename=treename, branches=geometry_branches,
+            selection='zside==1')
+    order = np.lexsort((cells['layer'], cells['subdet']))
+    columns = dict([(name, cells[name][order]) for name in geometry_branches])
+    columns['vertices'], columns['n_vertices'] = cell_vertex_array(columns['x'],
+            columns['y'], columns['wafertype'], columns['cell'])
+
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # made meanwhile by another job
+            if not os.path.isdir(cache_dir):
+                raise
+    # writing to a temporary file of this job first so readers never see
+    # half cache and concurrent jobs never write in the same file
+    temp_fd, temp_filename = tempfile.mkstemp(dir=cache_dir,
+            prefix=os.path.basename(cache_filename)+'.', suffix='.tmp')
+    try:
+        with os.fdopen(temp_fd, 'wb') as fhandle:
+            np.savez(fhandle, cache_version=geometry_cache_version,
+                    source_hash=source_hash, **columns)
+        os.chmod(temp_filename, 0644)
+        os.rename(temp_filename, cache_filename)
+    except Exception:
+        os.remove(temp_filename)
+        raise
+    return GeometryColumns(columns)
+
+# geometry columns already read, per (filename,treename)
+_geometry_columns = {}
+
+def read_geometry_cached(filename, treename, subdet, layer, wafer=-1,
+        cache_dir='geometry_cache/', source_hash=None):
+    # Same as read_geometry, the geometry being read only once per job
+    # (and once for all jobs through the cache)
+    key = (os.path.abspath(filename), treename)
+    if key not in _geometry_columns:
+        _geometry_columns[key] = read_geometry_columns(filename, treename,
+                cache_dir, source_hash)
+    return _geometry_columns[key].cells(subdet, layer, wafer)
 
 def read_bh_geometry(filename, treename):
     # Read cells from one side
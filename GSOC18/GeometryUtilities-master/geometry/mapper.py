@@ -1,11 +1,13 @@
 import numpy as np
 from scipy.spatial import cKDTree
+from geometry.cell import cell_columns
 
 
 
 def map_cells(input_cells, output_cells, max_distance=5, min_overlap=0.001):
-    input_position_array = np.array([cell.center.coords[0] for cell in input_cells])
-    output_position_array = np.array([cell.center.coords[0] for cell in output_cells])
+    # input and output cells can be lists of Cell or CellArray
+    input_position_array, input_polygons, input_ids = cell_columns(input_cells)
+    output_position_array, output_polygons, output_ids = cell_columns(output_cells)
     input_tree = cKDTree(input_position_array)
     output_tree = cKDTree(output_position_array)
     # retrieve lists of (output) neighbors around input cells
@@ -14,13 +16,13 @@ def map_cells(input_cells, output_cells, max_distance=5, min_overlap=0.001):
     overlaps = []
     print '>> Computing overlaps'
     for i,cells in enumerate(neighbors):
-        input_cell = input_cells[i]
+        input_polygon = input_polygons[i]
         if len(cells)==0:
             raise RuntimeError('Cannot match input cell to any output cell')
-        intersection_candidates = [output_cells[j] for j in cells]
+        intersection_candidates = [output_polygons[j] for j in cells]
         areas = []
         for intersection_candidate in intersection_candidates:
-            intersection = input_cell.vertices.intersection(intersection_candidate.vertices)
+            intersection = input_polygon.intersection(intersection_candidate)
             areas.append(intersection.area)
         areas = np.array(areas)
         areas /= np.sum(areas)
@@ -30,10 +32,10 @@ def map_cells(input_cells, output_cells, max_distance=5, min_overlap=0.001):
         intersection_sum = np.sum(areas[intersection_indices])
         overlaps.append(zip(intersection_cells, areas[intersection_indices]/intersection_sum))
     overlaps_dict = {}
-    for cell,overlap in zip(input_cells,overlaps):
-        overlaps_dict[cell.id] = []
+    for cell_id,overlap in zip(input_ids,overlaps):
+        overlaps_dict[cell_id] = []
         for output_cell, area in overlap:
-            overlaps_dict[cell.id].append((output_cells[output_cell].id, area))
+            overlaps_dict[cell_id].append((output_ids[output_cell], area))
     return overlaps, overlaps_dict
 
 
@@ -1,35 +1,151 @@
 import numpy as np
 from scipy.spatial import cKDTree
+from geometry.cell import CellArray, cell_columns
 
 
-def closest_neighbors(input_cells, max_distance=5):
-    input_position_array = np.array([cell.center.coords[0] for cell in input_cells])
+def _point_segment_distance(points, starts, ends):
+    direction = ends - starts
+    length2 = np.sum(direction**2, axis=1)
+    t = np.sum((points-starts)*direction, axis=1)/np.where(length2>0., length2, 1.)
+    t = np.clip(t, 0., 1.)
+    return np.hypot(*(starts + t[:,None]*direction - points).T)
+
+def _segment_distance(starts0, ends0, starts1, ends1):
+    distance = np.minimum(np.minimum(_point_segment_distance(starts0, starts1, ends1),
+        _point_segment_distance(ends0, starts1, ends1)),
+        np.minimum(_point_segment_distance(starts1, starts0, ends0),
+        _point_segment_distance(ends1, starts0, ends0)))
+    # crossing segments
+    def side(a, b, c):
+        return np.sign((b[:,0]-a[:,0])*(c[:,1]-a[:,1]) - (b[:,1]-a[:,1])*(c[:,0]-a[:,0]))
+    crossing = (side(starts0, ends0, starts1)*side(starts0, ends0, ends1)<0) & \
+        (side(starts1, ends1, starts0)*side(starts1, ends1, ends0)<0)
+    return np.where(crossing, 0., distance)
+
+def _shared_length(starts0, ends0, starts1, ends1, tolerance):
+    # length of the common part of two collinear (within tolerance) segments
+    direction = ends0 - starts0
+    length = np.hypot(*direction.T)
+    direction = direction/np.where(length>0., length, 1.)[:,None]
+    along0 = np.sum((starts1-starts0)*direction, axis=1)
+    along1 = np.sum((ends1-starts0)*direction, axis=1)
+    across0 = np.abs(np.cross(direction, starts1-starts0))
+    across1 = np.abs(np.cross(direction, ends1-starts0))
+    shared = np.minimum(length, np.maximum(along0, along1)) - np.maximum(0., np.minimum(along0, along1))
+    return np.where((across0<=tolerance) & (across1<=tolerance), shared, 0.)
+
+def touching_cells(input_cells, tolerance=None):
+    # Pairs of cells closer than the tolerance, found by hashing the polygon
+    # edges of all the cells on a grid and comparing only the edges in the same
+    # grid squares. By default the tolerance of a pair is the margin used for
+    # the overlaps (smallest perimeter/1000).
+    # Returns a dict {(i,j):shared edge} with i<j cell indices, shared edge
+    # being True if the cells share (part of) an edge and not just a vertex
+    if not isinstance(input_cells, CellArray):
+        input_cells = CellArray.from_cells(input_cells)
+    vertices = input_cells.vertices
+    n_vertices = input_cells.n_vertices
+    valid = np.arange(vertices.shape[1])[None,:]<n_vertices[:,None]
+    next_index = np.arange(vertices.shape[1])[None,:]+1
+    next_index = np.where(next_index<n_vertices[:,None], next_index, 0)
+    next_vertices = vertices[np.arange(len(vertices))[:,None],next_index]
+    edge_lengths = np.where(valid, np.hypot(*(next_vertices-vertices).transpose(2,0,1)), 0.)
+    if tolerance is None:
+        tolerances = np.sum(edge_lengths, axis=1)/1000.
+    else:
+        tolerances = np.full(len(input_cells), float(tolerance))
+    max_tolerance = np.max(tolerances)
+    edge_cell = np.nonzero(valid)[0]
+    starts = vertices[valid]
+    ends = next_vertices[valid]
+    # hash each edge in all the grid squares covered by its bounding box
+    grid_size = max(np.mean(edge_lengths[valid]), 2.*max_tolerance)
+    low = np.floor((np.minimum(starts, ends)-max_tolerance)/grid_size).astype(np.int64)
+    high = np.floor((np.maximum(starts, ends)+max_tolerance)/grid_size).astype(np.int64)
+    span = high - low + 1
+    n_squares = span[:,0]*span[:,1]
+    entry_edge = np.repeat(np.arange(len(starts)), n_squares)
+    entry_square = np.arange(len(entry_edge)) - np.repeat(np.cumsum(n_squares)-n_squares, n_squares)
+    entry_x = low[entry_edge,0] + entry_square//span[entry_edge,1]
+    entry_y = low[entry_edge,1] + entry_square%span[entry_edge,1]
+    keys = (entry_x-entry_x.min())*(entry_y.max()-entry_y.min()+1) + entry_y-entry_y.min()
+    order = np.argsort(keys, kind='mergesort')
+    entry_edge = entry_edge[order]
+    unique_keys, first, inverse, counts = np.unique(keys[order], return_index=True,
+            return_inverse=True, return_counts=True)
+    # all the pairs of edges of different cells in the same square
+    n_partners = counts[inverse]
+    edges0 = np.repeat(entry_edge, n_partners)
+    partner = np.arange(len(edges0)) - np.repeat(np.cumsum(n_partners)-n_partners, n_partners)
+    edges1 = entry_edge[np.repeat(first[inverse], n_partners) + partner]
+    selected = edge_cell[edges0]<edge_cell[edges1]
+    pairs = np.unique(edges0[selected]*len(starts) + edges1[selected])
+    edges0 = pairs//len(starts)
+    edges1 = pairs%len(starts)
+    cells0 = edge_cell[edges0]
+    cells1 = edge_cell[edges1]
+    pair_tolerances = np.minimum(tolerances[cells0], tolerances[cells1])
+    close = _segment_distance(starts[edges0], ends[edges0], starts[edges1], ends[edges1])<pair_tolerances
+    shared = close & (_shared_length(starts[edges0], ends[edges0], starts[edges1], ends[edges1],
+        pair_tolerances)>pair_tolerances)
+    touching = {}
+    for cell0,cell1,shared_edge in zip(cells0[close], cells1[close], shared[close]):
+        touching[(cell0,cell1)] = touching.get((cell0,cell1), False) or shared_edge
+    return touching
+
+def topology_neighbors(input_cells, share_vertex=True, tolerance=None):
+    # Neighbors of each cell (list of sets of cell indices) sharing an edge
+    # with it or, if share_vertex, only touching it
+    neighbors = [set() for i in xrange(len(input_cells))]
+    for (i,j),shared_edge in touching_cells(input_cells, tolerance).items():
+        if shared_edge or share_vertex:
+            neighbors[i].add(j)
+            neighbors[j].add(i)
+    return neighbors
+
+def closest_neighbors(input_cells, max_distance=5, method='overlap', share_vertex=True):
+    # input cells can be a list of Cell or a CellArray
+    # method is 'overlap' (cells overlapping the slightly inflated candidate)
+    # or 'topology' (cells touching each other, see topology_neighbors),
+    # which gives the same neighbors
+    input_position_array, input_polygons, input_ids = cell_columns(input_cells)
     input_tree = cKDTree(input_position_array)
     print '>> Fetching neighbors for the', len(input_cells), 'input cells'
     neighbors = input_tree.query_ball_tree(input_tree, max_distance)
+    if method=='topology':
+        print '>> Looking for nearest neighbors by shared edges and vertices'
+        touching = topology_neighbors(input_cells, share_vertex)
+        # keeping the same order of the candidates and the cell itself as
+        # done with the overlaps
+        nearest_neighbors = [np.array([j for j in cells if j==i or j in touching[i]], dtype=np.int64)
+                for i,cells in enumerate(neighbors)]
+        return nearest_neighbors, _neighbors_dict(input_ids, nearest_neighbors)
     nearest_neighbors = []
     print '>> Looking for nearest neighbors' 
     for i,cells in enumerate(neighbors):
         if i%(len(neighbors)/100)==0:
             print i, '/', len(neighbors)
-        input_cell = input_cells[i]
+        input_polygon = input_polygons[i]
         if len(cells)==0:
             raise RuntimeError('Cannot find any neighbor')
-        intersection_candidates = [input_cells[j] for j in cells]
+        intersection_candidates = [input_polygons[j] for j in cells]
         areas = []
         for intersection_candidate in intersection_candidates:
-            margin = min(input_cell.vertices.length, intersection_candidate.vertices.length)/1000.
-            intersection = input_cell.vertices.intersection(intersection_candidate.vertices.buffer(margin))
+            margin = min(input_polygon.length, intersection_candidate.length)/1000.
+            intersection = input_polygon.intersection(intersection_candidate.buffer(margin))
             areas.append(intersection.area)
         areas = np.array(areas)
         cells = np.array(cells)
         intersection_indices = areas>0
         intersection_cells = cells[intersection_indices]
         nearest_neighbors.append(intersection_cells)
+    return nearest_neighbors, _neighbors_dict(input_ids, nearest_neighbors)
+
+def _neighbors_dict(input_ids, nearest_neighbors):
     neighbors_dict = {}
-    for cell,nn in zip(input_cells,nearest_neighbors):
-        neighbors_dict[cell.id] = []
+    for cell_id,nn in zip(input_ids,nearest_neighbors):
+        neighbors_dict[cell_id] = []
         for neighbor in nn:
-            if input_cells[neighbor].id!=cell.id:
-                neighbors_dict[cell.id].append(input_cells[neighbor].id)
-    return nearest_neighbors, neighbors_dict
+            if input_ids[neighbor]!=cell_id:
+                neighbors_dict[cell_id].append(input_ids[neighbor])
+    return neighbors_dict
@@ -1,10 +1,12 @@
 
 import cPickle as pickle
 import math
+import numpy as np
 from geometry.cmssw import read_geometry
 from geometry.generators import HexagonGenerator, GridGenerator, shift_point, SectorGenerator, SectorGeneratorTest
 from shapely.geometry import Polygon, Point
-from geometry.cell import Cell
+from shapely.strtree import STRtree
+from geometry.cell import Cell, CellArray, cell_columns
 from shapely.affinity import rotate
 
 
@@ -31,18 +33,40 @@ def sector_id(id):
 
 
 
-def intersect_modules(polygon, modules):
-    module_intersect = []
-    for module in modules:
-        if polygon.intersection(module.vertices).area>0.:
-            module_intersect.append(module)
-    return module_intersect
+def module_tree(modules):
+    # STRtree of the module polygons, to be given to intersect_modules
+    # when intersecting several polygons with the same modules
+    return STRtree(cell_columns(modules)[1])
 
 
-def generate_modules(wafer_size, grid_size):
+def intersect_modules(polygon, modules, tree=None):
+    # modules can be a list of Cell or a CellArray (a CellArray is returned)
+    # Only the modules with a bounding box overlapping the polygon are
+    # intersected, found with the STRtree of the modules
+    polygons = cell_columns(modules)[1]
+    if tree is None:
+        tree = STRtree(polygons)
+    index = dict([(id(vertices), i) for i,vertices in enumerate(polygons)])
+    candidates = sorted([index[id(vertices)] for vertices in tree.query(polygon)])
+    selected = [i for i in candidates if polygon.intersection(polygons[i]).area>0.]
+    if isinstance(modules, CellArray):
+        return modules.select(selected)
+    return [modules[i] for i in selected]
+
+
+def generate_modules(wafer_size, grid_size, as_array=False):
     grid_generator = GridGenerator('hexagon', grid_size)
     module_centers = grid_generator(point=Point((0,0)), step=wafer_size*sqrt3o2)
     hex_generator = HexagonGenerator(wafer_size/2.)
+    if as_array:
+        centers = np.array([point.coords[0] for point in module_centers])
+        vertices = centers[:,None,:] + np.array(hex_generator.vertices)
+        modules = CellArray(id=np.arange(len(centers)), layer=1, zside=1, subdet=3,
+                module=np.arange(len(centers)), center=centers, vertices=vertices)
+        modules = modules.rotate(30, centers)
+        # the rotation is around the centers, kept exactly as they are
+        modules.center = centers
+        return modules
     module_vertices = [rotate(hex_generator(point), 30, point) for i,point in enumerate(module_centers)]
     modules = []
     for i,(vertices,center) in enumerate(zip(module_vertices,module_centers)):
@@ -93,42 +117,46 @@ def generate_panels_test(wafer_size, panel_list):
     return panels
 
 def modules_to_panels(wafer_size, grid_size):
-    modules = generate_modules(wafer_size, grid_size)
+    modules = generate_modules(wafer_size, grid_size, as_array=True)
     full_layer = HexagonGenerator(wafer_size*grid_size*sqrt3o2)(Point(0,0))
     sectors = generate_sectors(full_layer, wafer_size)
     panels = generate_panels(wafer_size)
     sector_to_modules = {}
     module_to_panel = {}
     panel_to_modules = {}
+    tree = module_tree(modules)
     for i,sector in enumerate(sectors):
-        sector_to_modules[i] = intersect_modules(sector, modules)
+        sector_to_modules[i] = intersect_modules(sector, modules, tree)
     for isec,sector_panels in enumerate(panels):
         sector_modules = sector_to_modules[isec]
+        sector_tree = module_tree(sector_modules)
         for ipan,panel in enumerate(sector_panels):
             panel_to_modules[compute_id(isec,ipan+1)] = []
-            panel_modules = intersect_modules(panel, sector_modules)
-            for module in panel_modules:
-                module_to_panel[module.id] = (isec, ipan+1)
-                panel_to_modules[compute_id(isec,ipan+1)].append(module.id)
+            panel_modules = intersect_modules(panel, sector_modules, sector_tree)
+            for module_id in cell_columns(panel_modules)[2]:
+                module_to_panel[module_id] = (isec, ipan+1)
+                panel_to_modules[compute_id(isec,ipan+1)].append(module_id)
     return module_to_panel, panel_to_modules
 
 
 def modules_to_panels_test(wafer_size, grid_size, panel_list):
-    modules = generate_modules(wafer_size, grid_size)
+    modules = generate_modules(wafer_size, grid_size, as_array=True)
     full_layer = HexagonGenerator(wafer_size*grid_size*sqrt3o2)(Point(0,0))
     sectors = generate_sectors(full_layer, wafer_size)
     panels = generate_panels_test(wafer_size, panel_list)
     sector_to_modules = {}
     module_to_panel = {}
     panel_to_modules = {}
+    tree = module_tree(modules)
     for i,sector in enumerate(sectors):
-        sector_to_modules[i] = intersect_modules(sector, modules)
+        sector_to_modules[i] = intersect_modules(sector, modules, tree)
     for isec,sector_panels in enumerate(panels):
         sector_modules = sector_to_modules[isec]
+        sector_tree = module_tree(sector_modules)
         for ipan,panel in enumerate(sector_panels):
             panel_to_modules[compute_id(isec,ipan+1)] = []
-            panel_modules = intersect_modules(panel, sector_modules)
-            for module in panel_modules:
-                module_to_panel[module.id] = (isec, ipan+1)
-                panel_to_modules[compute_id(isec,ipan+1)].append(module.id)
+            panel_modules = intersect_modules(panel, sector_modules, sector_tree)
+            for module_id in cell_columns(panel_modules)[2]:
+                module_to_panel[module_id] = (isec, ipan+1)
+                panel_to_modules[compute_id(isec,ipan+1)].append(module_id)
     return module_to_panel, panel_to_modules
@@ -2,7 +2,7 @@ import math
 import numpy as np
 from shapely.geometry import Polygon, Point
 from shapely.affinity import translate
-from geometry.cell import Cell, hexagon, rotate
+from geometry.cell import Cell, CellArray, hexagon, rotate, outline, merge_polygons
 from geometry.generators import HexagonGenerator, GridGenerator, delete_point, shift_point
 
 
@@ -94,17 +94,13 @@ def trigger_cells(cells, size=2):
         for j in range(0,nrows,size):
             # Extract cell indices to be included in the trigger cell
             index_window = index_grid[i:i+size,j:j+size].flatten()
-            # dilate cell to ensure coverage of neighbor cells
-            margin = min(cells[i+nrows*j].length, cells[i+1+nrows*j].length)/1000.
-            cells_window = []
-            for index in index_window:
-                cells_window.append(cells[index].buffer(margin))
-            # Merge cells into one trigger cell
-            triggercell = cells_window[0] 
-            for cell in cells_window[1:]:
-                triggercell = triggercell.union(cell)
-            # erode the trigger cell to go back to the original cell sizes
-            triggercell = triggercell.buffer(-margin)
+            # Merge cells into one trigger cell, directly from the outline of
+            # the cells if they share their vertices
+            triggercell = outline([cells[index] for index in index_window])
+            if triggercell is None:
+                # dilate cell to ensure coverage of neighbor cells
+                margin = min(cells[i+nrows*j].length, cells[i+1+nrows*j].length)/1000.
+                triggercell = merge_polygons([cells[index] for index in index_window], margin)
             triggercells.append(triggercell)
     return triggercells
 
@@ -144,26 +140,35 @@ def module_third(wafer_size, ncells, module_center=Point((0,0)), module_id=0, tr
     return cells
 
 
-def module(wafer_size, ncells, center=Point((0,0)), module_id=0, triggercell_size=1):
+def module(wafer_size, ncells, center=Point((0,0)), module_id=0, triggercell_size=1, as_array=False):
     # create the cells for the first third
-    cells_third0 = module_third(wafer_size, ncells, center, module_id, triggercell_size=triggercell_size)
+    cells_third0 = CellArray.from_cells(module_third(wafer_size, ncells, center, module_id, triggercell_size=triggercell_size))
     # create the two other thirds, rotated wrt the first one
-    cells_third1 = [rotate(cell, 120, center) for cell in cells_third0]
-    cells_third2 = [rotate(cell, 240, center) for cell in cells_third0]
-    for c in cells_third1:
-        c.id = compute_id(module=module_id, third=1, cell=cell_id(c.id))
-    for c in cells_third2:
-        c.id = compute_id(module=module_id, third=2, cell=cell_id(c.id))
-    return cells_third0 + cells_third1 + cells_third2
-
-
-def module_grid(wafer_size, ncells, grid_size=3, triggercell_size=1, center=(0,0)):
+    cells_third1 = cells_third0.rotate(120, center)
+    cells_third2 = cells_third0.rotate(240, center)
+    cells_third1.id = compute_id(module=module_id, third=1, cell=cell_id(cells_third1.id))
+    cells_third2.id = compute_id(module=module_id, third=2, cell=cell_id(cells_third2.id))
+    cells = CellArray.concatenate([cells_third0, cells_third1, cells_third2])
+    # CellArray, or list of Cell as before
+    if as_array:
+        return cells
+    return cells.to_cells()
+
+
+def module_grid(wafer_size, ncells, grid_size=3, triggercell_size=1, center=(0,0), as_array=False):
     # Create hexagonal grid of points corresponding to module centers
     grid_generator = GridGenerator('hexagon', grid_size)
     grid_shift = Point(center)
     module_centers = grid_generator(point=grid_shift, step=wafer_size*sqrt3o2)
-    # Create a module at each grid point
-    modules = [module(wafer_size, ncells, center=Point(center), module_id=i, triggercell_size=triggercell_size) for i,center in enumerate(module_centers)]
+    # All the modules are identical: a module is created once at (0,0)
+    # and translated to each grid point
+    template = module(wafer_size, ncells, module_id=0, triggercell_size=triggercell_size, as_array=True)
+    modules = []
+    for i,center in enumerate(module_centers):
+        cells = template.translate(center.x, center.y)
+        cells.module[:] = i
+        cells.id = compute_id(module=i, third=third_id(template.id), cell=cell_id(template.id))
+        modules.append(cells if as_array else cells.to_cells())
     return modules
 
 
@@ -0,0 +1,189 @@
+##########################IMPORTS########################
+#For timing script
+import datetime
+#Linear Algebra library
+import numpy as np
+#Importing the bundle and the interpolation kernel
+from coef_bundle import CoefBundle,get_coef_bundle_path
+from hexCells_to_squareCell_interpolation import interpolate_layer_hits
+from hexCells_to_squareCell_interpolation import _readCoefFile
+from hexCells_to_squareCell_interpolation import sq_cells_basepath
+
+'''
+DESCRIPTION:
+    This script benchmarks the interpolation of the hits of one layer.
+    The "before" is the baseline path of compute_energy_map: reading the
+    float64 coefficient pickle of the layer and looping over each hit and
+    each of its overlap in python. The "after" is reading the layer from
+    the coefficient bundle and doing the sparse
+    (events x hex cells)*(hex cells x square cells) product.
+    The hits are randomly generated on the cells present in both.
+
+    The bundle stores the normalized weights in float32 while the pickle
+    keeps the float64 areas, so the two images are not bit identical.
+    This is a deliberate deviation: they are only required to agree
+    within the float32 rounding (rtol=1e-5,atol=1e-6 on the float32 image).
+USAGE:
+    python benchmark_interpolation.py --resolution 514,513 --edge_length 0.7
+                                --layer 10 --no_events 100 --no_hits 2000
+'''
+
+#Tolerance of the float32 bundle weights wrt the float64 pickle
+float32_rtol=1e-5
+float32_atol=1e-6
+
+#################Function Definition####################
+def get_coef_pickle_filename(layer,resolution,edge_length):
+    '''
+    DESCRIPTION:
+        The name of the baseline coefficient pickle of a layer.
+    '''
+    coef_filename=sq_cells_basepath+\
+                'coef_dict_layer_%s_res_%s,%s_len_%s.pkl'%(
+                        layer,resolution[0],resolution[1],edge_length)
+    return coef_filename
+
+def _generate_random_hits(cellid,no_events,no_hits,seed=0):
+    '''
+    DESCRIPTION:
+        Generates no_hits random hits per event on the given cells.
+    '''
+    rng=np.random.RandomState(seed)
+    cellid=np.asarray(cellid)
+    hit_example_idx=np.repeat(np.arange(no_events),no_hits)
+    hit_cellid_arr=cellid[rng.randint(0,len(cellid),no_events*no_hits)]
+    hit_energy_arr=rng.exponential(1.0,no_events*no_hits).astype(np.float32)
+
+    return hit_example_idx,hit_cellid_arr,hit_energy_arr
+
+def _interpolate_layer_loop(hit_example_idx,hit_cellid_arr,hit_energy_arr,
+                            coef_dict,energy_map):
+    '''
+    DESCRIPTION:
+        The baseline compute_energy_map loop: for each hit, normalizing
+        the float64 overlap areas of its cell from the pickled coef_dict
+        and adding the share of each overlap to the image.
+    '''
+    for hit_id in range(hit_energy_arr.shape[0]):
+        hex_cell_id=hit_cellid_arr[hit_id]
+        overlaps=coef_dict[hex_cell_id]
+        hit_energy=hit_energy_arr[hit_id]
+
+        norm_coef=np.sum([overlap[1] for overlap in overlaps])
+        for overlap in overlaps:
+            i,j=overlap[0]
+            weight=overlap[1]/norm_coef
+            mesh_energy=hit_energy*weight
+
+            example_idx=hit_example_idx[hit_id]
+            energy_map[example_idx,i,j]+=mesh_energy
+
+def benchmark_layer(coef_filename,coef_bundle,layer,no_events,no_hits,
+                    dtype=np.float32):
+    '''
+    DESCRIPTION:
+        Runs the baseline pickle loop and the bundle sparse product on the
+        same random hits, prints the events/sec of both (with and without
+        the loading of the coefficients) and checks that the images agree
+        within the float32 tolerance.
+    USAGE:
+        INPUT:
+            coef_filename   : the float64 coefficient pickle of the layer
+            coef_bundle     : the CoefBundle having the same layer
+            layer           : the layer to benchmark
+            no_events       : the number of events in the minibatch
+            no_hits         : the number of hits per event in this layer
+        OUTPUT:
+            speedup         : the ratio of the after to before events/sec
+                                (including the loading)
+    '''
+    #Loading the baseline coefficients
+    t0=datetime.datetime.now()
+    coef_dict=_readCoefFile(coef_filename)
+    t1=datetime.datetime.now()
+    loop_load_time=(t1-t0).total_seconds()
+
+    #Loading the bundle coefficients
+    t0=datetime.datetime.now()
+    layer_coef=coef_bundle.layer(layer)
+    layer_coef.matrix()
+    t1=datetime.datetime.now()
+    sparse_load_time=(t1-t0).total_seconds()
+
+    resolution=layer_coef.resolution
+    cellid=np.intersect1d(np.asarray(layer_coef.cellid),
+                            np.array(list(coef_dict.keys())))
+    if len(cellid)!=len(coef_dict):
+        print '>>> WARNING: %s cells of the pickle not in the bundle'%(
+                                                len(coef_dict)-len(cellid))
+    hit_example_idx,hit_cellid_arr,hit_energy_arr=_generate_random_hits(
+                                                cellid,no_events,no_hits)
+
+    #Timing the baseline loop
+    loop_map=np.zeros((no_events,resolution[0],resolution[1]),dtype=dtype)
+    t0=datetime.datetime.now()
+    _interpolate_layer_loop(hit_example_idx,hit_cellid_arr,hit_energy_arr,
+                            coef_dict,loop_map)
+    t1=datetime.datetime.now()
+    loop_time=(t1-t0).total_seconds()
+
+    #Timing the sparse product
+    sparse_map=np.zeros((no_events,resolution[0],resolution[1]),dtype=dtype)
+    t0=datetime.datetime.now()
+    example_idx,i,j,mesh_energy=interpolate_layer_hits(hit_example_idx,
+                                    hit_cellid_arr,hit_energy_arr,
+                                    layer_coef,no_events)
+    sparse_map[example_idx,i,j]+=mesh_energy
+    t1=datetime.datetime.now()
+    sparse_time=(t1-t0).total_seconds()
+
+    #Comparing within the float32 rounding of the bundle weights
+    abs_diff=np.abs(loop_map.astype(np.float64)-sparse_map)
+    max_rel_diff=np.max(abs_diff/np.maximum(np.abs(loop_map),float32_atol))
+    print '>>> Max abs difference (pickle vs bundle): ',np.max(abs_diff)
+    print '>>> Max rel difference (pickle vs bundle): ',max_rel_diff
+    assert np.allclose(loop_map,sparse_map,rtol=float32_rtol,
+                        atol=float32_atol),\
+            'Bundle interpolation differs from the pickle beyond float32'
+
+    print '>>> Before (pickle loop)   : load %.3f sec, %.1f events/sec, '\
+            '%.1f events/sec with load'%(loop_load_time,no_events/loop_time,
+                                no_events/(loop_time+loop_load_time))
+    print '>>> After  (bundle sparse) : load %.3f sec, %.1f events/sec, '\
+            '%.1f events/sec with load'%(sparse_load_time,
+                                no_events/sparse_time,
+                                no_events/(sparse_time+sparse_load_time))
+    print '>>> Speedup: %.1fx (%.1fx with load)'%(loop_time/sparse_time,
+                (loop_time+loop_load_time)/(sparse_time+sparse_load_time))
+    speedup=(loop_time+loop_load_time)/(sparse_time+sparse_load_time)
+
+    return speedup
+
+if __name__=='__main__':
+    import optparse
+    usage = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option('--resolution',dest='resolution',
+                help='resolution of the mesh as res_x,res_y',default='514,513')
+    parser.add_option('--edge_length',dest='edge_length',
+                help='edge_length of square', type='float', default=0.7)
+    parser.add_option('--layer',dest='layer',
+                help='layer to benchmark',type='int',default=1)
+    parser.add_option('--coef_pickle',dest='coef_pickle',
+                help='baseline coefficient pickle of the layer (default in '
+                        +sq_cells_basepath+')',default=None)
+    parser.add_option('--no_events',dest='no_events',
+                help='number of events in the minibatch',type='int',default=100)
+    parser.add_option('--no_hits',dest='no_hits',
+                help='number of hits per event in the layer',type='int',
+                default=1000)
+    (opt, args) = parser.parse_args()
+
+    resolution=tuple(int(res) for res in opt.resolution.split(','))
+    coef_filename=opt.coef_pickle
+    if coef_filename is None:
+        coef_filename=get_coef_pickle_filename(opt.layer,resolution,
+                                                opt.edge_length)
+    coef_bundle=CoefBundle(get_coef_bundle_path(resolution,opt.edge_length))
+    benchmark_layer(coef_filename,coef_bundle,opt.layer,opt.no_events,
+                    opt.no_hits)
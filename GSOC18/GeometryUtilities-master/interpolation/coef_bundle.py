@@ -0,0 +1,680 @@
+##########################IMPORTS########################
+#For file IO/data Handling
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import cPickle as pickle
+#Linear Algebra library
+import numpy as np
+import scipy.sparse
+from geometry.cell import CellArray
+from geometry.cmssw import geometry_file_hash
+
+
+#################Global Variables#######################
+#For saving the interpolation coefficents and sq_cells data
+sq_cells_basepath='sq_cells_data/'
+#Version of the on-disk layout of the bundle
+bundle_version=1
+#Version of the overlap calculation code (to be incremented whenever the
+#coefficient calculation changes, which invalidates the cached coefficients)
+coef_code_version=1
+
+'''
+LAYOUT OF THE BUNDLE:
+    The interpolation coefficient of all the layers for a given geometry
+    and edge length are kept in one directory (the bundle):
+        index.json              : resolution, edge_length, mesh origin,
+                                    the cache key and geometry hash with which
+                                    the coefficients were made and the number
+                                    of rows/entries and the geometry
+                                    fingerprint of each layer, or the layer
+                                    it is an alias of (see ALIASES below)
+        layer_<l>_cellid.npy    : (int64) sorted hexagonal cell ids, the row
+                                    of a cell in the layer matrix
+        layer_<l>_indptr.npy    : (int64) CSR row pointer
+        layer_<l>_indices.npy   : (int32) flat index of the square cell
+                                    i.e i*resolution[1]+j
+        layer_<l>_weights.npy   : (float32) normalized overlap coefficient
+                                    (each row sums to one)
+        layer_<l>_norm.npy      : (float64) total overlap area of the row
+                                    to get back the unnormalized coefficient
+    All the arrays are plain .npy files opened with np.memmap (mmap_mode)
+    so the pages are shared by the OS cache among all the processes
+    reading the same bundle and opening a layer takes milliseconds.
+
+ALIASES:
+    Many layers have exactly the same cells (same ids, centers and shapes)
+    so they have the same coefficients. Each layer is fingerprinted by its
+    cells (see get_layer_fingerprint) and the coefficients are made and saved
+    only once per fingerprint, the other layers being saved in the index as
+    {'alias_of':layer} without any array. The aliases are resolved when
+    reading, and the same (memory mapped) LayerCoef is given for all of them.
+
+PYRAMID:
+    The coarser meshes of the pyramid (factor f=2,4..) are derived from the
+    finest one without recomputing any overlap. The coarse square cell (I,J)
+    is exactly the union of the fine cells (f*I..f*I+f-1,f*J..f*J+f-1), so
+    its edge length is f*edge_length, its origin (center of cell (0,0)) is
+    shifted by (f-1)/2*edge_length and its coefficient is the sum of the
+    coefficients of these fine cells (see get_coarse_mesh, coarsen_csr).
+    Each level is saved as a separate bundle at its default location.
+
+CACHING:
+    The bundle also works as a cache of the coefficients. The cache key is
+    the hash of the geometry file contents, the edge length, the mesh
+    (origin and resolution) and the coefficient code version.
+    Each layer records the key it was made with, so only the layers which
+    are missing or were made with another key have to be recomputed.
+'''
+
+#################Function Definition####################
+def get_coef_bundle_path(resolution,edge_length):
+    '''
+    DESCRIPTION:
+        Gives the default directory of the bundle for the given mesh.
+    '''
+    return sq_cells_basepath+'coef_bundle_res_%s,%s_len_%s/'%(
+                                    resolution[0],resolution[1],edge_length)
+
+def get_cache_key(geometry_hash,edge_length,origin,resolution):
+    '''
+    DESCRIPTION:
+        Gives the cache key (sha1 hex) of the coefficients made for the
+        given geometry (hash of file contents) and mesh, with the current
+        version of the coefficient calculation code.
+    '''
+    key_data=json.dumps({
+        'geometry_hash'     : geometry_hash,
+        'edge_length'       : float(edge_length),
+        'origin'            : [repr(float(origin[0])),repr(float(origin[1]))],
+        'resolution'        : [int(resolution[0]),int(resolution[1])],
+        'coef_code_version' : coef_code_version,
+    },sort_keys=True)
+
+    return hashlib.sha1(key_data).hexdigest()
+
+def get_layer_fingerprint(hex_cells_dict,quantum=1e-4):
+    '''
+    DESCRIPTION:
+        Gives the fingerprint (sha1 hex) of the cells of a layer, made from
+        the cell ids and their centers and vertices quantized to the given
+        quantum (in cm), so layers with same cells have same fingerprint.
+    USAGE:
+        INPUT:
+            hex_cells_dict  : the hexagonal cell dictionary of the layer
+                                (or its CellArray)
+            quantum         : the precision to which the positions are matched
+        OUTPUT:
+            fingerprint     : the sha1 hex of the layer cells
+    '''
+    if isinstance(hex_cells_dict,CellArray):
+        return _get_array_fingerprint(hex_cells_dict,quantum)
+
+    sha1=hashlib.sha1()
+    for hex_id in sorted(hex_cells_dict.keys()):
+        cell=hex_cells_dict[hex_id]
+        coords=np.array([cell.center.coords[0]]+
+                            list(cell.vertices.exterior.coords),
+                            dtype=np.float64)
+        quantized=np.rint(coords/quantum).astype(np.int64)
+        sha1.update(np.array([hex_id,quantized.shape[0]],
+                                dtype=np.int64).tobytes())
+        sha1.update(quantized.tobytes())
+
+    return sha1.hexdigest()
+
+def _get_array_fingerprint(cell_array,quantum):
+    '''
+    DESCRIPTION:
+        Same fingerprint as get_layer_fingerprint from the arrays of a
+        CellArray: the record (id,number of points,quantized center and
+        closed ring of vertices) of each cell, in order of id, is packed in
+        one padded int64 matrix whose valid part is hashed at once.
+    '''
+    order=np.argsort(cell_array.id,kind='mergesort')
+    no_cells=len(order)
+    n_vertices=cell_array.n_vertices[order]
+    vertices=cell_array.vertices[order]
+    max_points=vertices.shape[1]+2
+
+    #The center, the vertices and the first vertex again to close the ring
+    coords=np.zeros((no_cells,max_points,2),dtype=np.float64)
+    coords[:,0,:]=cell_array.center[order]
+    coords[:,1:max_points-1,:]=np.nan_to_num(vertices)
+    coords[np.arange(no_cells),n_vertices+1,:]=vertices[:,0,:]
+    n_points=n_vertices+2
+
+    records=np.zeros((no_cells,2+2*max_points),dtype=np.int64)
+    records[:,0]=cell_array.id[order]
+    records[:,1]=n_points
+    records[:,2:]=np.rint(coords/quantum).astype(np.int64).reshape(
+                                                            (no_cells,-1))
+    valid=np.arange(records.shape[1])[np.newaxis,:]<\
+                                        (2+2*n_points)[:,np.newaxis]
+
+    sha1=hashlib.sha1()
+    sha1.update(records[valid].tobytes())
+    return sha1.hexdigest()
+
+def coef_dict_to_csr(coef_dict,resolution):
+    '''
+    DESCRIPTION:
+        This function converts the (unnormalized) coefficient dictionary
+        made by linear_interpolate_hex_to_square to the CSR arrays
+        saved in the bundle.
+    USAGE:
+        INPUT:
+            coef_dict   : { hex_id :[((i,j),area),((i,j),area)....] }
+            resolution  : the resolution of the mesh
+        OUTPUT:
+            csr_arrays  : tuple of (cellid,indptr,indices,weights,norm)
+                            as described in the layout above.
+    '''
+    cellid=np.array(sorted(coef_dict.keys()),dtype=np.int64)
+    row_length=np.array([len(coef_dict[hex_id]) for hex_id in cellid],
+                                dtype=np.int64)
+    indptr=np.zeros((len(cellid)+1,),dtype=np.int64)
+    indptr[1:]=np.cumsum(row_length)
+
+    sq_ids=np.array([sq_id for hex_id in cellid
+                        for sq_id,_ in coef_dict[hex_id]],
+                        dtype=np.int64).reshape((-1,2))
+    area=np.array([coef for hex_id in cellid
+                        for _,coef in coef_dict[hex_id]],dtype=np.float64)
+    indices=(sq_ids[:,0]*resolution[1]+sq_ids[:,1]).astype(np.int32)
+
+    #Normalizing each row by its total overlap area
+    row=np.repeat(np.arange(len(cellid)),row_length)
+    norm=np.bincount(row,weights=area,minlength=len(cellid))
+    weights=(area/norm[row]).astype(np.float32)
+
+    return cellid,indptr,indices,weights,norm
+
+def get_coarse_mesh(resolution,edge_length,origin,pyramid_factor):
+    '''
+    DESCRIPTION:
+        Gives the mesh of the coarser level of the pyramid whose cells
+        are blocks of pyramid_factor x pyramid_factor cells of the given
+        mesh, aligned exactly on the fine cell (0,0).
+    USAGE:
+        INPUT:
+            resolution      : the resolution of the fine mesh
+            edge_length     : the edge length of the fine mesh
+            origin          : center of the square cell (0,0) of fine mesh
+            pyramid_factor  : the number of fine cells per coarse cell side
+        OUTPUT:
+            coarse_resolution,coarse_edge_length,coarse_origin
+    '''
+    coarse_resolution=(-(-int(resolution[0])//pyramid_factor),
+                        -(-int(resolution[1])//pyramid_factor))
+    #Rounding away the float noise so the bundle path stays readable
+    coarse_edge_length=float('%.10g'%(edge_length*pyramid_factor))
+    shift=(pyramid_factor-1)*edge_length/2.0
+    coarse_origin=(origin[0]+shift,origin[1]+shift)
+
+    return coarse_resolution,coarse_edge_length,coarse_origin
+
+def coarsen_csr(csr_arrays,resolution,pyramid_factor):
+    '''
+    DESCRIPTION:
+        This function gives the CSR arrays of the coefficients of a layer
+        on the coarser mesh of the pyramid, by summing the weights of
+        the fine square cells falling in the same coarse cell.
+        The normalization of each row remains the same.
+    USAGE:
+        INPUT:
+            csr_arrays      : (cellid,indptr,indices,weights,norm) of layer
+                                on the fine mesh
+            resolution      : the resolution of the fine mesh
+            pyramid_factor  : the number of fine cells per coarse cell side
+        OUTPUT:
+            csr_arrays      : (cellid,indptr,indices,weights,norm) of layer
+                                on the coarse mesh
+    '''
+    cellid,indptr,indices,weights,norm=csr_arrays
+    coarse_resolution=(-(-int(resolution[0])//pyramid_factor),
+                        -(-int(resolution[1])//pyramid_factor))
+
+    #Mapping the fine flat index to the flat index of its coarse cell
+    indices=np.asarray(indices,dtype=np.int64)
+    coarse_indices=(indices//resolution[1]//pyramid_factor)*\
+                        coarse_resolution[1]+\
+                        (indices%resolution[1])//pyramid_factor
+    shape=(len(cellid),coarse_resolution[0]*coarse_resolution[1])
+    coarse_matrix=scipy.sparse.csr_matrix((
+                        np.asarray(weights,dtype=np.float64),
+                        coarse_indices,np.array(indptr,dtype=np.int64)),
+                        shape=shape)
+    coarse_matrix.sum_duplicates()
+
+    return (np.array(cellid,dtype=np.int64),
+            coarse_matrix.indptr.astype(np.int64),
+            coarse_matrix.indices.astype(np.int32),
+            coarse_matrix.data.astype(np.float32),
+            np.array(norm,dtype=np.float64))
+
+class LayerCoef(object):
+    '''
+    This class holds the (memory mapped) CSR coefficient of one layer.
+    The matrix has one row per hexagonal cell and one column per square cell
+    (flat index i*resolution[1]+j). It can also be used like the old
+    coefficient dictionary: layer_coef[hex_id] gives back the list of
+    ((i,j),area) of the hexagonal cell.
+    '''
+    def __init__(self,cellid,indptr,indices,weights,norm,resolution):
+        self.cellid=cellid
+        self.indptr=indptr
+        self.indices=indices
+        self.weights=weights
+        self.norm=norm
+        self.resolution=tuple(resolution)
+        self._matrix=None
+
+    def rows(self,hex_ids):
+        '''
+        Row of each of the given hexagonal cell ids (numpy array).
+        Raises KeyError if some cell is not in this layer.
+        '''
+        hex_ids=np.asarray(hex_ids,dtype=np.int64)
+        rows=np.searchsorted(self.cellid,hex_ids)
+        rows=np.minimum(rows,len(self.cellid)-1)
+        found=(self.cellid[rows]==hex_ids) if len(self.cellid)>0 \
+                    else np.zeros(hex_ids.shape,dtype=np.bool_)
+        if not np.all(found):
+            raise KeyError(hex_ids[~found][0])
+        return rows
+
+    def matrix(self):
+        '''
+        The scipy CSR matrix (hex cell rows x flat square cell columns)
+        of the normalized weights (uses the mapped arrays directly).
+        '''
+        if self._matrix is None:
+            shape=(len(self.cellid),self.resolution[0]*self.resolution[1])
+            self._matrix=scipy.sparse.csr_matrix((self.weights,self.indices,
+                                        self.indptr),shape=shape,copy=False)
+        return self._matrix
+
+    def keys(self):
+        return self.cellid.tolist()
+
+    def __contains__(self,hex_id):
+        row=np.searchsorted(self.cellid,hex_id)
+        return row<len(self.cellid) and self.cellid[row]==hex_id
+
+    def __len__(self):
+        return len(self.cellid)
+
+    def __getitem__(self,hex_id):
+        row=self.rows([hex_id])[0]
+        start,stop=self.indptr[row],self.indptr[row+1]
+        area=self.weights[start:stop].astype(np.float64)*self.norm[row]
+        return [((int(flat//self.resolution[1]),int(flat%self.resolution[1])),
+                    coef) for flat,coef in zip(self.indices[start:stop],area)]
+
+class CoefBundle(object):
+    '''
+    This class reads and writes the bundle of interpolation coefficients
+    of all the layers (see the layout above).
+    USAGE:
+        Writing:
+            bundle=CoefBundle(bundle_path,resolution,edge_length,origin)
+            bundle.add_layer(layer,coef_dict_to_csr(coef_dict,resolution))
+        Reading:
+            bundle=CoefBundle(bundle_path)
+            layer_coef=bundle.layer(layer)
+        Caching (when writing):
+            bundle=CoefBundle(bundle_path,resolution,edge_length,origin,
+                                cache_key,geometry_hash)
+            layers_to_compute=[layer for layer in layers
+                                if not bundle.is_layer_valid(layer)]
+        Aliases (layers with the same cells as another one):
+            bundle.add_layer(layer,csr_arrays,fingerprint)
+            bundle.add_alias(other_layer,layer)
+    '''
+    def __init__(self,bundle_path,resolution=None,edge_length=None,
+                    origin=None,cache_key=None,geometry_hash=None):
+        self.bundle_path=bundle_path
+        #The LayerCoef already opened (shared by the aliases of the layer)
+        self._layer_coefs={}
+        index_filename=os.path.join(bundle_path,'index.json')
+        if os.path.exists(index_filename):
+            fhandle=open(index_filename,'r')
+            self.index=json.load(fhandle)
+            fhandle.close()
+            #Checking the mesh if we are adding to an existing bundle
+            if resolution is not None:
+                assert tuple(self.index['resolution'])==tuple(resolution),\
+                                    'Resolution mismatch with the bundle'
+                assert self.index['edge_length']==edge_length,\
+                                    'Edge length mismatch with the bundle'
+                #Invalidating all the layers if made for other geometry/mesh
+                if cache_key is not None and \
+                        self.index.get('cache_key')!=cache_key:
+                    print '>>> Cache key changed, invalidating the bundle'
+                    self._init_index(resolution,edge_length,origin,
+                                        cache_key,geometry_hash)
+        elif resolution is not None:
+            if not os.path.exists(bundle_path):
+                os.makedirs(bundle_path)
+            self._init_index(resolution,edge_length,origin,
+                                cache_key,geometry_hash)
+        else:
+            raise IOError('No coefficient bundle found at: %s'%(bundle_path))
+
+    def _init_index(self,resolution,edge_length,origin,cache_key,
+                    geometry_hash):
+        self.index={
+            'version'       : bundle_version,
+            'resolution'    : [int(resolution[0]),int(resolution[1])],
+            'edge_length'   : edge_length,
+            'origin'        : None if origin is None else \
+                                [float(origin[0]),float(origin[1])],
+            'cache_key'     : cache_key,
+            'geometry_hash' : geometry_hash,
+            'coef_code_version' : coef_code_version,
+            'layers'        : {},
+        }
+        self._layer_coefs={}
+        self._write_index()
+
+    @property
+    def resolution(self):
+        return tuple(self.index['resolution'])
+
+    @property
+    def edge_length(self):
+        return self.index['edge_length']
+
+    @property
+    def layers(self):
+        return sorted(int(layer) for layer in self.index['layers'].keys())
+
+    def _write_index(self):
+        #Locking the index against the other jobs adding to the bundle and
+        #keeping the layers they added meanwhile (for the same cache key)
+        index_filename=os.path.join(self.bundle_path,'index.json')
+        with open(index_filename+'.lock','a') as lock_file:
+            fcntl.flock(lock_file,fcntl.LOCK_EX)
+            if os.path.exists(index_filename):
+                fhandle=open(index_filename,'r')
+                disk_index=json.load(fhandle)
+                fhandle.close()
+                if disk_index.get('cache_key')==self.index.get('cache_key'):
+                    for layer,layer_entry in disk_index['layers'].items():
+                        self.index['layers'].setdefault(layer,layer_entry)
+            #Writing to a temporary file of this job first so readers never
+            #see half index
+            temp_fd,temp_filename=tempfile.mkstemp(dir=self.bundle_path,
+                                            prefix='index.json.',suffix='.tmp')
+            fhandle=os.fdopen(temp_fd,'w')
+            json.dump(self.index,fhandle,indent=1,sort_keys=True)
+            fhandle.close()
+            os.chmod(temp_filename,0644)
+            os.rename(temp_filename,index_filename)
+
+    def _array_filename(self,layer,name):
+        return os.path.join(self.bundle_path,'layer_%s_%s.npy'%(layer,name))
+
+    def add_layer(self,layer,csr_arrays,fingerprint=None):
+        '''
+        Saves the CSR arrays (as given by coef_dict_to_csr) of the layer
+        and registers it in the index along with the fingerprint of its
+        cells (if given) to find the layers with same cells later.
+        '''
+        cellid,indptr,indices,weights,norm=csr_arrays
+        for name,array in zip(['cellid','indptr','indices','weights','norm'],
+                                [cellid,indptr,indices,weights,norm]):
+            np.save(self._array_filename(layer,name),array)
+
+        self.index['layers'][str(layer)]={
+                        'nrows'     : int(len(cellid)),
+                        'nnz'       : int(len(indices)),
+                        'cache_key' : self.index.get('cache_key'),
+                        'fingerprint' : fingerprint,
+                        }
+        self._layer_coefs.pop(int(layer),None)
+        self._write_index()
+
+    def add_alias(self,layer,target_layer):
+        '''
+        Registers the layer as an alias of the target layer (having the same
+        cells) so it uses the coefficients of the target, without any array
+        saved for it. The arrays of the layer (if saved earlier) are removed.
+        '''
+        target_layer=self.resolve_layer(target_layer)
+        if target_layer==int(layer):
+            raise ValueError('Layer %s cannot be an alias of itself'%(layer))
+        for name in ['cellid','indptr','indices','weights','norm']:
+            if os.path.exists(self._array_filename(layer,name)):
+                os.remove(self._array_filename(layer,name))
+
+        self.index['layers'][str(layer)]={
+                        'alias_of'  : target_layer,
+                        'cache_key' : self.index.get('cache_key'),
+                        }
+        self._layer_coefs.pop(int(layer),None)
+        self._write_index()
+
+    def alias_of(self,layer):
+        '''
+        Gives the layer of which the given layer is an alias (None if the
+        layer has its own coefficients).
+        '''
+        return self.index['layers'][str(layer)].get('alias_of')
+
+    def resolve_layer(self,layer):
+        '''
+        Gives the layer whose arrays hold the coefficients of given layer.
+        '''
+        if str(layer) not in self.index['layers']:
+            raise KeyError('Layer %s not in the bundle %s'%(layer,
+                                                    self.bundle_path))
+        target_layer=self.alias_of(layer)
+        if target_layer is None:
+            return int(layer)
+        return self.resolve_layer(target_layer)
+
+    def get_fingerprint(self,layer):
+        '''
+        Gives the fingerprint of the cells of the layer (None if unknown).
+        '''
+        return self.index['layers'][str(self.resolve_layer(layer))].get(
+                                                            'fingerprint')
+
+    def is_layer_valid(self,layer):
+        '''
+        Checks if the layer is in the bundle, was made with the current
+        cache key and all its arrays (or those of the layer it is an alias
+        of) are there with the expected size.
+        '''
+        layer_entry=self.index['layers'].get(str(layer))
+        if layer_entry is None or \
+                layer_entry.get('cache_key')!=self.index.get('cache_key'):
+            return False
+        if layer_entry.get('alias_of') is not None:
+            return self.is_layer_valid(layer_entry['alias_of'])
+        expected_length={
+            'cellid'    : layer_entry['nrows'],
+            'indptr'    : layer_entry['nrows']+1,
+            'indices'   : layer_entry['nnz'],
+            'weights'   : layer_entry['nnz'],
+            'norm'      : layer_entry['nrows'],
+        }
+        for name,length in expected_length.items():
+            array_filename=self._array_filename(layer,name)
+            if not os.path.exists(array_filename):
+                return False
+            try:
+                array=np.load(array_filename,mmap_mode='r')
+            except (IOError,ValueError):
+                return False
+            if array.shape!=(length,):
+                return False
+        return True
+
+    def check_layers(self,layers):
+        '''
+        Raises an error if any of the given layers is missing or invalid,
+        to fail before starting the interpolation with stale coefficients.
+        '''
+        invalid_layers=[layer for layer in layers
+                            if not self.is_layer_valid(layer)]
+        if len(invalid_layers)>0:
+            raise ValueError('Missing or invalid layers %s in the bundle %s'%(
+                                invalid_layers,self.bundle_path))
+
+    def check_geometry(self,geometry_hash):
+        '''
+        Raises an error if the bundle was made for another geometry or with
+        another version of the coefficient calculation code.
+        '''
+        if self.index.get('geometry_hash')!=geometry_hash:
+            raise ValueError('The bundle %s was made for another geometry '\
+                            '(%s instead of %s)'%(self.bundle_path,
+                            self.index.get('geometry_hash'),geometry_hash))
+        if self.index.get('coef_code_version')!=coef_code_version:
+            raise ValueError('The bundle %s was made by another code version '\
+                            '(%s instead of %s)'%(self.bundle_path,
+                            self.index.get('coef_code_version'),
+                            coef_code_version))
+
+    def layer(self,layer):
+        '''
+        Gives the LayerCoef of the layer with the arrays memory mapped.
+        The aliases of a layer are given the same LayerCoef object.
+        '''
+        layer=self.resolve_layer(layer)
+        if layer not in self._layer_coefs:
+            arrays=[np.load(self._array_filename(layer,name),mmap_mode='r')
+                    for name in ['cellid','indptr','indices','weights','norm']]
+            self._layer_coefs[layer]=LayerCoef(*arrays,
+                                            resolution=self.resolution)
+        return self._layer_coefs[layer]
+
+def derive_coarse_bundle(bundle,pyramid_factor):
+    '''
+    DESCRIPTION:
+        This function derives the bundle of the coarser level of the
+        pyramid from the (finest) bundle. The coarse bundle is keyed by
+        the same geometry, so only its missing or invalid layers are made.
+    USAGE:
+        INPUT:
+            bundle          : the CoefBundle of the fine mesh
+            pyramid_factor  : the number of fine cells per coarse cell side
+        OUTPUT:
+            coarse_bundle   : the CoefBundle of the coarse mesh
+    '''
+    if bundle.index.get('origin') is None:
+        raise ValueError('The origin of the bundle %s is unknown, cannot '\
+                            'align the coarse mesh'%(bundle.bundle_path))
+    coarse_resolution,coarse_edge_length,coarse_origin=get_coarse_mesh(
+                            bundle.resolution,bundle.edge_length,
+                            bundle.index['origin'],pyramid_factor)
+
+    cache_key=None
+    geometry_hash=bundle.index.get('geometry_hash')
+    if geometry_hash is not None:
+        cache_key=get_cache_key(geometry_hash,coarse_edge_length,
+                                coarse_origin,coarse_resolution)
+    coarse_bundle=CoefBundle(get_coef_bundle_path(coarse_resolution,
+                                coarse_edge_length),
+                            coarse_resolution,coarse_edge_length,
+                            coarse_origin,cache_key,geometry_hash)
+
+    #Deriving the layers having their own coefficient first
+    for layer in bundle.layers:
+        if bundle.alias_of(layer) is not None or \
+                coarse_bundle.is_layer_valid(layer):
+            continue
+        print '>>> Deriving layer %s for pyramid factor %s'%(layer,
+                                                        pyramid_factor)
+        layer_coef=bundle.layer(layer)
+        coarse_bundle.add_layer(layer,coarsen_csr((layer_coef.cellid,
+                                layer_coef.indptr,layer_coef.indices,
+                                layer_coef.weights,layer_coef.norm),
+                                bundle.resolution,pyramid_factor),
+                                bundle.get_fingerprint(layer))
+    #The aliases remain the same in the coarse bundle
+    for layer in bundle.layers:
+        if bundle.alias_of(layer) is not None and \
+                not coarse_bundle.is_layer_valid(layer):
+            coarse_bundle.add_alias(layer,bundle.alias_of(layer))
+
+    return coarse_bundle
+
+def convert_coef_pickles(resolution,edge_length,layers,bundle_path=None,
+                            geometry_fname=None):
+    '''
+    DESCRIPTION:
+        This function converts the old per-layer coefficient pickles
+        (coef_dict_layer_<l>_res_<res>_len_<len>.pkl) to a bundle.
+        The mesh origin is taken from the saved square mesh if available.
+    USAGE:
+        INPUT:
+            resolution  : the resolution of the mesh of the pickles
+            edge_length : the edge length of the mesh of the pickles
+            layers      : the list of layers to convert
+            bundle_path : where to create the bundle (default location
+                            if not given)
+            geometry_fname: the geometry file with which the pickles were
+                            made (optional) to record its hash in bundle
+        OUTPUT:
+            bundle      : the CoefBundle created
+    '''
+    if bundle_path is None:
+        bundle_path=get_coef_bundle_path(resolution,edge_length)
+
+    #Retreiving the mesh origin from the saved square mesh
+    origin=None
+    sq_cells_filename=sq_cells_basepath+'sq_cells_dict_res_%s,%s_len_%s.pkl'%(
+                                resolution[0],resolution[1],edge_length)
+    if os.path.exists(sq_cells_filename):
+        fhandle=open(sq_cells_filename,'rb')
+        sq_mesh=pickle.load(fhandle)
+        fhandle.close()
+        origin=sq_mesh[(0,0)].center.coords[0]
+
+    #Recording the geometry (if known) to validate the bundle later
+    cache_key=None
+    geometry_hash=None
+    if geometry_fname is not None and origin is not None:
+        geometry_hash=geometry_file_hash(geometry_fname)
+        cache_key=get_cache_key(geometry_hash,edge_length,origin,resolution)
+
+    bundle=CoefBundle(bundle_path,resolution,edge_length,origin,
+                        cache_key,geometry_hash)
+    for layer in layers:
+        coef_filename=sq_cells_basepath+\
+                    'coef_dict_layer_%s_res_%s,%s_len_%s.pkl'%(
+                            layer,resolution[0],resolution[1],edge_length)
+        print '>>> Converting: ',coef_filename
+        fhandle=open(coef_filename,'rb')
+        coef_dict=pickle.load(fhandle)
+        fhandle.close()
+        bundle.add_layer(layer,coef_dict_to_csr(coef_dict,resolution))
+
+    return bundle
+
+if __name__=='__main__':
+    import optparse
+    usage = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option('--resolution',dest='resolution',
+                help='resolution of the pickles as res_x,res_y',default='514,513')
+    parser.add_option('--edge_length',dest='edge_length',
+                help='edge_length of square', type='float', default=0.7)
+    parser.add_option('--no_layers',dest='no_layers',
+                help='number of layers to convert',type='int',default=40)
+    parser.add_option('--input_geometry',dest='input_file',
+                help='geometry file with which the pickles were made',
+                default=None)
+    (opt, args) = parser.parse_args()
+
+    resolution=tuple(int(res) for res in opt.resolution.split(','))
+    convert_coef_pickles(resolution,opt.edge_length,
+                            range(1,opt.no_layers+1),
+                            geometry_fname=opt.input_file)
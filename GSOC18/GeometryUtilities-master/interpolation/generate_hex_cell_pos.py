@@ -1,5 +1,5 @@
 from main import get_subdet
-from geometry.cmssw import read_geometry
+from geometry.cmssw import read_geometry_cached
 import cPickle as pickle
 import datetime
 
@@ -25,7 +25,7 @@ def readGeometry( input_file,  layer, subdet ):
     '''
     t0 = datetime.datetime.now()
     treename = 'hgcaltriggergeomtester/TreeCells'
-    cells = read_geometry(filename=input_file, treename=treename,
+    cells = read_geometry_cached(filename=input_file, treename=treename,
               subdet=subdet, layer=layer, wafer=-1)
     cells_d = dict([(c.id, c.center.coords[0]) for c in cells])
     t1 = datetime.datetime.now()
@@ -8,13 +8,18 @@ import cPickle as pickle
 import pandas as pd
 #Linear Algebra library
 import numpy as np
-from scipy.spatial import  cKDTree
+import scipy.sparse
 #Plotting Imports and configuration
 import matplotlib.pyplot as plt
 from shapely.geometry import LineString,Polygon
 from descartes.patch import PolygonPatch
 #Importing custom classes and function
-from sq_Cells import sq_Cells
+from sq_Cells import sq_Cells,SquareMesh
+from geometry.cell import CellArray
+from coef_bundle import CoefBundle,get_coef_bundle_path,get_coarse_mesh
+from record_writer import ParallelRecordWriter,ShardedRecordWriter
+from record_writer import PendingBudget
+from record_writer import get_record_index_filename
 #Importing a required function from main file
 #from main import get_subdet as _get_subdet
 #Importing Tensorflow to save the tfRecords
@@ -31,9 +36,14 @@ if not os.path.exists(sq_cells_basepath):
 image_basepath='image_data/'
 if not os.path.exists(image_basepath):
     os.makedirs(image_basepath)
+#Default bound on the memory of the images being interpolated (in bytes)
+#in compute_energy_map, the events are interpolated block by block within it
+image_memory_budget=1024*1024*1024
+#Fraction of it bounding the copies of the images waiting in the writers
+image_pending_fraction=0.5
 
 #################Function Definition####################
-def linear_interpolate_hex_to_square(hex_cells_dict,sq_cells_dict,edge_length):
+def linear_interpolate_hex_to_square(hex_cells_dict,sq_mesh,edge_length):
     '''
     DESCRIPTION:
         This function will interpolate the energy deposit in hexagonal cells
@@ -43,7 +53,10 @@ def linear_interpolate_hex_to_square(hex_cells_dict,sq_cells_dict,edge_length):
 
     INPUT:
         hex_cells_dict  : the dictionary of input geometry read from root file
-        sq_cells_dict   : the common square cell mesh for interpolation
+                            or directly its CellArray (only its vertex
+                            arrays are used, no polygon is made)
+        sq_mesh         : the common square cell mesh (SquareMesh) for
+                            interpolation
         edge_length     : the edge length of the square cells
     OUTPUT:
         coef(unnormalized) : a dictionary which contains the coefficient of overlap
@@ -53,29 +66,16 @@ def linear_interpolate_hex_to_square(hex_cells_dict,sq_cells_dict,edge_length):
                             }
     '''
 
-    #Calculating the maximum length of any cells
-        #(will to used to specify search radius in KD tree)
-    print '>>> Calculating the Search Radius'
+    assert (sq_mesh.edge_length==edge_length),'Mesh edge length mismatch'
     t0=datetime.datetime.now()
-    max_length_hex=max(map(
-                    lambda c: max([
-                    c.vertices.bounds[2]-c.vertices.bounds[0],
-                    c.vertices.bounds[3]-c.vertices.bounds[1]
-                    ]),hex_cells_dict.values())
-                    )
-    #DISCUSS and CONFIRM THIS LINE
-    max_length_sq=np.sqrt(edge_length**2+edge_length**2 )
-    #Any overlapping cells will be in this search radius
-    search_radius=(max_length_hex/2)+(max_length_sq/2)
-    t1=datetime.datetime.now()
-    print 'Search Radius finding completed in: ',t1-t0,' sec'
-
-    #Calculating the coefficient of overlap
     print '>>> Calculating the Overlap Coefficient'
-    coef_dict=calculate_overlap(hex_cells_dict.values(),sq_cells_dict.values(),
-                            search_radius,min_overlap_area=0.0)
-    t2=datetime.datetime.now()
-    print 'Overlap Coef Finding completed in: ',t2-t1,' sec'
+    hex_cells_list=hex_cells_dict
+    if not isinstance(hex_cells_list,CellArray):
+        hex_cells_list=hex_cells_dict.values()
+    coef_dict=calculate_overlap(hex_cells_list,sq_mesh,
+                                        min_overlap_area=0.0)
+    t1=datetime.datetime.now()
+    print 'Overlap Coef Finding completed in: ',t1-t0,' sec'
 
     #Returning the coef_dict,resolution and the edge length
     return coef_dict
@@ -90,20 +90,29 @@ def generate_mesh(hex_cells_dict,edge_length,save_sq_cells=False):
     USAGE:
         INPUT:
             hex_cells_dict  : the dictionary containing the hexagonal cells
+                                (or their CellArray)
             edge_length     : the edge length of each square cells
         OUTPUT:
             resolution      : the resolution of mesh grid for the given detector
                                 layers at the current edge_length
-            sq_cells_dict   : the square mesh dictionary for furthur interpolation
+            sq_mesh         : the square mesh (SquareMesh) for furthur
+                                interpolation
     '''
     #Iterating over all the cells to get the bounds of the detector
     print '>>> Calculating Bounds'
     t1=datetime.datetime.now()
-    cell_bounds=map(lambda c:c.vertices.bounds,hex_cells_dict.values())
-    max_x=max(bound[2] for bound in cell_bounds)
-    min_x=min(bound[0] for bound in cell_bounds)
-    max_y=max(bound[3] for bound in cell_bounds)
-    min_y=min(bound[1] for bound in cell_bounds)
+    if isinstance(hex_cells_dict,CellArray):
+        #Directly from the vertex arrays (padded with nan)
+        max_x=float(np.nanmax(hex_cells_dict.vertices[:,:,0]))
+        min_x=float(np.nanmin(hex_cells_dict.vertices[:,:,0]))
+        max_y=float(np.nanmax(hex_cells_dict.vertices[:,:,1]))
+        min_y=float(np.nanmin(hex_cells_dict.vertices[:,:,1]))
+    else:
+        cell_bounds=map(lambda c:c.vertices.bounds,hex_cells_dict.values())
+        max_x=max(bound[2] for bound in cell_bounds)
+        min_x=min(bound[0] for bound in cell_bounds)
+        max_y=max(bound[3] for bound in cell_bounds)
+        min_y=min(bound[1] for bound in cell_bounds)
     t2=datetime.datetime.now()
     layer_bounds=(min_x,min_y,max_x,max_y)
     print 'Bounds: xmin:%s ,xmax:%s '%(min_x,max_x)
@@ -129,19 +138,19 @@ def generate_mesh(hex_cells_dict,edge_length,save_sq_cells=False):
 
     #Creating the Square Mesh Grid
     print '>>> Generating the Square Mesh'
-    sq_cells_dict=_get_square_cells(resolution,layer_bounds,edge_length,save_sq_cells)
+    sq_mesh=_get_square_cells(resolution,layer_bounds,edge_length,save_sq_cells)
     t3=datetime.datetime.now()
     print 'Generation Complete in: ',t3-t2,' sec'
-    return resolution,sq_cells_dict
+    return resolution,sq_mesh
 
 def _get_square_cells(resolution,layer_bounds,edge_length,save_sq_cells):
     '''
     DESCRIPTION:
-        This function will generate square mesh grid by Creating
-    the square polygon. This function create the square cell using the
-    class defined in sq_Cells.py script. This first calculate the appropriate
-    length of the square cells based on the resolution i.e total number of
-    cells in each direction and distance available.
+        This function will generate square mesh grid. The mesh is not
+    stored cell by cell but described by a SquareMesh (defined in
+    sq_Cells.py) holding the origin, edge length and resolution, so its
+    memory doesnt depend on the resolution. The sq_Cells (square polygon)
+    are created by it only when someone asks for them.
     USAGE:
         INPUT:
             resolution      : the number of cells in both x and y direction in
@@ -151,56 +160,47 @@ def _get_square_cells(resolution,layer_bounds,edge_length,save_sq_cells):
             save_sq_cells   : a boolean whether to save the square cell geometry
                                 default: False
         OUPUT:
-            sq_cells        : a dictionary with the key as id of cell and
-                                value as the square cell object.
+            sq_mesh         : the SquareMesh object which could still be used
+                                as the old dictionary of square cells:
                                 {
                                 key:(i,j) : value:(sqCell object)
                                 }
-            This dictionary is saved as pickle file in a new directory created
+            This mesh is saved as pickle file in a new directory created
             automatically in current directory named as 'sq_cells_data'
     '''
-    #Creating empty array to store
-    #sq_cells=np.empty(resolution,dtype=np.object)
-    sq_cells={}
-
     min_x,min_y,max_x,max_y=layer_bounds
-    #Length in each dimension (Square box)
-    x_length=edge_length
-    y_length=edge_length
-
-    #Time Comlexity = O(res[0]*res[1])
-    for i in range(resolution[0]):
-        for j in range(resolution[1]):
-            #Center of the square polygon
-            #Now they wont coincide with actual center of polygon
-            center=(min_x+i*x_length,min_y+j*y_length)
-            id=(i,j)    #given in usual matrix notation
-            sq_cells[id]=sq_Cells(id,center,x_length,y_length)
+    #Center of the square (i,j) is (min_x+i*edge_length,min_y+j*edge_length)
+    #Now they wont coincide with actual center of polygon
+    sq_mesh=SquareMesh((min_x,min_y),edge_length,resolution)
 
     #Saving the sq_cell sq_cell_data in given folder (Optional)
     if save_sq_cells==True:
         sq_cells_filename=sq_cells_basepath+'sq_cells_dict_res_%s,%s_len_%s.pkl'%(
                                     resolution[0],resolution[1],edge_length)
         fhandle=open(sq_cells_filename,'wb')
-        pickle.dump(sq_cells,fhandle,protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(sq_mesh,fhandle,protocol=pickle.HIGHEST_PROTOCOL)
         fhandle.close()
 
-    return sq_cells
+    return sq_mesh
 
-def calculate_overlap(hex_cells_list,sq_cells_list,search_radius,min_overlap_area=0.0):
+def calculate_overlap(hex_cells_list,sq_mesh,min_overlap_area=0.0):
     '''
     DESCRIPTION:
         This function calculate the overlap coeffieicnt from between the
         hexagonal cell and corresponding square cells. It is called internally
         by above linear_interpolate_hex_to_square frunciton.
 
+        The candidate square cells of each hexagonal cell are the index
+        range of its bounding box in the mesh (no KD-Tree needed) and all the
+        candidate pairs are clipped at once by the vectorized
+        _clip_polygons_by_boxes (exact convex polygon clipping).
+
         Generated a coefficient dictionary of form:
         { hexagon id 1: [(overlap_sq_cell_id,overlap_coefficient),(....),(.....)]
         }
     INPUT:
-        hex_cells_list  : hexagonal cells in form of list
-        sq_cells_list   : square cells in form of list
-        search_radius   : upto what distance to search in KD-Tree.
+        hex_cells_list  : hexagonal cells in form of list (or CellArray)
+        sq_mesh         : the square mesh (SquareMesh)
         min_overlap_area: the minimum overlap with square cell to accept it
                             as candidate of overlap_cells
                             (default greater than 0.0)
@@ -209,51 +209,193 @@ def calculate_overlap(hex_cells_list,sq_cells_list,search_radius,min_overlap_are
                             with the overlapping square cells and their
                             coefficient of overlap in form of fraction of area.
     '''
-    hex_centers=np.array([cell.center.coords[0]
-                            for cell in hex_cells_list])
-    sq_centers=np.array([cell.center.coords[0]
-                            for cell in sq_cells_list])
-
-    hex_kd_tree=cKDTree(hex_centers)
-    sq_kd_tree=cKDTree(sq_centers)
+    hex_vertices=_get_vertex_array(hex_cells_list)
+    hex_bounds=np.concatenate([hex_vertices.min(axis=1),
+                                hex_vertices.max(axis=1)],axis=1)
 
     #Calculating all the possible overlaps of each hex cells
-    #with all the sq cells
-    overlap_candidate_id=hex_kd_tree.query_ball_tree(
-                                    sq_kd_tree,search_radius)
+    #with the sq cells in its bounding box
+    pair_hex_idx,pair_sq_idx=sq_mesh.candidates(hex_bounds)
+    sq_bounds=np.stack(sq_mesh.bounds(pair_sq_idx[:,0],pair_sq_idx[:,1]),
+                                axis=1)
+    overlap_area=_clip_polygons_by_boxes(hex_vertices,pair_hex_idx,
+                                    sq_bounds,np.arange(len(pair_hex_idx)))
+
+    #Filtering the ones accoding to minimum ovelap criteria
+    #by default the zero overlap cells are discarded
+    selected_indices=overlap_area>min_overlap_area
+    pair_hex_idx=pair_hex_idx[selected_indices]
+    #Storing the overlap area directly. Normalize later when using O(1)
+    overlap_area=overlap_area[selected_indices]
+    pair_sq_idx=pair_sq_idx[selected_indices]
+
+    #Splitting the pairs back per hexagonal cell
+    split_points=np.searchsorted(pair_hex_idx,
+                                    np.arange(1,len(hex_cells_list)))
+    pair_sq_idx=np.split(pair_sq_idx,split_points)
+    overlap_area=np.split(overlap_area,split_points)
+
+    #We are using the hex_cell is as the key instead of cell center
+    if isinstance(hex_cells_list,CellArray):
+        hex_ids=hex_cells_list.id.tolist()
+    else:
+        hex_ids=[hex_cell.id for hex_cell in hex_cells_list]
     coef_dict={}
-    for i,sq_cell_id in enumerate(overlap_candidate_id):
-        #Going one by one for each cell and seiving through
-        #all its overlap
-        hex_cell=hex_cells_list[i]
-        overlap_candidates=[sq_cells_list[j] for j in sq_cell_id]
-        overlap_area=[]
-        for overlap_candidate in overlap_candidates:
-            overlap=hex_cell.vertices.intersection(
-                        overlap_candidate.polygon)
-            overlap_area.append(overlap.area)
-
-        #Filtering the ones accoding to minimum ovelap criteria
-        #by default the zero overlap cells are discarded
-        sq_cell_id=np.array(sq_cell_id)
-        overlap_area=np.array(overlap_area)
-        selected_indices=overlap_area>min_overlap_area
-
-        #Final accumulation of selected cell and their overlap area
-        sq_cell_id_final=sq_cell_id[selected_indices]
-        overlap_area_final=overlap_area[selected_indices]
-        #Storing the overlap area directly. Normalize later when using O(1)
-        overlap_coef_final=overlap_area_final#/np.sum(overlap_area_final)
-
-        #We are using the hex_cell is as the key instead of cell center
-        #coef_dict[hex_cell.center.coords[0]]=[]
-        coef_dict[hex_cell.id]=[]
-        for fid,coef in zip(sq_cell_id_final,overlap_coef_final):
-            #coef_dict[hex_cell.center.coords[0]].append((sq_cells_list[fid].id,coef))
-            coef_dict[hex_cell.id].append((sq_cells_list[fid].id,coef))
+    for i,hex_id in enumerate(hex_ids):
+        coef_dict[hex_id]=[((int(ij[0]),int(ij[1])),coef)
+                    for ij,coef in zip(pair_sq_idx[i],overlap_area[i])]
 
     return coef_dict
 
+def _get_vertex_array(cells_list):
+    '''
+    DESCRIPTION:
+        This function packs the (convex) polygons of the cells into a
+        single (N,V,2) numpy array, V being the largest number of vertices
+        among them (6 for the full hexagonal cells). The cells having less
+        vertices (like the half cells at the wafer border) are padded by
+        repeating their last vertex, which leaves both the clipping and the
+        area unchanged.
+    USAGE:
+        INPUT:
+            cells_list      : list of cells having a shapely Polygon as the
+                                vertices attribute, or a CellArray whose
+                                vertex arrays are used directly
+        OUTPUT:
+            vertices        : the (N,V,2) array of vertices
+    '''
+    if isinstance(cells_list,CellArray):
+        n_vertices=cells_list.n_vertices
+        max_vertices=int(np.max(n_vertices))
+        #Index of the vertex at each position (the last one in the padding)
+        vertex_idx=np.minimum(np.arange(max_vertices)[np.newaxis,:],
+                                n_vertices[:,np.newaxis]-1)
+        return cells_list.vertices[np.arange(len(cells_list))[:,np.newaxis],
+                                    vertex_idx].astype(dtype)
+
+    coords=[cell.vertices.exterior.coords[:-1] for cell in cells_list]
+    max_vertices=max(len(cell_coords) for cell_coords in coords)
+
+    vertices=np.empty((len(coords),max_vertices,2),dtype=dtype)
+    for i,cell_coords in enumerate(coords):
+        nvert=len(cell_coords)
+        vertices[i,:nvert,:]=cell_coords
+        vertices[i,nvert:,:]=cell_coords[-1]
+
+    return vertices
+
+def _clip_polygons_by_boxes(poly_vertices,poly_idx,box_bounds,box_idx,
+                            chunk_size=2**18):
+    '''
+    DESCRIPTION:
+        This function calculates the exact area of overlap between the
+        convex polygons and the axis aligned boxes (the square cells) for
+        all the given (polygon,box) pairs at once. The Sutherland-Hodgman
+        clipping is done against the four sides of the box on the whole
+        batch of pairs with numpy, so there is no python loop over the pairs.
+
+        Each pair is translated to its box center before clipping to keep
+        the shoelace area precise far from the origin.
+    USAGE:
+        INPUT:
+            poly_vertices   : (N,V,2) array of the polygons' vertices as
+                                created by _get_vertex_array
+            poly_idx        : index of polygon of each pair
+            box_bounds      : (M,4) array of box bounds as
+                                (min_x,min_y,max_x,max_y)
+            box_idx         : index of box of each pair
+            chunk_size      : the number of pairs clipped in one go to
+                                keep the memory bounded
+        OUTPUT:
+            overlap_area    : the area of overlap for each of the pair
+    '''
+    overlap_area=np.empty((len(poly_idx),),dtype=dtype)
+    for start in range(0,len(poly_idx),chunk_size):
+        stop=start+chunk_size
+        bounds=box_bounds[box_idx[start:stop]]
+        center=np.stack([(bounds[:,0]+bounds[:,2])/2,
+                        (bounds[:,1]+bounds[:,3])/2],axis=1)
+        points=poly_vertices[poly_idx[start:stop]]-center[:,np.newaxis,:]
+        bounds=bounds-np.concatenate([center,center],axis=1)
+
+        #Clipping with each side of the box one by one
+        points=_clip_half_plane(points,0,bounds[:,0],keep_above=True)
+        points=_clip_half_plane(points,0,bounds[:,2],keep_above=False)
+        points=_clip_half_plane(points,1,bounds[:,1],keep_above=True)
+        points=_clip_half_plane(points,1,bounds[:,3],keep_above=False)
+
+        #Shoelace formula for the area of the clipped polygon
+        x=points[:,:,0]
+        y=points[:,:,1]
+        area=0.5*np.abs(np.sum(x*np.roll(y,-1,axis=1)-np.roll(x,-1,axis=1)*y,
+                                axis=1))
+        #Discarding the round-off area of the degenerate polygon left
+        #when the cells are just touching each other
+        box_area=(bounds[:,2]-bounds[:,0])*(bounds[:,3]-bounds[:,1])
+        area[area<=box_area*1e-12]=0.0
+        overlap_area[start:stop]=area
+
+    return overlap_area
+
+def _clip_half_plane(points,axis,bound,keep_above):
+    '''
+    DESCRIPTION:
+        One Sutherland-Hodgman step clipping a batch of convex polygons
+        with the line points[:,:,axis]==bound. It is used internally by
+        _clip_polygons_by_boxes.
+
+        The output of each vertex is itself if it lies inside and the
+        intersection point if the edge starting from it crosses the line.
+        The valid output points are then compacted to the front (keeping
+        their order) and the unused slots are filled with the last valid
+        point, so the polygons stay a rectangular array.
+    USAGE:
+        INPUT:
+            points      : (N,V,2) array of the polygons vertices
+            axis        : 0 to clip along x and 1 to clip along y
+            bound       : (N,) array of the position of clipping line
+            keep_above  : whether to keep the side above or below the line
+        OUTPUT:
+            points      : (N,W,2) array of the clipped polygons
+    '''
+    npoly,nvert,_=points.shape
+    next_points=np.roll(points,-1,axis=1)
+    dist=points[:,:,axis]-bound[:,np.newaxis]
+    if not keep_above:
+        dist=-dist
+    next_dist=np.roll(dist,-1,axis=1)
+
+    inside=dist>=0
+    crossing=inside!=(next_dist>=0)
+
+    #Intersection of the crossing edges with the clipping line
+    denom=np.where(crossing,dist-next_dist,1.0)
+    frac=np.where(crossing,dist/denom,0.0)
+    intersection=points+frac[:,:,np.newaxis]*(next_points-points)
+    intersection[:,:,axis]=bound[:,np.newaxis]
+
+    #Interleaving the candidate output points as vertex,intersection,...
+    candidates=np.empty((npoly,2*nvert,2),dtype=points.dtype)
+    candidates[:,0::2,:]=points
+    candidates[:,1::2,:]=intersection
+    valid=np.empty((npoly,2*nvert),dtype=np.bool_)
+    valid[:,0::2]=inside
+    valid[:,1::2]=crossing
+
+    #Compacting the valid points to the front (stable to keep the order)
+    count=np.sum(valid,axis=1)
+    width=max(int(np.max(count)),1) if npoly>0 else 1
+    order=np.argsort(~valid,axis=1,kind='mergesort')
+    slot=np.minimum(np.arange(width)[np.newaxis,:],
+                    np.maximum(count-1,0)[:,np.newaxis])
+    row=np.arange(npoly)[:,np.newaxis]
+    points=candidates[row,order[row,slot]]
+
+    #Polygons lying fully outside collapse to a single point (zero area)
+    points[count==0]=0.0
+
+    return points
+
 def plot_sq_cells(sq_cells_dict):
     '''
     DESCRIPTION:
@@ -390,36 +532,89 @@ def _get_layer_number_or_mask_from_detid(detid,mask_layer=None):
         layer_mask=subdet_mask & (layer_arr==mask_layer)
         return layer_mask
 
-def _get_cellid_energy_array(all_event_hits,layer,zside,event):
+#Number of segment keys reserved for each zside (layers are < 72)
+_layer_key_stride=128
+
+def _decode_hits(all_event_hits,event_start_no,event_stride,event_mask):
     '''
     DESCRIPTION:
-        This will create the energy array and cellid whithout the extra memory
-        overhead of mask.
+        This function decodes the hits of all the (non masked) events of the
+        minibatch in a single pass. The jagged detid and energy arrays of
+        the events are flattened once into contiguous arrays, the
+        subdet/zside/layer/cellid are decoded vectorially for all the hits
+        and the hits are then grouped by a stable sort in (zside,layer,event)
+        segments. The hits of one layer of one zside for all the events are
+        then just a slice of these arrays (see _get_hit_segment).
+    USAGE:
+        INPUT:
+            all_event_hits  : the dataframe containing the rechits of the events
+            event_start_no  : the starting event number of the minibatch
+            event_stride    : the size of the minibatch
+            event_mask      : whether to select an event or not
+        OUTPUT:
+            decoded_hits    : a dictionary with the sorted arrays
+                                'segment_key' : (zside*128+layer)*stride+example
+                                'example_idx' : index of the event in minibatch
+                                'cellid'      : hexagonal cell id of the hit
+                                'energy'      : energy of the hit
     '''
-    #getting the cellid by masking detid's last 18 bits
-    detid=all_event_hits.loc[event,'detid']
-    cellid_arr=detid & 0x3FFFF
-
-    layer_mask=_get_layer_number_or_mask_from_detid(detid,layer)
-    zside_mask=((detid>>24) & 0x1)==zside
-    mask=layer_mask & zside_mask    #Final mnet mask
-
-    #Now masking both the energy arr and cellid arr to retreive data of this layer
-    energy_arr=np.squeeze(all_event_hits.loc[event,'energy']).reshape((-1,))
-    #(LC) required for logical error check
-    # z_arr=np.squeeze(all_event_hits.loc[event,'z']).reshape((-1,))
-    # cluster2d_arr=np.squeeze(all_event_hits.loc[event,'cluster2d']).reshape((-1,))
-    # cluster3d_arr=np.squeeze(
-    #     all_event_hits.loc[event,'cluster2d_multicluster'][cluster2d_arr]).reshape((-1,))
+    #Flattening the jagged arrays of the selected events
+    examples=[example_idx for example_idx in range(event_stride)
+                    if event_mask[example_idx]]
+    detid_list=[np.asarray(all_event_hits.loc[event_start_no+example_idx,
+                    'detid'],dtype=np.int64).reshape((-1,))
+                    for example_idx in examples]
+    energy_list=[np.squeeze(all_event_hits.loc[event_start_no+example_idx,
+                    'energy']).reshape((-1,))
+                    for example_idx in examples]
+    hit_counts=np.array([detid.shape[0] for detid in detid_list],
+                            dtype=np.int64)
+    detid=np.concatenate(detid_list+[np.zeros((0,),dtype=np.int64)])
+    energy=np.concatenate(energy_list+[np.zeros((0,),dtype=np.float32)])
+    example_idx=np.repeat(np.array(examples,dtype=np.int64),hit_counts)
+
+    #Decoding all the hits at once
+    cellid=detid & 0x3FFFF
+    zside=(detid>>24) & 0x1
+    subdet=(detid>>25) & 0x7
+    layer=(detid>>19) & 0x1F
+    layer=layer+(subdet==4)*28+(subdet==5)*40
+
+    #Keeping only the hits of the HGCal subdets (EE,FH,BH)
+    subdet_mask=(subdet==3) | (subdet==4) | (subdet==5)
+
+    #Grouping the hits in (zside,layer,event) segments
+    segment_key=(zside*_layer_key_stride+layer)*event_stride+example_idx
+    segment_key=segment_key[subdet_mask]
+    order=np.argsort(segment_key,kind='mergesort')
+
+    decoded_hits={
+        'segment_key'   : segment_key[order],
+        'example_idx'   : example_idx[subdet_mask][order],
+        'cellid'        : cellid[subdet_mask][order],
+        'energy'        : energy[subdet_mask][order],
+    }
+    return decoded_hits
 
-    #Masking the array for requred zside->layer->event
-    cellid_arr=cellid_arr[mask]
-    energy_arr=energy_arr[mask]
-    #masking (LC)
-    # z_arr=z_arr[mask]
-    # cluster3d_arr=cluster3d_arr[mask]
+def _get_hit_segment(decoded_hits,zside,layer,event_stride,
+                        example_start=0,example_stop=None):
+    '''
+    DESCRIPTION:
+        Gives the example index, cellid and energy of the hits in the given
+        layer and zside of all the events (already sorted by event),
+        or of the events from example_start to example_stop (excluded),
+        as slices of the decoded hits.
+    '''
+    if example_stop is None:
+        example_stop=event_stride
+    key_start=(zside*_layer_key_stride+layer)*event_stride
+    start,stop=np.searchsorted(decoded_hits['segment_key'],
+                                [key_start+example_start,
+                                key_start+example_stop])
 
-    return cellid_arr,energy_arr#,cluster3d_arr,z_arr
+    return (decoded_hits['example_idx'][start:stop],
+            decoded_hits['cellid'][start:stop],
+            decoded_hits['energy'][start:stop])
 
 def _get_hit_layers(all_event_hits,event_start_no,event_stride):
     '''
@@ -442,6 +637,45 @@ def _get_hit_layers(all_event_hits,event_start_no,event_stride):
     layers=np.unique(layers)
     return layers.tolist()
 
+def interpolate_layer_hits(hit_example_idx,hit_cellid_arr,hit_energy_arr,
+                            layer_coef,no_examples):
+    '''
+    DESCRIPTION:
+        This function interpolates the hits of one layer of all the events
+        of the minibatch at once. The hits are put in a sparse
+        (events x hexagonal cells) energy matrix which is multiplied with
+        the (hexagonal cells x square cells) coefficient matrix of the layer,
+        giving the interpolated image of this layer for all the events
+        in a single sparse product.
+    USAGE:
+        INPUT:
+            hit_example_idx : the index of the example (in the minibatch)
+                                to which each hit belong
+            hit_cellid_arr  : the hexagonal cell id of each hit
+            hit_energy_arr  : the energy of each hit
+            layer_coef      : the LayerCoef of this layer from the bundle
+            no_examples     : the number of examples in the minibatch
+        OUTPUT:
+            example_idx     : the example index of each non zero pixel
+            i,j             : the index of each non zero pixel in the mesh
+            energy          : the interpolated energy of each pixel
+    '''
+    #Building the sparse hit matrix (duplicate hits are summed up)
+    hit_rows=layer_coef.rows(hit_cellid_arr)
+    hit_matrix=scipy.sparse.csr_matrix(
+                    (np.asarray(hit_energy_arr,dtype=np.float64),
+                    (hit_example_idx,hit_rows)),
+                    shape=(no_examples,len(layer_coef)))
+
+    #Interpolating all the events of this layer in one go
+    image_matrix=(hit_matrix*layer_coef.matrix()).tocoo()
+
+    resolution=layer_coef.resolution
+    i=image_matrix.col//resolution[1]
+    j=image_matrix.col%resolution[1]
+
+    return image_matrix.row,i,j,image_matrix.data
+
 def _bytes_feature(value):
     '''
     DESCRIPTION:
@@ -451,10 +685,325 @@ def _bytes_feature(value):
     '''
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
+def _int64_list_feature(values):
+    '''
+    DESCRIPTION:
+        Makes the int64 list feature of the given (numpy) array.
+    '''
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+def _float_list_feature(values):
+    '''
+    DESCRIPTION:
+        Makes the float list feature of the given (numpy) array.
+    '''
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+def _get_image_feature(image,image_format):
+    '''
+    DESCRIPTION:
+        This function gives the features of the image of one example
+        in the required format:
+            dense   : 'image' the raw bytes of the whole image
+            sparse  : 'image_index' the flat (c-order) index of the non zero
+                        pixels and 'image_energy' the energy of those pixels.
+                        (densified back by the io_pipeline while reading)
+    '''
+    if image_format=='dense':
+        return {'image':_bytes_feature(image.tobytes())}
+    elif image_format=='sparse':
+        flat_image=image.reshape((-1,))
+        flat_index=np.flatnonzero(flat_image)
+        return {'image_index'  :_int64_list_feature(flat_index),
+                'image_energy' :_float_list_feature(flat_image[flat_index])}
+    else:
+        raise ValueError('Unknown image format: %s'%(image_format))
+
+def _get_roi_origin(image,roi_shape):
+    '''
+    DESCRIPTION:
+        This function finds the origin (first row and column in the full
+        image) of the region of interest of the given shape centered
+        on the energy weighted seed of the shower, i.e the energy weighted
+        barycenter of the image summed over all the layers.
+        The window is shifted to stay inside the image near the borders.
+    USAGE:
+        INPUT:
+            image       : the full (height,width,depth) image of the event
+            roi_shape   : the (height,width) of the region of interest
+        OUTPUT:
+            roi_origin  : numpy array of the (row,column) of the origin
+    '''
+    energy_2d=np.sum(image,axis=2,dtype=np.float64)
+    total_energy=np.sum(energy_2d)
+
+    #Finding the energy weighted seed (center of image for empty events)
+    if total_energy>0:
+        seed=np.array([
+            np.sum(np.sum(energy_2d,axis=1)*np.arange(image.shape[0])),
+            np.sum(np.sum(energy_2d,axis=0)*np.arange(image.shape[1]))
+            ])/total_energy
+    else:
+        seed=(np.array(image.shape[0:2])-1)/2.0
+
+    roi_shape=np.array(roi_shape,dtype=np.int64)
+    roi_origin=np.rint(seed).astype(np.int64)-roi_shape//2
+    roi_origin=np.clip(roi_origin,0,np.array(image.shape[0:2])-roi_shape)
+
+    return roi_origin
+
+def check_roi_shape(roi_shape,resolution):
+    '''
+    DESCRIPTION:
+        Raises a ValueError if the region of interest is not a
+        (height,width) fitting inside the images of the given resolution.
+    '''
+    if len(roi_shape)!=2 or min(roi_shape)<=0:
+        raise ValueError('The roi_shape %s is not a (height,width)'%(
+                                                        str(roi_shape),))
+    if roi_shape[0]>resolution[0] or roi_shape[1]>resolution[1]:
+        raise ValueError('The roi_shape %s is larger than the images %s'%(
+                                        str(tuple(roi_shape)),
+                                        str(tuple(resolution))))
+
+def _get_roi_labels(label,roi_origin,mesh_origin,edge_length):
+    '''
+    DESCRIPTION:
+        Gives the label of an event whose image is cropped to the region of
+        interest, with the barycenter posx,posy made relative to the center
+        of the first pixel (roi_origin) of the region of interest, the row
+        and column of the image being along x and y of the mesh
+        (see SquareMesh). So the position target is the one seen by the
+        model in the cropped image.
+    '''
+    label=label.copy()
+    label[1]-=mesh_origin[0]+roi_origin[0]*edge_length
+    label[2]-=mesh_origin[1]+roi_origin[1]*edge_length
+
+    return label
+
+def coarsen_energy_map(energy_map,pyramid_factor):
+    '''
+    DESCRIPTION:
+        This function gives the images of the coarser level of the mesh
+        pyramid (see coef_bundle.get_coarse_mesh) by summing the energy of
+        the pyramid_factor x pyramid_factor blocks of pixels of the images.
+        This is same as interpolating with the coarse coefficients since the
+        coarse pixels are exactly the union of these fine pixels.
+    USAGE:
+        INPUT:
+            energy_map      : the (events,height,width,depth) images
+            pyramid_factor  : the number of fine pixels per coarse pixel side
+        OUTPUT:
+            coarse_map      : the (events,ceil(height/factor),
+                                ceil(width/factor),depth) images
+    '''
+    _,height,width,_=energy_map.shape
+
+    #Summing the blocks of rows then of columns, the last (ragged) block
+    #at the border taking only the pixels left, without copying the
+    #fine images (only a 1/factor sized image of row sums is made)
+    row_map=np.add.reduceat(energy_map,np.arange(0,height,pyramid_factor),
+                            axis=1)
+    coarse_map=np.add.reduceat(row_map,np.arange(0,width,pyramid_factor),
+                            axis=2)
+
+    return coarse_map
+
+def _write_examples(record_writer,energy_map,event_labels,event_mask,
+                    image_format,roi_shape,example_start=0,event_start_no=0,
+                    roi_mesh=None):
+    '''
+    DESCRIPTION:
+        Serializes the images of the selected events of the minibatch
+        along with their labels to the tfrecords writer.
+        When cropped to the roi_shape, the posx,posy labels are made
+        relative to the region of interest using the roi_mesh, the
+        (origin,edge_length) of the mesh of the images (see _get_roi_labels).
+        The energy_map can hold only the block of events of the minibatch
+        starting at example_start.
+        The event number (in the event file) of the examples, the
+        minibatch starting at event_start_no, is saved in the record
+        index of the ParallelRecordWriter.
+    '''
+    #REMEMBER: we have to retreive in this format only. also check
+    #in what format numpy stores matrix by using tobytes.
+    #(row mojor or column major)
+    #(the labels are only there for the selected events)
+    label_idx=int(np.sum(event_mask[0:example_start]))
+    for block_idx in range(energy_map.shape[0]):
+        example_idx=example_start+block_idx
+        #Not saving the events which were not interpolated
+        if not event_mask[example_idx]:
+            continue
+        print 'Making example for: ',example_idx
+        image=energy_map[block_idx,:,:,:]
+        #Cropping the image to the region of interest around the shower
+        roi_origin=None
+        if roi_shape is not None:
+            roi_origin=_get_roi_origin(image,roi_shape)
+            image=image[roi_origin[0]:roi_origin[0]+roi_shape[0],
+                        roi_origin[1]:roi_origin[1]+roi_shape[1],:]
+        #Adding an event lable to check sequential access
+        label=event_labels[label_idx,:]
+        if roi_origin is not None:
+            label=_get_roi_labels(label,roi_origin,roi_mesh[0],roi_mesh[1])
+        label_bytes=label.tobytes()
+        if isinstance(record_writer,ParallelRecordWriter):
+            #(the ShardedRecordWriter too)
+            #Serialized in the pool from a copy since the energy_map
+            #is the scratch buffer cleared after the block
+            record_writer.submit(_serialize_example,np.array(image),
+                                    image_format,roi_origin,label_bytes,
+                                    event=event_start_no+example_idx,
+                                    size=image.nbytes)
+        else:
+            record_writer.write(_serialize_example(image,image_format,
+                                                roi_origin,label_bytes))
+        #Incrementing the label idx after the event which is not masked
+        #is serialized
+        label_idx+=1
+
+def _serialize_example(image,image_format,roi_origin,label_bytes):
+    '''
+    DESCRIPTION:
+        Makes the serialized example of the image of one event with
+        its label (and the origin of its region of interest if cropped).
+    '''
+    feature=_get_image_feature(image,image_format)
+    if roi_origin is not None:
+        feature['roi_origin']=_int64_list_feature(roi_origin)
+    feature['label']=_bytes_feature(label_bytes)
+    example=tf.train.Example(features=tf.train.Features(
+                                                feature=feature))
+
+    return example.SerializeToString()
+
+def split_memory_budget(memory_budget=None):
+    '''
+    DESCRIPTION:
+        Splits the memory budget of the images (image_memory_budget by
+        default) between the scratch buffer of the events interpolated
+        at a time and the copies of the images waiting to be serialized
+        and compressed, the PendingBudget shared by all the writers of the
+        images (of every zside and pyramid level).
+    USAGE:
+        OUTPUT:
+            scratch_bytes   : the bytes of the scratch buffer
+            pending_budget  : the PendingBudget of the writers
+    '''
+    if memory_budget is None:
+        memory_budget=image_memory_budget
+    pending_bytes=int(memory_budget*image_pending_fraction)
+
+    return memory_budget-pending_bytes,PendingBudget(pending_bytes)
+
+def get_image_record_writer(event_file_no,event_start_no,event_stride,zside,
+                            pyramid_factor=1,workers=None,
+                            pending_budget=None):
+    '''
+    DESCRIPTION:
+        Opens the (ZLIB compressed) tfrecords writer of the image dataset
+        of a minibatch for the given zside. The images coarser by a
+        pyramid_factor (>1) than the mesh are written in a separate file
+        suffixed by _pyramid_<factor>.
+        The examples are serialized and compressed by a pool of workers
+        threads (record_writer.record_writer_workers by default), or in
+        this thread if workers is 0, and written in order by a
+        ParallelRecordWriter along with the index of the events in the
+        file (see record_writer), replacing the index of an earlier file.
+        The images waiting in the pool are bounded by the pending_budget
+        (see split_memory_budget).
+    '''
+    image_filename=image_basepath+_get_image_file_prefix(event_file_no,
+                                    event_start_no,event_stride,zside,
+                                    pyramid_factor)+'.tfrecords'
+
+    return ParallelRecordWriter(image_filename,compression='ZLIB',
+                                workers=workers,
+                                pending_budget=pending_budget)
+
+def _get_image_file_prefix(event_file_no,event_start_no,event_stride,zside,
+                            pyramid_factor):
+    '''
+    DESCRIPTION:
+        The name of the image files of a minibatch (without extension)
+    '''
+    prefix='event_file_%s_start_%s_stride_%s_zside_%s'%(
+                            event_file_no,event_start_no,event_stride,zside)
+    if pyramid_factor!=1:
+        prefix=prefix+'_pyramid_%s'%(pyramid_factor)
+
+    return prefix
+
+def get_level_dataset_dir(dataset_dir,zside,pyramid_factor=1):
+    '''
+    DESCRIPTION:
+        The directory of the sharded dataset of the images of one zside
+        (and level of the pyramid), with its own train and valid
+        directories and manifest.json, so that all the shards in it have
+        the same image shape:
+            <dataset_dir>/zside_<zside>[_pyramid_<pyramid_factor>]/
+    '''
+    level_name='zside_%s'%(zside)
+    if pyramid_factor!=1:
+        level_name=level_name+'_pyramid_%s'%(pyramid_factor)
+
+    return os.path.join(dataset_dir,level_name)
+
+def get_level_image_shape(resolution,no_layers,pyramid_factor=1,
+                            roi_shape=None):
+    '''
+    DESCRIPTION:
+        The (height,width,depth) of the images saved for the given level
+        of the mesh pyramid (cropped to the roi_shape, scaled down for
+        the coarse levels, if given) as made by compute_energy_map.
+    '''
+    if roi_shape is not None:
+        return tuple(-(-size//pyramid_factor) for size in roi_shape)+\
+                                                            (no_layers,)
+
+    return tuple(-(-size//pyramid_factor) for size in resolution)+\
+                                                            (no_layers,)
+
+def get_image_shard_writer(dataset_dir,event_file_no,event_start_no,
+                            event_stride,zside,image_shape,pyramid_factor=1,
+                            image_format='dense',dtype=np.float32,
+                            shard_events=None,shard_bytes=None,
+                            valid_fraction=0.0,workers=None,
+                            pending_budget=None):
+    '''
+    DESCRIPTION:
+        Opens the writer of the image dataset of a minibatch for the given
+        zside (and level of the pyramid) in balanced shards of
+        shard_events examples or shard_bytes bytes, split in the train and
+        valid directories of the level directory in dataset_dir (see
+        get_level_dataset_dir) and listed with their image_shape, dtype
+        and image_format in its manifest.json
+        (see record_writer.ShardedRecordWriter).
+        The images waiting to be compressed are bounded by the
+        pending_budget (see split_memory_budget). With workers=0 they are
+        compressed and written in this thread (no pool).
+    '''
+    level_dir=get_level_dataset_dir(dataset_dir,zside,pyramid_factor)
+    prefix=_get_image_file_prefix(event_file_no,event_start_no,
+                                    event_stride,zside,pyramid_factor)
+
+    return ShardedRecordWriter(level_dir,prefix,shard_events=shard_events,
+                                shard_bytes=shard_bytes,
+                                valid_fraction=valid_fraction,
+                                image_shape=image_shape,image_dtype=dtype,
+                                image_format=image_format,
+                                compression='ZLIB',workers=workers,
+                                pending_budget=pending_budget)
+
 def compute_energy_map(all_event_hits,event_labels,event_mask,
                     interpolate_zside,resolution,edge_length,
                     event_file_no,event_start_no,event_stride,
-                    no_layers,dtype=np.float32):
+                    no_layers,dtype=np.float32,record_writers=None,
+                    image_format='dense',roi_shape=None,geometry_hash=None,
+                    pyramid_factors=[],memory_budget=None,
+                    writer_workers=None):
     '''
     DESCRIPTION:
         This function will finally map the energy deposit recorded in the
@@ -475,7 +1024,7 @@ def compute_energy_map(all_event_hits,event_labels,event_mask,
                                 all the events (a certain minibatch of events).
             event_labels    : the corresponding labels to the images to
                                 create the full data set here only
-            event_mask      : a mask whether to select an event or not based
+            event_mask      : a boolean mask whether to select an event or not based
                                 on the decision in the label creation function
             interpolate_zside: the zside we want to create the data set of
                                 since sometime we could want to create the dataset
@@ -491,6 +1040,45 @@ def compute_energy_map(all_event_hits,event_labels,event_mask,
                                 available to us right now)
             dtype           : np.float32 is kept as default to save memory
                                 of the model
+            record_writers  : optional dict {(zside,pyramid_factor):
+                                ParallelRecordWriter} (factor 1 for the mesh
+                                resolution) to write the examples to, when a
+                                minibatch is interpolated chunk by chunk in
+                                one file. (by default files are created
+                                for this call)
+            image_format    : 'dense' to save the whole image as bytes or
+                                'sparse' to save only the non zero pixels
+                                (same has to be given to the io_pipeline)
+            roi_shape       : optional (height,width) of the region of interest
+                                to save instead of the full image, centered
+                                on the energy weighted seed of the event.
+                                The (row,column) origin of the window in the
+                                full image is saved as 'roi_origin' feature
+                                to recover the global position, and the
+                                posx,posy labels are made relative to the
+                                window (needs the mesh origin in the bundle).
+            geometry_hash   : the hash of the geometry file (see geometry_file_hash)
+                                if given, the coefficient bundle is checked
+                                to be made for this geometry before starting
+            pyramid_factors : the list of factors (eg. [2,4]) of the coarser
+                                levels of the mesh pyramid whose images are
+                                also written (from the same read of the hits)
+                                in separate files, see coarsen_energy_map.
+                                The roi_shape is scaled down for them.
+            memory_budget   : the bound (in bytes) on the memory of the
+                                images being made, image_memory_budget
+                                by default. The events are interpolated and
+                                written block by block in one scratch
+                                buffer of a part of it (at least one event),
+                                the rest bounding the copies of the images
+                                waiting in all the writers created here
+                                (see split_memory_budget), so the memory
+                                does not depend on stride. The given
+                                record_writers should share the pending
+                                budget of the same split.
+            writer_workers  : the number of threads serializing and
+                                compressing the examples of the files
+                                created here (see get_image_record_writer)
         OUTPUT:
             energy_map      : a numpy array containing the map/interpolation
                                 of a minibatch of event.
@@ -508,127 +1096,134 @@ def compute_energy_map(all_event_hits,event_labels,event_mask,
     # sq_cells_dict=_readCoefFile(sq_cells_filename)
 
 
-    #Strating the tfRecord Writer
-    for zside in interpolate_zside:
-        image_filename=image_basepath+\
-                    'event_file_%s_start_%s_stride_%s_zside_%s.tfrecords'%(
-                                event_file_no,event_start_no,event_stride,zside)
-        compression_options=tf.python_io.TFRecordOptions(
-                        tf.python_io.TFRecordCompressionType.ZLIB)
-
-        with tf.python_io.TFRecordWriter(image_filename,
-                        options=compression_options) as record_writer:
-            #Initializing the numpy matrix to hold the interpolation
-            energy_map=np.zeros((event_stride,resolution[0],resolution[1],
-                                    no_layers),dtype=dtype)
-
-            #Starting to interpolate layer by layer for all the events
-            layers=range(1,no_layers+1)
-            #Better iterate only those layers whch are there in hit atleast once (LATER)
-            #layers=_get_hit_layers(all_event_hits,event_start_no,event_stride)
-            for layer in layers:
-                #Loading the interpolation coef for this layer
-                print '\n>>> Reading the layer %s interpolation coefficient'%(layer)
-                coef_filename='sq_cells_data/coef_dict_layer_%s_res_%s,%s_len_%s.pkl'%(
-                                            layer,resolution[0],resolution[1],edge_length)
-                coef_dict=_readCoefFile(coef_filename)
-
-                #(LC)Reading the position filename
-                # pos_fname='hex_pos_data/%s.pkl'%(layer)
-                # hex_pos=_readCoefFile(pos_fname)
-
-                #Now we will iterate the all the events
-                events=range(event_start_no,event_start_no+event_stride)
-                for event in events:
-                    #Filtering the event based on the event_mask
-                    if event_mask[event-event_start_no]=='False':
-                        continue
-
-                    print '>>> Interpolating for Event:%s zside:%s'%(event,zside)
-                    #Retreiving the data for that event of this layer(saving memory also)
-                    print '>>> Masking and retreiving the hit'
-                    hit_cellid_arr,hit_energy_arr=_get_cellid_energy_array(
-                                            all_event_hits,layer,zside,event)
-                    #(LC)
-                    # hit_cellid_arr,hit_energy_arr,hit_cluster3d_arr,hit_z_arr=_get_cellid_energy_array(
-                    #                         all_event_hits,layer,zside,event)
-
-                    #Checking if the event contains no hits in this layer
-                    if hit_energy_arr.shape[0]==0:
-                        print 'Empty Event: ',hit_energy_arr.shape
-                        continue
-
-                    #Now iterating over all the hits of this layer in this event
-                    for hit_id in range(hit_energy_arr.shape[0]):
-                        #Accquiring the hexagonal cell
-                        hex_cell_id=hit_cellid_arr[hit_id]
-
-                        #Retreiving the overlap coef from the dictionary
-                        overlaps=coef_dict[hex_cell_id]
-
-                        #Performing the interpolation
-                        hit_energy=hit_energy_arr[hit_id]
-
-                        #(LC)Adding the new key to multi-cluster properties
-                        # cluster3d=hit_cluster3d_arr[hit_id]
-                        # if (event,cluster3d) not in cluster_properties.keys():
-                        #     init_list=np.array([0,0,0,0],dtype=np.float64)
-                        #     mesh_list=np.array([0,0,0,0],dtype=np.float64)
-                        #     key=(event,cluster3d)
-                        #     cluster_properties[key]=[init_list,mesh_list]
-                        # #(LC)Now adding the hexagonal contribution to initial properties
-                        # hex_cell_center=hex_pos[hex_cell_id]
-                        # hit_Wx=hex_cell_center[0]*hit_energy
-                        # hit_Wy=hex_cell_center[1]*hit_energy
-                        # hit_Wz=hit_z_arr[hit_id]*hit_energy
-                        # init_list=[hit_energy,hit_Wx,hit_Wy,hit_Wz]
-                        # key=(event,cluster3d)
-                        # cluster_properties[key][0]+=init_list
-
-                        norm_coef=np.sum([overlap[1] for overlap in overlaps])
-                        for overlap in overlaps:
-                            #Calculating the interpolated/mesh energy for each overlap
-                            i,j=overlap[0]  #index of square cell
-                            weight=overlap[1]/norm_coef
-                            mesh_energy=hit_energy*weight
-
-                            #(LC) For adding the mesh contribution to mesh properties
-                            # sq_center=sq_cells_dict[(i,j)].center
-                            # mesh_energy=hit_energy*weight
-                            # mesh_Wx=mesh_energy*sq_center.coords[0][0]
-                            # mesh_Wy=mesh_energy*sq_center.coords[0][1]
-                            # mesh_Wz=mesh_energy*hit_z_arr[hit_id]
-                            # mesh_list=[mesh_energy,mesh_Wx,mesh_Wy,mesh_Wz]
-                            # key=(event,cluster3d)
-                            # cluster_properties[key][1]+=mesh_list
-
-                            example_idx=event-event_start_no
-                            energy_map[example_idx,i,j,layer-1]+=mesh_energy
-
-            #Now saving the energy calculated for the particular z-side of event
-            #REMEMBER: we have to retreive in this format only. also check
-            #in what format numpy stores matrix by using tobytes.
-            #(row mojor or column major)
-            label_idx=0
-            for example_idx in range(event_stride):
-                #Not saving the events which were not interpolated
-                if event_mask[example_idx]=='False':
-                    continue
-                print 'Making example for: ',example_idx
-                example=tf.train.Example(features=tf.train.Features(
-                    feature={
-                        'image': _bytes_feature(energy_map[example_idx,:,:,:].tobytes()),
-                        #Adding an event lable to check sequential access
-                        'label': _bytes_feature(event_labels[label_idx,:].tobytes())
-                    }
-                ))
-                record_writer.write(example.SerializeToString())
-                #Incrementing the label idx after the event which is not masked
-                #is serialized
-                label_idx+=1
-
-            #Testing the numpy array
-            #np.save(image_filename,energy_map)
+    #Opening the coefficient bundle of all the layers once (memory mapped)
+    coef_bundle=CoefBundle(get_coef_bundle_path(resolution,edge_length))
+    #Failing here itself if the coefficients are stale or missing
+    coef_bundle.check_layers(range(1,no_layers+1))
+    if geometry_hash is not None:
+        coef_bundle.check_geometry(geometry_hash)
+    #The mesh of each level to make the labels relative to the roi
+    level_meshes={}
+    if roi_shape is not None:
+        check_roi_shape(roi_shape,resolution)
+        origin=coef_bundle.index.get('origin')
+        if origin is None:
+            raise ValueError('The origin of the bundle is unknown, cannot '\
+                                'make the labels relative to the roi')
+        for pyramid_factor in [1]+list(pyramid_factors):
+            _,level_edge_length,level_origin=get_coarse_mesh(resolution,
+                                    edge_length,origin,pyramid_factor)
+            level_meshes[pyramid_factor]=(level_origin,level_edge_length)
+
+    #Decoding and grouping the hits of all the events once for all zside
+    print '>>> Decoding the hits of the minibatch'
+    decoded_hits=_decode_hits(all_event_hits,event_start_no,event_stride,
+                                event_mask)
+
+    #Number of events interpolated at a time in the scratch buffer
+    #(holding the images of all the zside)
+    scratch_bytes,pending_budget=split_memory_budget(memory_budget)
+    zsides=list(interpolate_zside)
+    event_bytes=resolution[0]*resolution[1]*no_layers*len(zsides)*\
+                            np.dtype(dtype).itemsize
+    block_size=int(max(1,min(event_stride,scratch_bytes//event_bytes)))
+    #The scratch buffer of the block, zeroed back only where it was filled
+    energy_map=np.zeros((len(zsides),block_size,resolution[0],resolution[1],
+                            no_layers),dtype=dtype)
+
+    #Strating the tfRecord Writer of all the zside and pyramid levels
+    #(written together block by block)
+    level_writers={}
+    for zside in zsides:
+        for pyramid_factor in [1]+list(pyramid_factors):
+            #Writing to the given writer when the minibatch is made chunk by chunk
+            if record_writers is None:
+                level_writers[(zside,pyramid_factor)]=get_image_record_writer(
+                                        event_file_no,event_start_no,
+                                        event_stride,zside,pyramid_factor,
+                                        writer_workers,pending_budget)
+            else:
+                level_writers[(zside,pyramid_factor)]=\
+                                record_writers[(zside,pyramid_factor)]
+
+    for example_start in range(0,event_stride,block_size):
+        example_stop=min(example_start+block_size,event_stride)
+        #Skipping the blocks without any selected event
+        if not np.any(event_mask[example_start:example_stop]):
+            continue
+        no_examples=example_stop-example_start
+        block_map=energy_map[:,0:no_examples]
+        filled_index=[]
+
+        #Starting to interpolate layer by layer for all the events
+        layers=range(1,no_layers+1)
+        #Better iterate only those layers whch are there in hit atleast once (LATER)
+        #layers=_get_hit_layers(all_event_hits,event_start_no,event_stride)
+        for layer in layers:
+            #Loading the interpolation coef for this layer
+            #(the layers aliased to the same cells share one coefficient)
+            print '\n>>> Reading the layer %s interpolation coefficient'%(layer)
+            coef_dict=coef_bundle.layer(layer)
+
+            #Slicing the hits of this layer of all the events of block for
+            #every zside, the images of the k-th zside being the rows
+            #k*no_examples onwards of the interpolation
+            hit_segments=[_get_hit_segment(decoded_hits,zside,layer,
+                                        event_stride,example_start,
+                                        example_stop)
+                            for zside in zsides]
+            hit_example_idx=np.concatenate([example_idx-example_start+
+                                        zside_idx*no_examples
+                            for zside_idx,(example_idx,_,_) in
+                                        enumerate(hit_segments)])
+            hit_cellid_arr=np.concatenate([cellid for _,cellid,_ in
+                                        hit_segments])
+            hit_energy_arr=np.concatenate([energy for _,_,energy in
+                                        hit_segments])
+
+            #Checking if none of the event contains hits in this layer
+            if hit_energy_arr.shape[0]==0:
+                print 'Empty Layer: ',layer
+                continue
+
+            #Performing the interpolation of all the events at once
+            example_idx,i,j,mesh_energy=interpolate_layer_hits(
+                                hit_example_idx,hit_cellid_arr,
+                                hit_energy_arr,coef_dict,
+                                len(zsides)*no_examples)
+            zside_idx=example_idx//no_examples
+            example_idx=example_idx%no_examples
+            #(each pixel appears only once in the sparse product)
+            block_map[zside_idx,example_idx,i,j,layer-1]+=mesh_energy
+            filled_index.append((zside_idx,example_idx,i,j,layer-1))
+
+        #Now saving the energy calculated for each z-side of event at the
+        #mesh resolution and all the coarser levels of the pyramid
+        for zside_idx,zside in enumerate(zsides):
+            for pyramid_factor in [1]+list(pyramid_factors):
+                if pyramid_factor==1:
+                    level_map=block_map[zside_idx]
+                    level_roi_shape=roi_shape
+                else:
+                    level_map=coarsen_energy_map(block_map[zside_idx],
+                                                    pyramid_factor)
+                    level_roi_shape=None if roi_shape is None else \
+                            get_level_image_shape(resolution,no_layers,
+                                        pyramid_factor,roi_shape)[0:2]
+
+                _write_examples(level_writers[(zside,pyramid_factor)],
+                                level_map,event_labels,event_mask,
+                                image_format,level_roi_shape,example_start,
+                                event_start_no,
+                                level_meshes.get(pyramid_factor))
+
+        #Clearing the scratch buffer for the next block
+        for zside_idx,example_idx,i,j,layer_idx in filled_index:
+            block_map[zside_idx,example_idx,i,j,layer_idx]=0
+
+    if record_writers is None:
+        for record_writer in level_writers.values():
+            record_writer.close()
 
     #(LC)Appending the properties to the final error list
     # for key,value in cluster_properties.iteritems():
@@ -649,6 +1244,49 @@ def compute_energy_map(all_event_hits,event_labels,event_mask,
     #return energy_map
 
 ############### TARGET CRETION FUNCTION################
+def _flatten_jagged_column(column):
+    '''
+    DESCRIPTION:
+        Flattens a column of the dataframe having for each event an array
+        per particle (eg. the posx of the particle at each layer) to one
+        array of all the particles, along with the length of the array of
+        each particle. The awkward JaggedArray of an event (as read by
+        uproot) is flattened whole from its counts and content, and so is
+        a regular (particles x layers) array; only the ragged lists are
+        gone through particle by particle.
+    USAGE:
+        INPUT:
+            column      : the values of the column for the events
+        OUTPUT:
+            flat_value  : the concatenated arrays of all the particles
+            lengths     : the length of the array of each particle
+    '''
+    flat_value=[]
+    lengths=[]
+    for value in column:
+        if hasattr(value,'counts'):
+            lengths.append(np.asarray(value.counts,dtype=np.int64))
+            flat_value.append(np.asarray(value.flatten(),dtype=np.float64))
+            continue
+        try:
+            value=np.asarray(value,dtype=np.float64)
+        except ValueError:
+            value=[np.asarray(pos,dtype=np.float64).reshape((-1,))
+                        for pos in value]
+            lengths.append(np.array([pos.shape[0] for pos in value],
+                                        dtype=np.int64))
+            flat_value.append(np.concatenate(value+[np.zeros((0,))]))
+            continue
+        if value.shape[0]==0:
+            continue
+        value=value.reshape((value.shape[0],-1))
+        lengths.append(np.full(value.shape[0],value.shape[1],
+                                dtype=np.int64))
+        flat_value.append(value.reshape((-1,)))
+
+    return np.concatenate(flat_value+[np.zeros((0,))]),\
+            np.concatenate(lengths+[np.zeros((0,),dtype=np.int64)])
+
 def _int64_feature(value):
     '''
     DESCRIPTION:
@@ -684,11 +1322,12 @@ def compute_target_lable(genpart_df,resolution,edge_length,
                                 datafile i.e the number of examples in this data
                                 file.
         OUTPUT:
-            event_mask      : a mas showing which event to take while Creating
-                                the image to have a sync between the image and
-                                label dataset
-            all_labels      : a numpy array of the labels of the event it has
-                                processed according to the event mask.
+            event_mask      : a boolean array showing which event to take
+                                while Creating the image to have a sync
+                                between the image and label dataset
+            all_labels      : a numpy array (events selected x 6) of the
+                                labels of the event it has processed
+                                according to the event mask.
     '''
     #Reading the sq_cells dict for finding the probable location of
     #particle to the square layer
@@ -700,97 +1339,72 @@ def compute_target_lable(genpart_df,resolution,edge_length,
     # #Creating the sq_cells KD-Tree
     # sq_kd_tree=cKDTree(sq_cells_center)
 
-    #Making a flag for the events which dont have any electron
-    count=0
-    event_mask=[]
-    all_labels=None
-
-    #Setting up the filename and compression options of the target tfrecords
-    # label_filename=image_basepath+'label_event_file_%s_start_%s_stride_%s.tfrecords'%(
-    #                                 event_file_no,event_start_no,event_stride)
-    # compression_options=tf.python_io.TFRecordOptions(
-    #                 tf.python_io.TFRecordCompressionType.ZLIB)
-
+    #Flattening the jagged genpart arrays of all the events at once
     events=range(event_start_no,event_start_no+event_stride)
-    firsttime_flag=1
-    for event in events:
-        print '>>> Creating the target label for event: {}'.format(event)
-        #Creating the mask for filtering the particles (on current requirement)
-        electron_id=11
-        positron_id=-11
-        particles_mask=np.logical_or(genpart_df.loc[event,"pid"]==electron_id,
-                                genpart_df.loc[event,"pid"]==positron_id)
-        particles_mask &= (genpart_df.loc[event,"gen"]>=0)
-        particles_mask &= (genpart_df.loc[event,"reachedEE"]>1)
-        particles_mask &= ((genpart_df.loc[event,"energy"]/
-                            np.cosh(genpart_df.loc[event,"eta"]))>5)
-        particles_mask &= (genpart_df.loc[event,"eta"])>0
-
-        #Now filtering the required features for the target label
-        particles_energy=genpart_df.loc[event,"energy"][particles_mask]
-        particles_phi=genpart_df.loc[event,"phi"][particles_mask]
-        particles_eta=genpart_df.loc[event,"eta"][particles_mask]
-        particles_pid=genpart_df.loc[event,"pid"][particles_mask]
-        #Getting the barycenter location form the position array
-        particles_posx=np.array(genpart_df.loc[event,"posx"],
-                            dtype=object)[particles_mask]
-        particles_posy=np.array(genpart_df.loc[event,"posy"],
-                            dtype=object)[particles_mask]
-        particles_posz=np.array(genpart_df.loc[event,"posz"],
-                            dtype=object)[particles_mask]
-
-        #Checking if the electron is filtered and we got just one
-        print particles_pid,'\n'
-        if particles_pid.shape!=(1,): #and particles_pid.shape!=(2,):
-            count+=1
-            print 'Multiple/No Electron Detected!!!'
-            event_mask.append('False') #Dont take this event
-            continue
-        else:
-            event_mask.append('True') #Take this event
-        #assert particles_pid.shape==(1,),"Multiple Electrons are detected"
-
-        #Creating the label vector as its easier to manipulate in numpy
-        #format: [energy,bary_posx,bary_posy,bary_posz,pc1(electron),pc2]
-        #Target Metadata
-        target_len=6
-        label=np.empty((target_len,),dtype=np.float32)
-        barycenter_depth=10 #as recommended by Florian and Arthur Sir
-        #Filling up the target label
-        label[0]=particles_energy[0]
-        label[1]=particles_posx[0][barycenter_depth-1]
-        label[2]=particles_posy[0][barycenter_depth-1]
-        label[3]=particles_posz[0][barycenter_depth-1]
-        if particles_pid[0]==11:
-            label[4]=1      #its electron
-            label[5]=0
-        else:
-            label[4]=0
-            label[5]=1      #it not electon(positron ask Florian Sir)
-
-        #Creating the example protocol to write to tfrecords
-        #Add the event number later for check of the correspondancce
-        #between the events in the label and image
-        # example=tf.train.Example(features=tf.train.Features(
-        #         feature={
-        #             #Saving each features as the named dict with bytes
-        #             'label':_bytes_feature(label.tobytes()),
-        #             #extra label of event for seq access check
-        #             'event':_int64_feature(event)
-        #         }
-        #     )
-        # )
-        # #Adding the example to the record writer
-        # record_writer.write(example.SerializeToString())
-
-        #Now instead of creating the tfrecords we will store
-        #the labels in the array
-        if firsttime_flag==1:
-            all_labels=label
-            firsttime_flag=0
-        else:
-            all_labels=np.vstack((all_labels,label))
-
+    def _flatten_column(name):
+        column=[np.asarray(value).reshape((-1,))
+                    for value in genpart_df.loc[events,name]]
+        if len(column)==0:
+            return np.zeros((0,))
+        return np.concatenate(column)
+
+    particles_per_event=np.array([len(value) for value in
+                            genpart_df.loc[events,'pid']],dtype=np.int64)
+    particles_event_idx=np.repeat(np.arange(event_stride),particles_per_event)
+    particles_energy=_flatten_column('energy')
+    particles_eta=_flatten_column('eta')
+    particles_gen=_flatten_column('gen')
+    particles_pid=_flatten_column('pid')
+    particles_reachedEE=_flatten_column('reachedEE')
+
+    #Creating the mask for filtering the particles (on current requirement)
+    electron_id=11
+    positron_id=-11
+    particles_mask=np.logical_or(particles_pid==electron_id,
+                                particles_pid==positron_id)
+    particles_mask &= (particles_gen>=0)
+    particles_mask &= (particles_reachedEE>1)
+    particles_mask &= ((particles_energy/np.cosh(particles_eta))>5)
+    particles_mask &= (particles_eta>0)
+
+    #Taking only the events with exactly one electron/positron detected
+    electrons_per_event=np.bincount(particles_event_idx[particles_mask],
+                                    minlength=event_stride)
+    event_mask=(electrons_per_event==1)
+    count=event_stride-np.sum(event_mask)
+    #The selected particles (one per selected event and in event order)
+    selected_particles=np.flatnonzero(particles_mask &
+                                        event_mask[particles_event_idx])
+
+    #Creating the label vector as its easier to manipulate in numpy
+    #format: [energy,bary_posx,bary_posy,bary_posz,pc1(electron),pc2]
+    #Target Metadata
+    target_len=6
+    barycenter_depth=10 #as recommended by Florian and Arthur Sir
+    all_labels=np.empty((selected_particles.shape[0],target_len),
+                            dtype=np.float32)
+    all_labels[:,0]=particles_energy[selected_particles]
+    #Getting the barycenter location form the position array of each particle
+    for pos_idx,name in zip([1,2,3],['posx','posy','posz']):
+        flat_pos,pos_length=_flatten_jagged_column(
+                                        genpart_df.loc[events,name])
+        #The position array could be shorter than the barycenter depth
+        #(not reaching it), which would read the next particle's position
+        short_particles=selected_particles[
+                        pos_length[selected_particles]<barycenter_depth]
+        if short_particles.shape[0]!=0:
+            raise ValueError('The %s of the particle of events %s has less '\
+                            'than %s layers for the barycenter'%(name,
+                            str(list(event_start_no+
+                                particles_event_idx[short_particles])),
+                            barycenter_depth))
+        pos_offset=np.cumsum(pos_length)-pos_length
+        all_labels[:,pos_idx]=flat_pos[pos_offset[selected_particles]+
+                                        barycenter_depth-1]
+    #its electron (pc1) or its not electon(positron ask Florian Sir) (pc2)
+    is_electron=(particles_pid[selected_particles]==electron_id)
+    all_labels[:,4]=is_electron
+    all_labels[:,5]=np.logical_not(is_electron)
 
     #Seeing the fraction of events which dont have just one electron
     print 'Total number of events skipped: ',count
@@ -918,6 +1532,9 @@ def merge_image_and_label(event_file_no,event_start_no,event_stride,merge_zside)
         merged_record_filename=image_basepath+\
                     'event_file_%s_start_%s_stride_%s_zside_%s.tfrecords'%(
                         event_file_no,event_start_no,event_stride,zside)
+        #Removing the index of a previous file (written without one here)
+        if os.path.exists(get_record_index_filename(merged_record_filename)):
+            os.remove(get_record_index_filename(merged_record_filename))
 
         with tf.python_io.TFRecordWriter(merged_record_filename,
                             options=compression_options) as record_writer:
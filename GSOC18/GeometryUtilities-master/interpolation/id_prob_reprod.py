@@ -4,7 +4,7 @@ import concurrent.futures,multiprocessing
 ncpu=multiprocessing.cpu_count()
 executor=concurrent.futures.ThreadPoolExecutor(ncpu*4)
 
-from geometry.cmssw import read_geometry
+from geometry.cmssw import read_geometry_cached
 
 import sys
 import datetime
@@ -30,7 +30,7 @@ def readGeometry( input_file,  layer, subdet ):
     '''
     t0 = datetime.datetime.now()
     treename = 'hgcaltriggergeomtester/TreeCells'
-    cells = read_geometry(filename=input_file, treename=treename,
+    cells = read_geometry_cached(filename=input_file, treename=treename,
               subdet=subdet, layer=layer, wafer=-1)
     cells_d = dict([(c.id, c) for c in cells])
     t1 = datetime.datetime.now()
@@ -1,14 +1,18 @@
 #Helper function from this script
 from hexCells_to_squareCell_interpolation import *
+from coef_bundle import CoefBundle,coef_dict_to_csr,get_coef_bundle_path
+from coef_bundle import get_cache_key,derive_coarse_bundle
+from coef_bundle import get_layer_fingerprint
 
 #General Imports
+import os
 import sys
 import datetime
 import cPickle as pickle
 import matplotlib.pyplot as plt
 
 #Geometry File imports
-from geometry.cmssw import read_geometry
+from geometry.cmssw import read_geometry_cached,geometry_file_hash
 input_default_file = '/data_CMS/cms/grasseau/HAhRD/test_triggergeom.root'
 data_default_file = 'detector_data/hgcalNtuple_electrons_15GeV_n100.root'
 
@@ -23,7 +27,8 @@ ncpu=multiprocessing.cpu_count()
 executor=concurrent.futures.ThreadPoolExecutor(ncpu*4)
 
 ############## DRIVER FUNCTION DEFINITION#############
-def generate_interpolation(geometry_fname,edge_length=0.7):
+def generate_interpolation(geometry_fname,edge_length=0.7,
+                            cells_per_chunk=2048,pyramid_factors=[]):
     '''
     AUTHOR: Abhinav Kumar
     DESCRIPTION:
@@ -32,9 +37,18 @@ def generate_interpolation(geometry_fname,edge_length=0.7):
         dependent on functions of hexCell_to_sqyuareCell_interpolation.py
         STEPS:
             1.It calls the linear interpolation function to generate the
-            coefficient of interpolation as dictionary.
-            2.Then it saves the coefficient in form of pickle file in a
-            separate folder in same directory named as 'sq_cells_data'.
+            coefficient of interpolation as dictionary, for chunks of
+            wafers of all the layers in parallel on a process pool.
+            2.Then it saves the coefficient of each layer (once all its
+            chunks are done) in one coefficient bundle (see coef_bundle.py)
+            in a separate folder in same directory named as 'sq_cells_data'.
+            The bundle is a cache keyed by the geometry file contents
+            and the mesh, so only the missing or invalidated layers are
+            computed again. The layers having the same cells as an
+            earlier layer (same fingerprint) are not computed but saved
+            as an alias of that layer.
+            The coarser levels of the mesh pyramid (if any) are then
+            derived from these coefficients (see coef_bundle.py).
             3.It plots the hexagon to square maps for few of sampled
             Hexagon cells.
     USAGE:
@@ -43,6 +57,10 @@ def generate_interpolation(geometry_fname,edge_length=0.7):
             edge_length        : edge length of the square cell, from
                                     which the resolution will be calculated which
                                     fits with the layer bounds.
+            cells_per_chunk    : the number of cells (whole wafers) given
+                                    to a process at a time
+            pyramid_factors    : the factors (eg. [2,4]) of the coarser
+                                    meshes to derive from this one
         OUTPUT:(optional)
             coef_dict_array    : an array of size 52 have the interpolation
                                     coef of each layer in form:
@@ -53,45 +71,183 @@ def generate_interpolation(geometry_fname,edge_length=0.7):
     #Generating the Common Mesh Grid to be used for all the layers
     print '>>> Generating Common Mesh Grid for All Layers'
     t0=datetime.datetime.now()
+    #Hashing the geometry file once (naming its cache and keying the bundle)
+    geometry_hash=geometry_file_hash(geometry_fname)
     #Reading Input Geometry
     subdet,eff_layer=get_subdet(no_layers)
-    hex_cells_dict=readGeometry(geometry_fname,eff_layer,subdet)
+    hex_cells=readGeometry(geometry_fname,eff_layer,subdet,geometry_hash)
     #Generating the Mesh Grid
-    resolution,sq_cells_dict=generate_mesh(hex_cells_dict,edge_length,save_sq_cells=True)
+    resolution,sq_mesh=generate_mesh(hex_cells,edge_length,save_sq_cells=True)
     t1=datetime.datetime.now()
     print 'Generation of Mesh Grid Completed in: ',t1-t0,' time\n'
 
     #Generating the Overlapping Coefficient
     print '>>> Generating Overlapping Coefficient'
 
-    #Starting to make different process for interpolation of different layers
+    #Opening the bundle as cache keyed by the geometry contents and mesh
     talpha=datetime.datetime.now()
-    layers=range(1,no_layers+1)
-    with multiprocessing.Manager() as manager:
-        print '>>> Creating Shared Sq_cells_dict'
-        #Creating a shared dict of square cells among all the process
-        shared_sq_cells_dict=manager.dict(sq_cells_dict)
-
-        #Creating the process
-        print '>>> Starting the multiprocessing with %s process at a time'%(ncpu-2)
-        process_pool=multiprocessing.Pool(processes=ncpu-2)
-        #Now doing Map-Reduce to simultaneously run the processes
-        process_pool.map(partial(interpolate_layer,
-                            geometry_fname,shared_sq_cells_dict,edge_length,
-                            resolution),layers)
+    cache_key=get_cache_key(geometry_hash,edge_length,sq_mesh.origin,
+                            resolution)
+    coef_bundle=CoefBundle(get_coef_bundle_path(resolution,edge_length),
+                            resolution,edge_length,sq_mesh.origin,
+                            cache_key,geometry_hash)
+    #Recomputing only the layers not already (validly) in the cache
+    layers=[layer for layer in range(1,no_layers+1)
+                if not coef_bundle.is_layer_valid(layer)]
+    print '>>> Layers already in the cache: ',no_layers-len(layers)
+    if len(layers)==0:
+        print '>>>>> Nothing to compute, all layers are cached'
+        _derive_pyramid(coef_bundle,pyramid_factors)
+        return
+
+    #The fingerprints of the layers already in the cache, to alias the
+    #layers with same cells to them
+    fingerprint_layer={}
+    for layer in range(1,no_layers+1):
+        if coef_bundle.is_layer_valid(layer) and \
+                coef_bundle.alias_of(layer) is None and \
+                coef_bundle.get_fingerprint(layer) is not None:
+            fingerprint_layer.setdefault(coef_bundle.get_fingerprint(layer),
+                                            layer)
+
+    #Starting to make different process for interpolation of chunks of
+    #wafers of all the layers
+    #The mesh is just a descriptor (origin,edge_length,resolution) so
+    #it is directly passed by value to each process (no shared dict)
+    print '>>> Starting the multiprocessing with %s process at a time'%(ncpu-2)
+    process_pool=multiprocessing.Pool(processes=ncpu-2)
+    #The chunks are generated lazily (reading geometry layer by layer)
+    #while the pool is busy and given one at a time to the free process
+    layer_chunks_left={}
+    layer_fingerprint={}
+    layer_aliases={}
+    layer_coef_dict={layer:{} for layer in layers}
+    chunk_iterator=_generate_wafer_chunks(geometry_fname,layers,
+                                        cells_per_chunk,layer_chunks_left,
+                                        fingerprint_layer,layer_fingerprint,
+                                        layer_aliases)
+    chunk_results=process_pool.imap_unordered(partial(interpolate_wafer_chunk,
+                                        sq_mesh,edge_length),
+                                        chunk_iterator,chunksize=1)
+    for layer,chunk_coef_dict in chunk_results:
+        #Merging the chunk to its layer
+        layer_coef_dict[layer].update(chunk_coef_dict)
+        layer_chunks_left[layer]-=1
+        #Saving the layer in the bundle as soon as all its chunks are done
+        if layer_chunks_left[layer]==0:
+            print 'Done for Layer:%s'%(layer)
+            coef_bundle.add_layer(layer,coef_dict_to_csr(
+                                layer_coef_dict.pop(layer),resolution),
+                                layer_fingerprint[layer])
+    process_pool.close()
+    process_pool.join()
+
+    #Saving the layers without any cell (if any) as empty
+    for layer in layer_coef_dict.keys():
+        if layer in layer_aliases:
+            continue
+        coef_bundle.add_layer(layer,coef_dict_to_csr(
+                                layer_coef_dict.pop(layer),resolution),
+                                layer_fingerprint[layer])
+    #Saving the layers having same cells as aliases (now all saved)
+    for layer in sorted(layer_aliases.keys()):
+        print 'Layer %s saved as alias of Layer %s'%(layer,
+                                                layer_aliases[layer])
+        coef_bundle.add_alias(layer,layer_aliases[layer])
+
+    #Deriving the coarser levels from the finest coefficients
+    _derive_pyramid(coef_bundle,pyramid_factors)
 
     tbeta=datetime.datetime.now()
     print '>>>>> TASK COMPLETED in: ',tbeta-talpha
 
-def interpolate_layer(geometry_fname,sq_cells_dict,edge_length,resolution,layer):
-    #Reading the geometry file
-    subdet,eff_layer=get_subdet(layer)
-    hex_cells_dict=readGeometry(geometry_fname,eff_layer,subdet)
+def _derive_pyramid(coef_bundle,pyramid_factors):
+    '''
+    DESCRIPTION:
+        Derives (or validates the cache of) the coefficient bundles of
+        the coarser levels of the mesh pyramid from the finest bundle.
+        These are not read while making the dataset, where the coarse
+        images are summed from the fine ones (see coarsen_energy_map),
+        but by the jobs interpolating directly on a coarse mesh (giving
+        its resolution and edge length to compute_energy_map).
+    '''
+    for pyramid_factor in pyramid_factors:
+        print '>>> Deriving the mesh coarser by factor: ',pyramid_factor
+        derive_coarse_bundle(coef_bundle,pyramid_factor)
+
+def _generate_wafer_chunks(geometry_fname,layers,cells_per_chunk,
+                            layer_chunks_left,fingerprint_layer,
+                            layer_fingerprint,layer_aliases):
+    '''
+    DESCRIPTION:
+        This generator reads the geometry of the layers one by one and
+        splits the cells of each layer in chunks of whole wafers (modules)
+        having about cells_per_chunk cells, so that the work given to the
+        process pool is of similar size whatever be the size of the layer.
+        The number of chunks of each layer is recorded in layer_chunks_left
+        before its chunks are given out.
+        The layers whose cells have the same fingerprint as an earlier
+        layer are not split but recorded in layer_aliases.
+    USAGE:
+        INPUT:
+            geometry_fname      : geometry root file of the detector
+            layers              : the layers to split
+            cells_per_chunk     : the (minimum) number of cells in a chunk
+            layer_chunks_left   : dict to fill with the chunk count of layers
+            fingerprint_layer   : dict {fingerprint:layer} of the layers
+                                    already computed (updated here)
+            layer_fingerprint   : dict to fill with the fingerprint of layers
+            layer_aliases       : dict to fill with {layer:same_cells_layer}
+        OUTPUT (yields):
+            (layer,hex_cells) of each chunk, as a CellArray
+    '''
+    for layer in layers:
+        subdet,eff_layer=get_subdet(layer)
+        hex_cells=readGeometry(geometry_fname,eff_layer,subdet)
+
+        #Skipping the layer if same cells are already there in other layer
+        fingerprint=get_layer_fingerprint(hex_cells)
+        if fingerprint in fingerprint_layer:
+            layer_aliases[layer]=fingerprint_layer[fingerprint]
+            continue
+        fingerprint_layer[fingerprint]=layer
+        layer_fingerprint[layer]=fingerprint
+
+        #Grouping the cells of the layer wafer by wafer
+        wafer_order=np.argsort(hex_cells.module,kind='mergesort')
+        _,wafer_start,wafer_size=np.unique(hex_cells.module[wafer_order],
+                                        return_index=True,return_counts=True)
+
+        chunks=[]
+        chunk_start=0
+        chunk_size=0
+        for start,size in zip(wafer_start,wafer_size):
+            chunk_size+=size
+            if chunk_size>=cells_per_chunk:
+                chunks.append(hex_cells.select(
+                        wafer_order[chunk_start:start+size]))
+                chunk_start=start+size
+                chunk_size=0
+        if chunk_size>0:
+            chunks.append(hex_cells.select(wafer_order[chunk_start:]))
+        if len(chunks)==0:
+            continue
+
+        layer_chunks_left[layer]=len(chunks)
+        for chunk in chunks:
+            yield layer,chunk
+
+def interpolate_wafer_chunk(sq_mesh,edge_length,layer_chunk):
+    '''
+    DESCRIPTION:
+        Calculates the (unnormalized) overlap coefficient of a chunk of
+        cells of a layer. Runs in the worker process.
+    '''
+    layer,hex_cells=layer_chunk
 
-    #Calculating the sq_coef (unnormalized)
-    sq_coef_dict=linear_interpolate_hex_to_square(hex_cells_dict,
-                                            sq_cells_dict,edge_length)
-    print 'Done for Layer:%s'%(layer)
+    #Calculating the sq_coef (unnormalized) from the vertex arrays
+    sq_coef_dict=linear_interpolate_hex_to_square(hex_cells,
+                                            sq_mesh,edge_length)
 
     #Visual Consistency Check
     # print 'Checking for Consistency:'
@@ -102,21 +258,18 @@ def interpolate_layer(geometry_fname,sq_cells_dict,edge_length,resolution,layer)
     # fhandle.close()
     # plot_hex_to_square_map(sq_coef_dict,hex_cells_dict,sq_cells_dict)
 
-    #Saving the coef_dict_array as a pickle
-    print '>>> Pickling the coef_dict'
-    coef_filename='sq_cells_data/coef_dict_layer_%s_res_%s,%s_len_%s.pkl'%(
-                                layer,resolution[0],resolution[1],edge_length)
-    t0=datetime.datetime.now()
-    fhandle=open(coef_filename,'wb')
-    pickle.dump(sq_coef_dict,fhandle,protocol=pickle.HIGHEST_PROTOCOL)
-    fhandle.close()
-    t1=datetime.datetime.now()
-    print 'Pickling completed in: ',t1-t0,' sec\n'
+    return layer,sq_coef_dict
 
 def generate_training_dataset(event_data_filename,event_file_no,
                             event_start_no,event_stride,
                             no_layers=40,interpolate_zside=[0,1],
-                            resolution=(514,513),edge_length=0.7):
+                            resolution=(514,513),edge_length=0.7,
+                            chunk_size=50,image_format='dense',
+                            roi_shape=None,geometry_fname=None,
+                            pyramid_factors=[],memory_budget=None,
+                            writer_workers=None,dataset_dir=None,
+                            shard_events=None,shard_bytes=None,
+                            valid_fraction=0.0):
     #ONGOING
     '''
     DESCRIPTION:
@@ -124,6 +277,9 @@ def generate_training_dataset(event_data_filename,event_file_no,
         CNN pipeline.This will read the event file and generate the square Grid
         interpolation for each event layer by layer thus creating a 3D image
         per event and finally a 4D dataset for CNN input combining all the event
+        The events of the minibatch are read and interpolated chunk by chunk
+        (of chunk_size events) and written to the same dataset file, so the
+        memory used does not depend on the size of file or minibatch.
     USAGE:
         INPUTS:
             event_data_filename  : the filename of the root file to read event
@@ -132,41 +288,107 @@ def generate_training_dataset(event_data_filename,event_file_no,
             resolution          : the resolution of current interpolation scheme
             edge_length         : the edge length of the current interpolation
                                     scheme
+            chunk_size          : the number of events read and interpolated
+                                    at a time
+            image_format        : 'dense' or 'sparse' format of the images
+                                    in the dataset (see compute_energy_map)
+            roi_shape           : the (height,width) of the region of
+                                    interest to crop the images to (None to
+                                    save full image), at most resolution
+            geometry_fname      : the geometry file for which the
+                                    coefficients should have been made
+                                    (checked before starting if given)
+            pyramid_factors     : the factors (eg. [2,4]) of the coarser
+                                    images also written in separate files
+                                    from the same read of the hits
+            memory_budget       : the bound (in bytes) on the memory of the
+                                    images being interpolated at a time
+                                    (see compute_energy_map)
+            writer_workers      : the number of threads serializing and
+                                    compressing the examples (0 to write
+                                    them in this thread, without pool)
+            dataset_dir         : if given, the images are written in
+                                    shards of balanced size in the train
+                                    and valid directories of one directory
+                                    per zside and pyramid level in
+                                    dataset_dir, listed in its
+                                    manifest.json, instead of one file per
+                                    minibatch in image_data
+                                    (see get_image_shard_writer)
+            shard_events        : the number of examples per shard
+            shard_bytes         : the (compressed) bytes per shard
+            valid_fraction      : the fraction of examples put in the valid
+                                    directory
         OUTPUTS:
 
     '''
-    # #Some of the geometry metadata (will be constant)
-    # no_layers=40
-    # #Specifying the size of minibatch
-    # event_stride='upto_end' #seems optimal in terms of memory use.
-    # event_start_no=0 #for testing now
-
-    #Creating the corresponding label for out image
-    print '>>> Reading the event dataframe for the groundtruth particles'
-    all_event_particles=readDataFile_genpart(event_data_filename,event_start_no,
-                                            event_stride)
     #Setting up the correct value of stride for upto end case
     if event_stride=='upto_end':
-        event_stride=all_event_particles.shape[0]
-
-    t0=datetime.datetime.now()
-    event_mask,all_labels=compute_target_lable(all_event_particles,resolution,edge_length,
-                        event_file_no,event_start_no,event_stride)
-    t1=datetime.datetime.now()
-    print '>>> Label Creation Completed in: ',t1-t0
-
-    #Converting the root file to a data frame
-    print '>>> Reading the event dataframe for the hits'
-    all_event_hits=readDataFile_hits(event_data_filename,event_start_no,
-                                    event_stride)
-
-    t0=datetime.datetime.now()
-    print '>>> Starting to interpolate and create dataset'
-    compute_energy_map(all_event_hits,all_labels,event_mask,
-                        interpolate_zside,resolution,edge_length,
-                        event_file_no,event_start_no,event_stride,no_layers)
-    t1=datetime.datetime.now()
-    print '>>> Image Creation Completed in: ',t1-t0
+        tree=uproot.open(event_data_filename)['ana/hgc']
+        event_stride=tree.numentries-event_start_no
+
+    #Failing before creating any file if the roi does not fit the images
+    if roi_shape is not None:
+        check_roi_shape(roi_shape,resolution)
+
+    #Hashing the geometry to check the coefficients are made for it
+    geometry_hash=None
+    if geometry_fname is not None:
+        geometry_hash=geometry_file_hash(geometry_fname)
+
+    #Opening the dataset files of the whole minibatch, the images waiting
+    #in all of them sharing one part of the memory budget
+    _,pending_budget=split_memory_budget(memory_budget)
+    record_writers={}
+    for zside in interpolate_zside:
+        for pyramid_factor in [1]+list(pyramid_factors):
+            if dataset_dir is None:
+                record_writers[(zside,pyramid_factor)]=get_image_record_writer(
+                                    event_file_no,event_start_no,
+                                    event_stride,zside,pyramid_factor,
+                                    writer_workers,pending_budget)
+                continue
+            image_shape=get_level_image_shape(resolution,no_layers,
+                                        pyramid_factor,roi_shape)
+            record_writers[(zside,pyramid_factor)]=get_image_shard_writer(
+                                    dataset_dir,event_file_no,
+                                    event_start_no,event_stride,zside,
+                                    image_shape,pyramid_factor,
+                                    image_format=image_format,
+                                    shard_events=shard_events,
+                                    shard_bytes=shard_bytes,
+                                    valid_fraction=valid_fraction,
+                                    workers=writer_workers,
+                                    pending_budget=pending_budget)
+
+    #Reading and interpolating the minibatch chunk by chunk
+    chunk_iterator=readDataFile_chunks(event_data_filename,event_start_no,
+                                        event_stride,chunk_size)
+    for chunk_start_no,chunk_stride,all_event_hits,all_event_particles \
+                                                        in chunk_iterator:
+        #Creating the corresponding label for out image
+        t0=datetime.datetime.now()
+        event_mask,all_labels=compute_target_lable(all_event_particles,
+                                resolution,edge_length,event_file_no,
+                                chunk_start_no,chunk_stride)
+        t1=datetime.datetime.now()
+        print '>>> Label Creation Completed in: ',t1-t0
+
+        t0=datetime.datetime.now()
+        print '>>> Starting to interpolate and create dataset'
+        compute_energy_map(all_event_hits,all_labels,event_mask,
+                            interpolate_zside,resolution,edge_length,
+                            event_file_no,chunk_start_no,chunk_stride,
+                            no_layers,record_writers=record_writers,
+                            image_format=image_format,roi_shape=roi_shape,
+                            geometry_hash=geometry_hash,
+                            pyramid_factors=pyramid_factors,
+                            memory_budget=memory_budget)
+        t1=datetime.datetime.now()
+        print '>>> Image Creation Completed in: ',t1-t0
+
+    for record_writer in record_writers.values():
+        record_writer.close()
 
     #Now merging wont be done separately
     #Merging the dataset together as one example protocol
@@ -174,31 +396,35 @@ def generate_training_dataset(event_data_filename,event_file_no,
     # merge_image_and_label(event_file_no,event_start_no,event_stride,merge_zside)
 
 ################ MAIN FUNCTION DEFINITION ###################
-def readGeometry( input_file,  layer, subdet ):
+def readGeometry( input_file,  layer, subdet, geometry_hash=None ):
     '''
     AUTHOR: Grasseau Gilles
     DESCRIPTION:
         This function reads the root file which contain the Geometry
-    of the detector and create a dictionary of "Cell" object assiciated
-    with every hexagonal cell in the detector.
+    of the detector and gives the hexagonal cells of the layer as a
+    CellArray (the arrays of ids, centers and vertices). The shapely
+    polygons are made only if asked (see CellArray), the coefficient
+    generation working directly on the vertex arrays.
     USAGE:
         INPUT:
             input_file  : the name of input geometry file (root file)
             Layer       : which layer's cell we are interested in
             Subdet      : which part of subdetector it is
                             (EE,...)
+            geometry_hash: the hash of the input file if already made
+                            (see geometry_file_hash), to not read it
+                            again to find its cache
         OUTPUT:
-            cells_d     : the hexagonal cell-dictionary with id of
-                          cell as the key and Cell object as value
+            cells       : the CellArray of the hexagonal cells
     '''
     t0 = datetime.datetime.now()
     treename = 'hgcaltriggergeomtester/TreeCells'
-    cells = read_geometry(filename=input_file, treename=treename,
-              subdet=subdet, layer=layer, wafer=-1)
-    cells_d = dict([(c.id, c) for c in cells])
+    cells = read_geometry_cached(filename=input_file, treename=treename,
+              subdet=subdet, layer=layer, wafer=-1,
+              source_hash=geometry_hash)
     t1 = datetime.datetime.now()
     print 'Cells read: number=', len(cells), ', time=', t1-t0
-    return cells_d
+    return cells
 
 def get_subdet(layer):
     '''
@@ -230,6 +456,77 @@ def get_subdet(layer):
                                                             layer,eff_layer)
     return subdet,eff_layer
 
+#Branches to read from the ana/hgc tree for the images and labels
+hits_branches=["rechit_detid","rechit_energy"]
+#Adding the branches for logical Error check (Optional)
+#hits_branches +=["rechit_z","rechit_cluster2d","cluster2d_multicluster"]
+genpart_branches=["genpart_energy","genpart_phi","genpart_eta",
+                "genpart_gen","genpart_pid","genpart_reachedEE",
+                "genpart_posx","genpart_posy","genpart_posz"]
+
+def _get_entry_range(tree,event_start_no,event_stride):
+    '''
+    DESCRIPTION:
+        Gives the (entrystart,entrystop) of the tree for the minibatch,
+        handling the 'upto_end' stride.
+    '''
+    if event_stride=='upto_end':
+        return event_start_no,tree.numentries
+    return event_start_no,min(event_start_no+event_stride,tree.numentries)
+
+def _arrays_to_dataframe(arrays,branches,entrystart,entrystop):
+    '''
+    DESCRIPTION:
+        Converts the (jagged) arrays of a chunk read by uproot to a
+        dataframe with one row per event (indexed by the event number
+        in the file) and the branch prefix removed from the column name.
+        eg: rechit_energy --> energy
+    '''
+    col_names=[name.replace('rechit_','').replace('genpart_','')
+                    for name in branches]
+    columns={col_name:list(arrays[name])
+                    for name,col_name in zip(branches,col_names)}
+    df=pd.DataFrame(columns,index=range(entrystart,entrystop),
+                    columns=col_names)
+    return df
+
+def readDataFile_chunks(filename,event_start_no,event_stride,chunk_size=50):
+    '''
+    DESCRIPTION:
+        This function is a generator which iterates over the events of the
+        minibatch in chunks of fixed size, reading only the branches required
+        for the hits and genpart and only the entries of the minibatch.
+        So the memory used stays the same whatever be the size of the file
+        or of the minibatch.
+    USAGE:
+        INPUT:
+            filename        : the name of root file
+            event_start_no  : the starting event number of the minibatch
+            event_stride    : the size of minibatch (or 'upto_end')
+            chunk_size      : the number of events to read in one chunk
+        OUTPUT (yields):
+            chunk_start_no  : the starting event number of this chunk
+            chunk_stride    : the number of events in this chunk
+            hits_df         : the hits dataframe of the chunk
+                                (same format as readDataFile_hits)
+            genpart_df      : the genpart dataframe of the chunk
+                                (same format as readDataFile_genpart)
+    '''
+    tree=uproot.open(filename)['ana/hgc']
+    entrystart,entrystop=_get_entry_range(tree,event_start_no,event_stride)
+    branches=hits_branches+genpart_branches
+
+    chunk_iterator=tree.iterate(branches,entrysteps=chunk_size,
+                                entrystart=entrystart,entrystop=entrystop,
+                                reportentries=True,executor=executor)
+    for chunk_start,chunk_stop,arrays in chunk_iterator:
+        print '>>> Read the chunk of events: %s to %s'%(chunk_start,chunk_stop)
+        hits_df=_arrays_to_dataframe(arrays,hits_branches,
+                                            chunk_start,chunk_stop)
+        genpart_df=_arrays_to_dataframe(arrays,genpart_branches,
+                                            chunk_start,chunk_stop)
+        yield chunk_start,chunk_stop-chunk_start,hits_df,genpart_df
+
 def readDataFile_hits(filename,event_start_no,event_stride):
     '''
     DESCRIPTION:
@@ -246,8 +543,6 @@ def readDataFile_hits(filename,event_start_no,event_stride):
             event_stride    : the size of minibatch to process in one go,
                                 (the time cost taken is less than the memory
                                 on increasing the value)
-            query_string: this will be used to filter out the events like
-                            selecting the hits in EE part with certain energy etc.
         OUTPUT:
             df          : the pandas dataframe of the data in root file
                             with only the recorded hits to convert to image
@@ -255,34 +550,15 @@ def readDataFile_hits(filename,event_start_no,event_stride):
     '''
     print '>>> Reading the root File to get hits dataframe'
     tree=uproot.open(filename)['ana/hgc']
-    branches=[]
-    #Just extracting the required attributes to create image
-    branches += ["rechit_detid","rechit_energy"]
-    #Adding the branches for logical Error check (Optional)
-    #branches +=["rechit_z","rechit_cluster2d","cluster2d_multicluster"]
-    #branches +=["rechit_cluster2d","cluster2d_multicluster"]
-
-    cache={}
-    df=tree.pandas.df(branches,cache=cache,executor=executor)
+    entrystart,entrystop=_get_entry_range(tree,event_start_no,event_stride)
 
-    #Renaming the attribute in short form
-    col_names={name:name.replace('rechit_','') for name in branches}
-    df.rename(col_names,inplace=True,axis=1)
-
-    #Extracting out the minibatch of event to process at a time
-    if event_stride=='upto_end':
-        df=df.iloc[event_start_no:]
-    else:
-        df=df.iloc[event_start_no:event_start_no+event_stride]
-
-    #Do the Filtering here only no need to do it each time for each event
+    #Reading only the required branches of the events of the minibatch
+    arrays=tree.arrays(hits_branches,entrystart=entrystart,
+                        entrystop=entrystop,executor=executor)
+    df=_arrays_to_dataframe(arrays,hits_branches,entrystart,entrystop)
 
     #Printing for sanity check
-    #print df.head()
     print 'Shape of dataframe: ',df.shape
-    # print all_event_hits.loc[0,'energy']
-    # print type(all_event_hits.loc[0,'energy'])
-    # print all_event_hits.loc[0,'energy'].shape
 
     return df
 
@@ -312,28 +588,14 @@ def readDataFile_genpart(filename,event_start_no,event_stride):
     #Reading the root file to a dataframe
     print '>>> Reading the rootfile to get genpart dataframe'
     tree=uproot.open(filename)['ana/hgc']
+    entrystart,entrystop=_get_entry_range(tree,event_start_no,event_stride)
 
-    branches =["genpart_energy","genpart_phi","genpart_eta",
-                "genpart_gen","genpart_pid","genpart_reachedEE",
-                "genpart_posx","genpart_posy","genpart_posz"]
-    cache={}
-    df=tree.pandas.df(branches,cache=cache,executor=executor)
-
-    #Renaming the attributes in short form
-    col_names={name:name.replace('genpart_','') for name in branches}
-    df.rename(col_names,inplace=True,axis=1)
-
-    #Extracting the dataframe for the required events
-    if event_stride=='upto_end':
-        df=df.iloc[event_start_no:]
-    else:
-        df=df.iloc[event_start_no:event_start_no+event_stride]
+    #Reading only the required branches of the events of the minibatch
+    arrays=tree.arrays(genpart_branches,entrystart=entrystart,
+                        entrystop=entrystop,executor=executor)
+    df=_arrays_to_dataframe(arrays,genpart_branches,entrystart,entrystop)
 
     print '>>> Extraction completed with current shape: ',df.shape
-    # print df.dtypes
-    # print type(df.loc[0,'posx'])
-    # print df.loc[0,'posx']
-    # sys.exit(1)
 
     return df
 
@@ -354,6 +616,9 @@ if __name__=='__main__':
                 help='Input geometry file', default=input_default_file)
     parser.add_option('--edge_length', dest='edge_length',
                 help='edge_length of square', type='int', default=0.7)
+    parser.add_option('--pyramid_factors',dest='pyramid_factors',
+                help='factors of the coarser meshes/images eg. 2,4',
+                default=None)
 
     #Arguments for the Dataset Creation
     parser.add_option('--data_file_no',dest='data_file_no',
@@ -364,6 +629,36 @@ if __name__=='__main__':
                 help='from where to start interpolation')
     parser.add_option('--event_stride',dest='event_stride',
                 help='the number of events to process at a time')
+    parser.add_option('--chunk_size',dest='chunk_size',
+                help='the number of events to read at a time from the file',
+                type='int',default=50)
+    parser.add_option('--image_format',dest='image_format',
+                help='dense or sparse format of the images in dataset',
+                default='dense')
+    parser.add_option('--roi_shape',dest='roi_shape',
+                help='height,width of the region of interest to crop image',
+                default=None)
+    parser.add_option('--zside',dest='zside',
+                help='the zside to make the images of eg. 0 or 0,1',
+                default='0')
+    parser.add_option('--memory_budget',dest='memory_budget',
+                help='the memory (in MB) of the images made at a time',
+                type='int',default=None)
+    parser.add_option('--writer_workers',dest='writer_workers',
+                help='the threads compressing the images (0 for no pool)',
+                type='int',default=None)
+    parser.add_option('--dataset_dir',dest='dataset_dir',
+                help='directory to write the images in train/valid shards',
+                default=None)
+    parser.add_option('--shard_events',dest='shard_events',
+                help='the number of images per shard',
+                type='int',default=None)
+    parser.add_option('--shard_bytes',dest='shard_bytes',
+                help='the size (in MB) of the shards',
+                type='int',default=None)
+    parser.add_option('--valid_fraction',dest='valid_fraction',
+                help='the fraction of images put in the valid shards',
+                type='float',default=0.0)
     (opt, args) = parser.parse_args()
 
     #Checking if the required options are given or not
@@ -376,17 +671,61 @@ if __name__=='__main__':
         print 'Error: Missing input data file name'
         sys.exit(1)
 
+    pyramid_factors=[]
+    if opt.pyramid_factors!=None:
+        pyramid_factors=[int(factor)
+                            for factor in opt.pyramid_factors.split(',')]
+
     #Calling the driver function
-    if opt.mode=='coef_gen'
-        generate_interpolation(opt.input_file,opt.edge_length)
+    if opt.mode=='coef_gen':
+        generate_interpolation(opt.input_file,opt.edge_length,
+                                pyramid_factors=pyramid_factors)
         sys.exit(0)
 
     #Generating the image and label dataset (combined)
     no_layers=40
+    resolution=(514,513)
     try:
         event_stride=int(opt.event_stride)
     except:
         event_stride=opt.event_stride
+    #Checking the coefficients against the geometry (if available here)
+    geometry_fname=opt.input_file
+    if not os.path.exists(geometry_fname):
+        print 'Warning: geometry file not found, skipping the geometry check'
+        geometry_fname=None
+    roi_shape=None
+    if opt.roi_shape!=None:
+        roi_shape=tuple(int(size) for size in opt.roi_shape.split(','))
+        try:
+            check_roi_shape(roi_shape,resolution)
+        except ValueError as error:
+            parser.print_help()
+            print 'Error: ',error
+            sys.exit(1)
+    memory_budget=None
+    if opt.memory_budget!=None:
+        memory_budget=opt.memory_budget*1024*1024
+    shard_bytes=None
+    if opt.shard_bytes!=None:
+        shard_bytes=opt.shard_bytes*1024*1024
+    if opt.dataset_dir!=None and opt.shard_events==None and shard_bytes==None:
+        parser.print_help()
+        print 'Error: Missing the shard_events or shard_bytes of the shards'
+        sys.exit(1)
     generate_training_dataset(opt.data_file,opt.data_file_no,
                                 int(opt.event_start_no),event_stride,
-                                no_layers,interpolate_zside=[0,])
+                                no_layers,interpolate_zside=[int(zside)
+                                        for zside in opt.zside.split(',')],
+                                resolution=resolution,
+                                chunk_size=opt.chunk_size,
+                                image_format=opt.image_format,
+                                roi_shape=roi_shape,
+                                geometry_fname=geometry_fname,
+                                pyramid_factors=pyramid_factors,
+                                memory_budget=memory_budget,
+                                writer_workers=opt.writer_workers,
+                                dataset_dir=opt.dataset_dir,
+                                shard_events=opt.shard_events,
+                                shard_bytes=shard_bytes,
+                                valid_fraction=opt.valid_fraction)
@@ -3,7 +3,7 @@
 import datetime
 import cPickle as pickle
 from geometry.zoltan_split import module_grid
-from geometry.cmssw import read_geometry
+from geometry.cmssw import read_geometry_cached
 from geometry.mapper import map_cells
 import numpy as np
 import matplotlib.pyplot as plt
@@ -35,7 +35,7 @@ Read the 'cells' of the HGCAL geometry (old release)
 def readGeometry( input_file,  layer, subdet ):
     t0 = datetime.datetime.now()
     treename = 'hgcaltriggergeomtester/TreeCells'
-    cells = read_geometry(filename=input_file, treename=treename, 
+    cells = read_geometry_cached(filename=input_file, treename=treename, 
               subdet=subdet, layer=layer, wafer=-1)
     cells_d = dict([(c.id, c) for c in cells])
     t1 = datetime.datetime.now()
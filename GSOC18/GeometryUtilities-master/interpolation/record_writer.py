@@ -0,0 +1,708 @@
+##########################IMPORTS########################
+#For file IO/data Handling
+import os
+import json
+import fcntl
+import struct
+import zlib
+import threading
+import Queue
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+#Linear Algebra library
+import numpy as np
+
+
+#################Global Variables#######################
+#Number of threads compressing the records by default
+record_writer_workers=cpu_count()
+
+'''
+FILE FORMAT:
+    A TFRecord file is the sequence of the framed records:
+        length              : uint64 (little endian) length of the record
+        masked_crc(length)  : uint32 masked crc32c of the 8 length bytes
+        data                : the record (a serialized tf.train.Example)
+        masked_crc(data)    : uint32 masked crc32c of the data
+    and a ZLIB compressed TFRecord file is this whole sequence compressed
+    in one zlib stream.
+
+PARALLEL COMPRESSION:
+    Each record is framed and compressed independently by a thread of the
+    pool as a raw deflate chunk ending on a byte boundary (Z_SYNC_FLUSH).
+    These chunks put one after the other, between the zlib header and the
+    final (empty) deflate block with the adler32 of all the framed records,
+    make one valid zlib stream (as done by pigz), readable as any ZLIB
+    TFRecord file by tf.python_io.tf_record_iterator or TFRecordDataset.
+    zlib and the numpy crc32c below (with no python loop over the bytes,
+    whatever the size of the record) release the GIL on the data so the
+    compression runs in parallel, while the records are written to the
+    file in the order they were given by a single thread.
+
+RECORD INDEX:
+    Since each chunk is compressed independently (no back reference to
+    the previous records), a record can be read by inflating only its
+    chunk. The offset and length of the chunk (of the framed record if
+    not compressed) of each record in the file are saved along with its
+    event number in the sidecar <filename>.index (see save_record_index),
+    read by Visualization_Module.visualization_io to go to an event
+    directly. The files written before (as a single deflate stream) are
+    indexed by rewriting them once in this layout (see build_record_index).
+'''
+
+#################Function Definition####################
+def _get_crc32c_tables():
+    '''
+    DESCRIPTION:
+        Makes the lookup tables of the (reflected) crc32c used by TFRecord
+        for one byte and for two bytes at a time.
+    '''
+    byte_table=np.arange(256,dtype=np.uint32)
+    for bit in range(8):
+        byte_table=np.where(byte_table&1,(byte_table>>1)^0x82F63B78,
+                            byte_table>>1).astype(np.uint32)
+    word_table=np.arange(65536,dtype=np.uint32)
+    for byte in range(2):
+        word_table=byte_table[word_table&0xFF]^(word_table>>8)
+
+    return byte_table,word_table
+
+_crc32c_byte_table,_crc32c_word_table=_get_crc32c_tables()
+#The largest size (in bytes) of the blocks of the data processed in
+#parallel (smaller for short data, to still have about 16 blocks). Small
+#blocks keep the loop over the words of a block short, the many blocks
+#being combined in log2(blocks) vectorized steps.
+_crc32c_block=32
+
+def _gf2_matrix_times(matrix,vector):
+    '''
+    DESCRIPTION:
+        Product of a 32x32 matrix over GF(2) (list of 32 columns) with
+        the vector (32 bits integer)
+    '''
+    result=0
+    column=0
+    while vector:
+        if vector&1:
+            result^=matrix[column]
+        vector>>=1
+        column+=1
+
+    return result
+
+def _get_zeros_operator(no_bytes):
+    '''
+    DESCRIPTION:
+        Gives the crc32c register after feeding no_bytes zero bytes as a
+        function of the register before, as the 4 tables of the
+        contribution of each byte of the register (it is linear).
+        (same as the crc32_combine of zlib)
+    '''
+    #The operator for one zero bit, then squared to 8 bits
+    operator=[0x82F63B78]+[1<<bit for bit in range(31)]
+    for square in range(3):
+        operator=[_gf2_matrix_times(operator,column) for column in operator]
+    result=[1<<bit for bit in range(32)]
+    while no_bytes:
+        if no_bytes&1:
+            result=[_gf2_matrix_times(operator,column) for column in result]
+        no_bytes>>=1
+        operator=[_gf2_matrix_times(operator,column) for column in operator]
+
+    tables=np.zeros((4,256),dtype=np.uint32)
+    for byte in range(4):
+        for value in range(256):
+            tables[byte,value]=_gf2_matrix_times(result,value<<(8*byte))
+
+    return tables
+
+_zeros_operators={}
+def _feed_zeros(register,no_bytes):
+    '''
+    DESCRIPTION:
+        Feeds no_bytes zero bytes to the (array of) crc32c registers, one
+        power of two of no_bytes at a time (so only the operators of the
+        powers of two are kept, whatever the lengths of the data)
+    '''
+    power=1
+    while no_bytes:
+        if no_bytes&1:
+            if power not in _zeros_operators:
+                _zeros_operators[power]=_get_zeros_operator(power)
+            tables=_zeros_operators[power]
+            register=(tables[0][register&0xFF]^
+                        tables[1][(register>>8)&0xFF]^
+                        tables[2][(register>>16)&0xFF]^
+                        tables[3][register>>24])
+        no_bytes>>=1
+        power<<=1
+
+    return register
+
+def crc32c(data):
+    '''
+    DESCRIPTION:
+        Computes the crc32c (Castagnoli) checksum of the data vectorially.
+        The data is split in blocks (of _crc32c_block bytes, or less for
+        short data) whose crc (starting from a zero register) are computed
+        all together two bytes at a time, skipping the blocks full of
+        zeros whose crc is zero, and are then combined pairwise (shifting
+        the first one by the length of the second one).
+    USAGE:
+        INPUT:
+            data    : the bytes (str) to checksum
+        OUTPUT:
+            crc     : the crc32c as an integer
+    '''
+    data=np.frombuffer(data,dtype=np.uint8)
+    #The block size, a power of two from 8 bytes upto _crc32c_block
+    block_size=8
+    while block_size<_crc32c_block and 16*block_size<data.shape[0]:
+        block_size*=2
+
+    #Padding the front with zeros (not changing a zero register)
+    no_blocks=max(1,-(-data.shape[0]//block_size))
+    padded=np.zeros((no_blocks*block_size,),dtype=np.uint8)
+    padded[padded.shape[0]-data.shape[0]:]=data
+    blocks=padded.reshape((no_blocks,block_size))
+
+    #Computing the crc of the non zero blocks two bytes at a time
+    block_crc=np.zeros((no_blocks,),dtype=np.uint32)
+    nonzero=np.flatnonzero(np.any(blocks.view(np.uint64),axis=1))
+    words=blocks[nonzero].view('<u2').T.astype(np.uint32)
+    register=np.zeros((nonzero.shape[0],),dtype=np.uint32)
+    index=np.empty_like(register)
+    for word in words:
+        np.bitwise_xor(register,word,out=index)
+        np.bitwise_and(index,0xFFFF,out=index)
+        np.right_shift(register,16,out=register)
+        np.bitwise_xor(register,np.take(_crc32c_word_table,index),
+                        out=register)
+    block_crc[nonzero]=register
+
+    #Combining the blocks pairwise
+    while block_crc.shape[0]>1:
+        if block_crc.shape[0]%2:
+            block_crc=np.concatenate([np.zeros((1,),dtype=np.uint32),
+                                        block_crc])
+        block_crc=_feed_zeros(block_crc[0::2],block_size)^block_crc[1::2]
+        block_size*=2
+
+    #Adding the contribution of the initial register
+    initial=_feed_zeros(np.array([0xFFFFFFFF],dtype=np.uint32),
+                        data.shape[0])
+    return int(block_crc[0]^initial[0])^0xFFFFFFFF
+
+def _masked_crc32c(data):
+    '''
+    DESCRIPTION:
+        The masked crc32c of TFRecord
+    '''
+    crc=crc32c(data)
+    return (((crc>>15)|(crc<<17))+0xa282ead8)&0xFFFFFFFF
+
+def frame_record(record):
+    '''
+    DESCRIPTION:
+        Gives the bytes of the record as written in a TFRecord file
+    '''
+    length=struct.pack('<Q',len(record))
+    return length+struct.pack('<I',_masked_crc32c(length))+record+\
+                struct.pack('<I',_masked_crc32c(record))
+
+def _adler32_combine(adler1,adler2,length2):
+    '''
+    DESCRIPTION:
+        Gives the adler32 of the concatenation of two data from their
+        adler32 and the length of the second one (adler32_combine of zlib)
+    '''
+    base=65521
+    remainder=length2%base
+    sum1=adler1&0xFFFF
+    sum2=(remainder*sum1)%base
+    sum1+=(adler2&0xFFFF)+base-1
+    sum2+=((adler1>>16)&0xFFFF)+((adler2>>16)&0xFFFF)+base-remainder
+    if sum1>=base:
+        sum1-=base
+    if sum1>=base:
+        sum1-=base
+    if sum2>=(base<<1):
+        sum2-=(base<<1)
+    if sum2>=base:
+        sum2-=base
+
+    return sum1|(sum2<<16)
+
+def _compress_record(compression_level,function,args):
+    '''
+    DESCRIPTION:
+        Makes the record (function(*args) if function is given), frames
+        it and compresses it as one raw deflate chunk (if compression_level
+        is not None). Run by the threads of the pool.
+    '''
+    record=function(*args) if function is not None else args[0]
+    framed_record=frame_record(record)
+    if compression_level is None:
+        return framed_record,None,len(framed_record)
+    compressor=zlib.compressobj(compression_level,zlib.DEFLATED,
+                                -zlib.MAX_WBITS)
+    chunk=compressor.compress(framed_record)+\
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    return chunk,zlib.adler32(framed_record)&0xFFFFFFFF,len(framed_record)
+
+class _RecordFile(object):
+    '''
+    DESCRIPTION:
+        One (ZLIB compressed if compression_level is not None) TFRecord
+        file being written from the chunks made by _compress_record.
+    '''
+    def __init__(self,filename,compression_level,index=True):
+        self.filename=filename
+        self.compression_level=compression_level
+        self.events=0
+        self.bytes=0
+        self._adler=1
+        #(offset,length,event) of the records if indexed
+        self._index=[] if index else None
+        #The index of a previous file of this name no longer matches
+        index_filename=get_record_index_filename(filename)
+        if os.path.exists(index_filename):
+            os.remove(index_filename)
+        self._file=open(filename,'wb')
+        if compression_level is not None:
+            #zlib header (deflate, 32K window)
+            self._write(struct.pack('>H',0x789c))
+
+    def _write(self,data):
+        self._file.write(data)
+        self.bytes+=len(data)
+
+    def write_chunk(self,chunk,adler,length,event=None):
+        if self._index is not None:
+            self._index.append((self.bytes,len(chunk),
+                                self.events if event is None else event))
+        self._write(chunk)
+        if adler is not None:
+            self._adler=_adler32_combine(self._adler,adler,length)
+        self.events+=1
+
+    def close(self):
+        if self.compression_level is not None:
+            #final empty deflate block and the adler32 of the whole data
+            self._write(zlib.compressobj(self.compression_level,
+                                zlib.DEFLATED,-zlib.MAX_WBITS).flush())
+            self._write(struct.pack('>I',self._adler))
+        self._file.close()
+        if self._index is not None:
+            save_record_index(self.filename,self._index,
+                    'ZLIB' if self.compression_level is not None else None)
+
+class PendingBudget(object):
+    '''
+    DESCRIPTION:
+        Bounds the bytes held by the records waiting in the
+        ParallelRecordWriter (eg. the copies of the images given to submit)
+        from their submission until they are written. One budget can be
+        shared by several writers so that their pending records together
+        stay within it. A record larger than the whole budget is let in
+        once all the others are written.
+    '''
+    def __init__(self,max_bytes):
+        self.max_bytes=max(1,int(max_bytes))
+        self._used=0
+        self._condition=threading.Condition()
+
+    def acquire(self,size):
+        '''
+        DESCRIPTION:
+            Waits until size bytes fit in the budget and takes them,
+            returning the bytes taken (to be given back to release)
+        '''
+        size=min(int(size),self.max_bytes)
+        with self._condition:
+            while self._used+size>self.max_bytes:
+                self._condition.wait()
+            self._used+=size
+        return size
+
+    def release(self,size):
+        with self._condition:
+            self._used-=size
+            self._condition.notify_all()
+
+class ParallelRecordWriter(object):
+    '''
+    DESCRIPTION:
+        Writes a (ZLIB compressed by default) TFRecord file, the records
+        being made, framed and compressed by a pool of threads and written
+        in order by one writer thread (see PARALLEL COMPRESSION).
+        Same usage as tf.python_io.TFRecordWriter (write, close) plus
+        submit to make the record itself in the pool.
+        With workers=0 there is no pool: the records are made, compressed
+        and written by the thread calling write/submit.
+        At most max_pending records (2 per worker by default) are waiting
+        to be written at a time, bounding the memory used. Their bytes
+        (the size given to submit) are also bounded by the pending_budget
+        (a PendingBudget) if given, which can be shared by many writers.
+        The index of the records is written with the file if index is set
+        (see RECORD INDEX), with the event number given to write/submit
+        (the position of the record in the file by default).
+    '''
+    def __init__(self,filename,compression='ZLIB',workers=None,
+                    max_pending=None,
+                    compression_level=zlib.Z_DEFAULT_COMPRESSION,
+                    index=True,pending_budget=None):
+        if workers is None:
+            workers=record_writer_workers
+        if max_pending is None:
+            max_pending=2*max(1,workers)
+        if compression not in ('ZLIB',None):
+            raise ValueError('Unknown compression: %s'%(compression))
+        self.filename=filename
+        self.compression=compression
+        self.compression_level=compression_level \
+                                    if compression=='ZLIB' else None
+        self.index=index
+        self.pending_budget=pending_budget
+        self._open_files()
+        self._error=None
+        self._pool=None
+        if workers>0:
+            self._pool=ThreadPool(workers)
+            self._pending=Queue.Queue(max_pending)
+            self._writer_thread=threading.Thread(target=self._write_pending)
+            self._writer_thread.daemon=True
+            self._writer_thread.start()
+
+    def _write_pending(self):
+        '''
+        DESCRIPTION:
+            Writes the compressed records in the order they were given
+        '''
+        while True:
+            pending_record=self._pending.get()
+            if pending_record is None:
+                return
+            pending_result,event,pending_bytes=pending_record
+            try:
+                chunk,adler,length=pending_result.get()
+                if self._error is None:
+                    self._write_chunk(chunk,adler,length,event)
+            except Exception as error:
+                self._error=error
+            if pending_bytes>0:
+                self.pending_budget.release(pending_bytes)
+
+    def _open_files(self):
+        self._record_file=_RecordFile(self.filename,self.compression_level,
+                                        self.index)
+
+    def _write_chunk(self,chunk,adler,length,event):
+        self._record_file.write_chunk(chunk,adler,length,event)
+
+    def _close_files(self):
+        self._record_file.close()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self,function,*args,**kwargs):
+        '''
+        DESCRIPTION:
+            Adds the record function(*args) to the file, the function
+            being run in the pool (it should not depend on arrays which
+            are modified afterwards). The event number of the record in
+            the index can be given as event keyword, and the bytes held by
+            the args until the record is written as size keyword (waiting
+            for them to fit in the pending_budget).
+        '''
+        event=kwargs.pop('event',None)
+        size=kwargs.pop('size',0)
+        if len(kwargs)!=0:
+            raise TypeError('Unexpected arguments: %s'%(kwargs.keys()))
+        self._check_error()
+        if self._pool is None:
+            #Writing the record right away in this thread
+            try:
+                chunk,adler,length=_compress_record(self.compression_level,
+                                                    function,args)
+                self._write_chunk(chunk,adler,length,event)
+            except Exception as error:
+                self._error=error
+                raise
+            return
+        pending_bytes=0
+        if self.pending_budget is not None and size>0:
+            pending_bytes=self.pending_budget.acquire(size)
+        self._pending.put((self._pool.apply_async(_compress_record,
+                            (self.compression_level,function,args)),event,
+                            pending_bytes))
+
+    def write(self,record,event=None):
+        '''
+        DESCRIPTION:
+            Adds the record (bytes) to the file
+        '''
+        self.submit(None,record,event=event)
+
+    def close(self):
+        '''
+        DESCRIPTION:
+            Writes all the pending records and closes the file
+        '''
+        if self._pool is not None:
+            self._pending.put(None)
+            self._writer_thread.join()
+            self._pool.close()
+            self._pool.join()
+        self._close_files()
+        self._check_error()
+
+class ShardedRecordWriter(ParallelRecordWriter):
+    '''
+    DESCRIPTION:
+        Writes the records as a ParallelRecordWriter but in shards of
+        balanced size:
+            <dataset_dir>/<split>/<prefix>_shard_<number>.tfrecords
+        A new shard is started once the current one has shard_events
+        records or would go beyond shard_bytes (compressed) bytes with
+        the next record, so only the last shard of a split is smaller.
+        A valid_fraction of the records (evenly spread, in order) goes to
+        the 'valid' split and the rest to the 'train' split.
+        The shards are added on close to the manifest of the dataset
+        directory (see update_shard_manifest) with the given image_shape,
+        image_dtype and image_format of their examples.
+        The shards are made by the thread writing the records in order, so
+        the split and shard of a record only depend on the order of the
+        records.
+    '''
+    def __init__(self,dataset_dir,prefix,shard_events=None,
+                    shard_bytes=None,valid_fraction=0.0,image_shape=None,
+                    image_dtype=np.float32,image_format='dense',
+                    compression='ZLIB',workers=None,max_pending=None,
+                    index=True,pending_budget=None):
+        if shard_events is None and shard_bytes is None:
+            raise ValueError('Give the shard_events or shard_bytes target')
+        self.dataset_dir=dataset_dir
+        self.prefix=prefix
+        self.shard_events=shard_events
+        self.shard_bytes=shard_bytes
+        self.valid_fraction=valid_fraction
+        if not os.path.exists(dataset_dir):
+            os.makedirs(dataset_dir)
+        self.shard_info={'image_shape':None if image_shape is None
+                                            else list(image_shape),
+                        'dtype':np.dtype(image_dtype).name,
+                        'image_format':image_format,
+                        'compression':compression}
+        ParallelRecordWriter.__init__(self,None,compression,workers,
+                                        max_pending,index=index,
+                                        pending_budget=pending_budget)
+
+    def _open_files(self):
+        #The shards are opened when their first record comes
+        self._record_no=0
+        self._shard_files={}
+        self._shard_no={'train':0,'valid':0}
+        self.shards=[]
+
+    def _get_split(self):
+        #Putting the record in valid when the valid count goes up
+        valid_before=int(self._record_no*self.valid_fraction)
+        valid_after=int((self._record_no+1)*self.valid_fraction)
+        self._record_no+=1
+        return 'valid' if valid_after>valid_before else 'train'
+
+    def _close_shard(self,split):
+        shard_file=self._shard_files.pop(split)
+        shard_file.close()
+        self.shards.append((os.path.relpath(shard_file.filename,
+                                            self.dataset_dir),
+                            shard_file.events,shard_file.bytes))
+
+    def _write_chunk(self,chunk,adler,length,event):
+        split=self._get_split()
+        shard_file=self._shard_files.get(split)
+        #Starting the next shard when the current one is full
+        if shard_file is not None and (
+                (self.shard_events is not None and
+                    shard_file.events>=self.shard_events) or
+                (self.shard_bytes is not None and
+                    shard_file.bytes+len(chunk)>self.shard_bytes)):
+            self._close_shard(split)
+            shard_file=None
+        if shard_file is None:
+            split_dir=os.path.join(self.dataset_dir,split)
+            if not os.path.exists(split_dir):
+                try:
+                    os.makedirs(split_dir)
+                except OSError:
+                    #made by another process in the meantime
+                    pass
+            shard_file=_RecordFile(os.path.join(split_dir,
+                                '%s_shard_%05d.tfrecords'%(self.prefix,
+                                                self._shard_no[split])),
+                                self.compression_level,self.index)
+            self._shard_no[split]+=1
+            self._shard_files[split]=shard_file
+        shard_file.write_chunk(chunk,adler,length,event)
+
+    def _close_files(self):
+        for split in sorted(self._shard_files.keys()):
+            self._close_shard(split)
+        if self._error is not None:
+            return
+        shards={}
+        for filename,events,no_bytes in self.shards:
+            shards[filename]=dict(self.shard_info,events=events,
+                                    bytes=no_bytes)
+        update_shard_manifest(self.dataset_dir,shards)
+
+def update_shard_manifest(dataset_dir,shards):
+    '''
+    DESCRIPTION:
+        Adds the shards to the manifest.json of the dataset directory
+        (replacing the ones with same name), under a file lock so the
+        minibatches can be made by separate processes.
+    USAGE:
+        INPUT:
+            dataset_dir : the directory of the dataset
+            shards      : dict {shard filename (relative to dataset_dir):
+                            {'events','bytes','image_shape','dtype',
+                            'image_format','compression'}}
+        OUTPUT:
+            manifest    : the updated manifest
+                            {'shards':{filename:shard info}}
+    '''
+    manifest_filename=os.path.join(dataset_dir,'manifest.json')
+    with open(manifest_filename+'.lock','a') as lock_file:
+        fcntl.flock(lock_file,fcntl.LOCK_EX)
+        manifest={'shards':{}}
+        if os.path.exists(manifest_filename):
+            with open(manifest_filename,'r') as manifest_file:
+                manifest=json.load(manifest_file)
+        manifest['shards'].update(shards)
+        #Replacing the manifest at once (never seen half written)
+        with open(manifest_filename+'.tmp','w') as manifest_file:
+            json.dump(manifest,manifest_file,indent=1,sort_keys=True)
+        os.rename(manifest_filename+'.tmp',manifest_filename)
+
+    return manifest
+
+def get_record_index_filename(filename):
+    '''
+    DESCRIPTION:
+        The sidecar index file of a TFRecord file
+    '''
+    return filename+'.index'
+
+def save_record_index(filename,index,compression):
+    '''
+    DESCRIPTION:
+        Saves the index of the records of the file as the (uncompressed)
+        npz arrays offset, length and event (one entry per record in the
+        order of the file) and the compression of the file.
+    USAGE:
+        INPUT:
+            filename    : the TFRecord file indexed
+            index       : list of (offset,length,event) of the records
+            compression : 'ZLIB' (the chunks being independent raw deflate
+                            streams) or None (the framed records)
+    '''
+    index=np.array(index,dtype=np.int64).reshape((-1,3))
+    with open(get_record_index_filename(filename),'wb') as index_file:
+        np.savez(index_file,offset=index[:,0],length=index[:,1],
+                    event=index[:,2],
+                    compression=np.array(compression or 'NONE'))
+
+def _iter_framed_records(record_file,compression,read_size=1<<22):
+    '''
+    DESCRIPTION:
+        Iterates over the (offset,length,record) of the framed records of
+        an uncompressed TFRecord file, or over the records of a ZLIB one
+        (offset and length being then in the decompressed data).
+    '''
+    decompressor=zlib.decompressobj() if compression=='ZLIB' else None
+    data=''
+    offset=0
+    while True:
+        block=record_file.read(read_size)
+        if decompressor is not None:
+            block=decompressor.decompress(block) if len(block)!=0 \
+                                            else decompressor.flush()
+        if len(block)==0 and len(data)==0:
+            return
+        if len(block)==0:
+            raise IOError('Truncated record at byte %s'%(offset))
+        data=data+block
+        #Cutting all the complete records of the data
+        start=0
+        while len(data)-start>=12:
+            length=struct.unpack('<Q',data[start:start+8])[0]
+            if len(data)-start<length+16:
+                break
+            yield offset,length+16,data[start+12:start+12+length]
+            offset+=length+16
+            start+=length+16
+        data=data[start:]
+
+def build_record_index(filename,compression='ZLIB',workers=None):
+    '''
+    DESCRIPTION:
+        Makes the index of a TFRecord file written without one by scanning
+        it once, the event number of the records being their position in
+        the file. A ZLIB file is rewritten (same records, still readable
+        by TFRecordDataset) with the independent chunks of
+        ParallelRecordWriter since a single deflate stream cannot be read
+        from the middle.
+    USAGE:
+        INPUT:
+            filename    : the TFRecord file to index
+            compression : the compression of the file ('ZLIB' or None)
+            workers     : the threads recompressing a ZLIB file
+        OUTPUT:
+            no_records  : the number of records indexed
+    '''
+    if compression is None:
+        with open(filename,'rb') as record_file:
+            index=[(offset,length,event) for event,(offset,length,_) in
+                    enumerate(_iter_framed_records(record_file,None))]
+        save_record_index(filename,index,None)
+        return len(index)
+
+    #Rewriting the file next to it, replacing it once complete
+    indexed_filename=filename+'.indexing'
+    record_writer=ParallelRecordWriter(indexed_filename,compression,workers)
+    no_records=0
+    try:
+        with open(filename,'rb') as record_file:
+            for _,_,record in _iter_framed_records(record_file,compression):
+                record_writer.write(record)
+                no_records+=1
+    finally:
+        record_writer.close()
+    os.rename(indexed_filename,filename)
+    os.rename(get_record_index_filename(indexed_filename),
+                get_record_index_filename(filename))
+
+    return no_records
+
+if __name__=='__main__':
+    import optparse
+    usage='usage: %prog [options] tfrecords_files'
+    parser=optparse.OptionParser(usage)
+    parser.add_option('--compression',dest='compression',
+                help='ZLIB or NONE compression of the files',default='ZLIB')
+    parser.add_option('--workers',dest='workers',
+                help='the threads compressing the rewritten files',
+                type='int',default=None)
+    (opt,args)=parser.parse_args()
+
+    #Indexing the given files written without index
+    compression=None if opt.compression=='NONE' else opt.compression
+    for filename in args:
+        print '>>> Indexing ',filename
+        no_records=build_record_index(filename,compression,opt.workers)
+        print 'Records indexed: ',no_records
@@ -1,5 +1,6 @@
 #Importing appropriate shapes to create square cells
 from shapely.geometry import Point,box
+import numpy as np
 
 #Class Definition
 class sq_Cells():
@@ -23,3 +24,112 @@ class sq_Cells():
         self.polygon=box(minx,miny,maxx,maxy)
         #should we keep the name polygon or vertices as in
         #JB's Script for consistency
+
+class SquareMesh(object):
+    '''
+    This class describes the whole square mesh implicitly by its origin
+    (center of the square cell (0,0)), the edge length and the resolution.
+    The square cell (i,j) is centered at origin+(i*edge_length,j*edge_length)
+    as done earlier in _get_square_cells.
+
+    Nothing is stored per cell, the candidate square cells of any bounding
+    box are found by integer arithmetic. Still it can be used like the old
+    dictionary of sq_Cells (mesh[(i,j)], keys, items ...) in which case the
+    sq_Cells objects are created on demand.
+    '''
+    def __init__(self,origin,edge_length,resolution):
+        self.origin=(float(origin[0]),float(origin[1]))
+        self.edge_length=edge_length
+        self.resolution=(int(resolution[0]),int(resolution[1]))
+
+    def center(self,i,j):
+        '''
+        Center of the square cell (i,j), (works also with numpy arrays)
+        '''
+        return (self.origin[0]+i*self.edge_length,
+                self.origin[1]+j*self.edge_length)
+
+    def bounds(self,i,j):
+        '''
+        Bounds (min_x,min_y,max_x,max_y) of the square cell (i,j),
+        same as the bounds of the polygon of the equivalent sq_Cells.
+        (works also with numpy arrays)
+        '''
+        center_x,center_y=self.center(i,j)
+        return (center_x-self.edge_length/2,center_y-self.edge_length/2,
+                center_x+self.edge_length/2,center_y+self.edge_length/2)
+
+    def index_range(self,min_x,min_y,max_x,max_y):
+        '''
+        Range of index (i_min,j_min,i_max,j_max) (both inclusive) of the
+        square cells touching the given bounding box. Works also with
+        numpy arrays to get the ranges of many boxes at once.
+        '''
+        i_min=np.floor((min_x-self.origin[0])/self.edge_length+0.5)
+        j_min=np.floor((min_y-self.origin[1])/self.edge_length+0.5)
+        i_max=np.floor((max_x-self.origin[0])/self.edge_length+0.5)
+        j_max=np.floor((max_y-self.origin[1])/self.edge_length+0.5)
+        index=np.array([i_min,j_min,i_max,j_max]).astype(np.int64)
+        index[0]=np.maximum(index[0],0)
+        index[1]=np.maximum(index[1],0)
+        index[2]=np.minimum(index[2],self.resolution[0]-1)
+        index[3]=np.minimum(index[3],self.resolution[1]-1)
+        return tuple(index)
+
+    def candidates(self,bounds):
+        '''
+        Expands the index ranges of many bounding boxes into candidate
+        pairs. bounds is a (N,4) array of (min_x,min_y,max_x,max_y).
+        Returns the index of the box of each pair and the (K,2) array of
+        the (i,j) of the candidate square cell (row major order per box).
+        '''
+        bounds=np.asarray(bounds)
+        i_min,j_min,i_max,j_max=self.index_range(bounds[:,0],bounds[:,1],
+                            bounds[:,2],bounds[:,3])
+        span_i=np.maximum(i_max-i_min+1,0)
+        span_j=np.maximum(j_max-j_min+1,0)
+
+        count=span_i*span_j
+        box_idx=np.repeat(np.arange(len(count)),count)
+        rank=np.arange(np.sum(count))-np.repeat(np.cumsum(count)-count,count)
+        sq_idx=np.stack([i_min[box_idx]+rank//span_j[box_idx],
+                        j_min[box_idx]+rank%span_j[box_idx]],axis=1)
+        return box_idx,sq_idx
+
+    #Dictionary like access for the code using the sq_Cells dict
+    def __getitem__(self,id):
+        if id not in self:
+            raise KeyError(id)
+        return sq_Cells(id,self.center(id[0],id[1]),
+                        self.edge_length,self.edge_length)
+
+    def __contains__(self,id):
+        return (0<=id[0]<self.resolution[0]) and (0<=id[1]<self.resolution[1])
+
+    def __len__(self):
+        return self.resolution[0]*self.resolution[1]
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        for i in xrange(self.resolution[0]):
+            for j in xrange(self.resolution[1]):
+                yield (i,j)
+
+    def itervalues(self):
+        for id in self.iterkeys():
+            yield self[id]
+
+    def iteritems(self):
+        for id in self.iterkeys():
+            yield id,self[id]
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
@@ -13,9 +13,10 @@ import matplotlib.pyplot as plt
 from shapely.geometry import LineString,Polygon
 from descartes.patch import PolygonPatch
 #Geometry File imports
-from geometry.cmssw import read_geometry
+from geometry.cmssw import read_geometry_cached
 #Importing custom classes and function
 from sq_Cells import sq_Cells
+from coef_bundle import CoefBundle,get_coef_bundle_path
 from scipy import misc
 
 # Parameters ... to fix later
@@ -46,7 +47,7 @@ def readGeometry( input_file,  layer, subdet ):
 
     t0 = datetime.datetime.now()
     treename = 'hgcaltriggergeomtester/TreeCells'
-    cells = read_geometry(filename=input_file, treename=treename,
+    cells = read_geometry_cached(filename=input_file, treename=treename,
               subdet=subdet, layer=layer, wafer=-1)
     cells_d = dict([(c.id, c) for c in cells])
     t1 = datetime.datetime.now()
@@ -146,11 +147,8 @@ if __name__=='__main__':
         print '\nlayer:%s ,subdet:%s,eff_layer:%s '%(layer,subdet,eff_layer)
         cells_d = readGeometry( input_default_file, eff_layer, subdet )
         # Read coef
-        fname='sq_cells_data/coef_dict_layer_%s_res_%s,%s_len_%s.pkl'%(
-                                layer,resolution[0],resolution[1],edge_length)
-        fhandle=open(fname,'rb')
-        sq_coef=pickle.load(fhandle)
-        fhandle.close()
+        sq_coef=CoefBundle(get_coef_bundle_path(resolution,
+                                    edge_length)).layer(layer)
         error=compareAreas( cells_d, sq_coef )
         errors.append(error)
 
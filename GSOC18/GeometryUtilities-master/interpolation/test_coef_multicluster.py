@@ -13,6 +13,7 @@ ncpu=multiprocessing.cpu_count()
 executor=concurrent.futures.ThreadPoolExecutor(ncpu*4)
 
 from main import get_subdet
+from coef_bundle import CoefBundle,get_coef_bundle_path
 
 #Location of the root data file
 posfname='hex_pos_data/'
@@ -151,10 +152,9 @@ def interpolation_check(all_hits_df,sq_cells_dict,event_id,total_layers):
         if layer_hits.shape[0]==0:
             continue
 
-        #Reading the coef_dict for this layer
-        fname='sq_cells_data/coef_dict_layer_%s_res_%s,%s_len_%s.pkl'%(
-                                layer,resolution[0],resolution[1],edge_length)
-        coef_dict=readCoefFile(fname)
+        #Reading the coef_dict for this layer (from the coefficient bundle)
+        coef_dict=CoefBundle(get_coef_bundle_path(resolution,
+                                    edge_length)).layer(layer)
 
         #Reading the test_geometry file to get the hex_cells dict
         fname=posfname+'%s.pkl'%(layer)
@@ -0,0 +1,140 @@
+##########################IMPORTS########################
+#For file IO/data Handling
+import os
+import shutil
+import tempfile
+import zlib
+#Linear Algebra library
+import numpy as np
+#Reading the written files back
+import tensorflow as tf
+#Importing the writer to test
+import record_writer
+from record_writer import ParallelRecordWriter,crc32c,_adler32_combine
+
+'''
+DESCRIPTION:
+    This script checks the TFRecord framing of record_writer: the numpy
+    crc32c against the known CRC32C vectors and a bitwise reference (for
+    data shorter and longer than 16 blocks), the adler32 combination
+    against zlib and the files written by the ParallelRecordWriter being
+    read back by tf.python_io.tf_record_iterator with or without pool.
+USAGE:
+    python test_record_writer.py
+'''
+
+#CRC32C test vectors (RFC 3720, B.4)
+crc32c_vectors=[('',0x00000000),
+                ('123456789',0xE3069283),
+                ('\x00'*32,0x8A9136AA),
+                ('\xff'*32,0x62A8AB43),
+                (''.join(chr(byte) for byte in range(32)),0x46DD794E),
+                (''.join(chr(byte) for byte in range(31,-1,-1)),0x113FDB5C)]
+
+#################Function Definition####################
+def _crc32c_bitwise(data):
+    '''
+    DESCRIPTION:
+        The crc32c computed bit by bit from the (reflected) polynomial,
+        independently of the tables of record_writer.
+    '''
+    register=0xFFFFFFFF
+    for byte in bytearray(data):
+        register^=byte
+        for bit in range(8):
+            register=(register>>1)^(0x82F63B78 if register&1 else 0)
+
+    return register^0xFFFFFFFF
+
+def _get_random_data(rng,length):
+    '''
+    DESCRIPTION:
+        Random bytes with runs of zeros (the blocks skipped by crc32c)
+    '''
+    data=rng.randint(0,256,length).astype(np.uint8)
+    data[rng.randint(0,length+1):rng.randint(0,length+1)]=0
+
+    return data.tostring()
+
+def test_crc32c():
+    '''
+    DESCRIPTION:
+        Checks the crc32c against the known vectors, and against the
+        bitwise crc for lengths under and over 16 blocks.
+    '''
+    for data,crc in crc32c_vectors:
+        assert crc32c(data)==crc,'crc32c of %r'%(data)
+
+    rng=np.random.RandomState(0)
+    no_bytes=16*record_writer._crc32c_block
+    lengths=range(1,70)+[no_bytes-1,no_bytes,no_bytes+1,3*no_bytes+5,
+                        (1<<14)+3,100003]
+    for length in lengths:
+        data=_get_random_data(rng,length)
+        assert crc32c(data)==_crc32c_bitwise(data),\
+                'crc32c of %s bytes'%(length)
+
+def test_adler32_combine():
+    '''
+    DESCRIPTION:
+        Checks the combined adler32 against zlib.adler32 of the
+        concatenated data (including empty and long data).
+    '''
+    rng=np.random.RandomState(1)
+    lengths=[(0,0),(0,5),(5,0),(1,1),(100,65521),(65521,100),
+            (70000,200000),(3,1<<20)]
+    for length1,length2 in lengths:
+        data1=_get_random_data(rng,length1) if length1 else ''
+        data2=_get_random_data(rng,length2) if length2 else ''
+        adler=_adler32_combine(zlib.adler32(data1)&0xFFFFFFFF,
+                                zlib.adler32(data2)&0xFFFFFFFF,len(data2))
+        assert adler==zlib.adler32(data1+data2)&0xFFFFFFFF,\
+                'adler32 of %s+%s bytes'%(length1,length2)
+
+def test_round_trip(workers_list=(0,1,4)):
+    '''
+    DESCRIPTION:
+        Writes the same records (empty, short, long and compressible) with
+        the ParallelRecordWriter, compressed or not, for each number of
+        workers and reads them back with tf.python_io.tf_record_iterator
+        (which checks the crc of each record and the zlib stream).
+    '''
+    rng=np.random.RandomState(2)
+    records=['',' ','\x00'*7]+[_get_random_data(rng,length) for length in
+                                (1,8,100,5000,70000,300000)]+\
+            [np.zeros(200000,dtype=np.float32).tostring()]
+    options={'ZLIB':tf.python_io.TFRecordOptions(
+                            tf.python_io.TFRecordCompressionType.ZLIB),
+            None:None}
+
+    test_dir=tempfile.mkdtemp()
+    try:
+        for compression in ['ZLIB',None]:
+            for workers in workers_list:
+                filename=os.path.join(test_dir,'records_%s_%s.tfrecords'%(
+                                                    compression,workers))
+                writer=ParallelRecordWriter(filename,compression,workers)
+                for event,record in enumerate(records):
+                    if event%2:
+                        writer.submit(lambda data:data,record,event=event)
+                    else:
+                        writer.write(record,event=event)
+                writer.close()
+
+                read_records=list(tf.python_io.tf_record_iterator(filename,
+                                            options=options[compression]))
+                assert read_records==records,\
+                        'Records of %s workers (%s) not read back'%(
+                                                    workers,compression)
+                assert os.path.exists(
+                            record_writer.get_record_index_filename(filename))
+    finally:
+        shutil.rmtree(test_dir)
+
+if __name__=='__main__':
+    test_crc32c()
+    print '>>> crc32c OK'
+    test_adler32_combine()
+    print '>>> adler32 combine OK'
+    test_round_trip()
+    print '>>> round trip OK'
@@ -3,7 +3,7 @@
 import cPickle as pickle
 from geometry.cmssw import read_bh_geometry, compute_id
 from geometry.neighbors import closest_neighbors
-from geometry.cell import Cell,merge
+from geometry.cell import Cell,merge_groups
 import numpy as np
 import ROOT
 from array import array
@@ -34,11 +34,13 @@ def triggercell_mapping():
             mapping[(module_id,tc_id)].append((ieta,iphi))
     return mapping
 
-def create_triggercells(cells_dict):
+def create_triggercells(cells_dict, processes=1):
     mapping = triggercell_mapping()
     trigger_cells = []
-    for tc,cells in mapping.items():
-        triggercell = merge([cells_dict[ieta_iphi] for ieta_iphi in cells])
+    # the BH cells are a regular (ieta,iphi) grid: merged from their outline
+    triggercells = merge_groups([[cells_dict[ieta_iphi] for ieta_iphi in cells] for cells in mapping.values()],
+            processes=processes, exact_tiling=True)
+    for tc,triggercell in zip(mapping.keys(), triggercells):
         trigger_cells.append(Cell(
             id=compute_id(tc[0],tc[1]),
             layer=1,
@@ -53,16 +55,16 @@ def create_triggercells(cells_dict):
 
 
 
-def main(input_file, output_file):
+def main(input_file, output_file, processes=1):
     treename = 'hgcaltriggergeomtester/TreeCellsBH'
     cells = read_bh_geometry(filename=input_file, treename=treename)
     cells_dict = dict([((c.ieta,c.iphi), c) for c in cells])
-    triggercells = create_triggercells(cells_dict)
+    triggercells = create_triggercells(cells_dict, processes=processes)
     # Find max cell size
     max_size = max(map(lambda c:max([c.vertices.bounds[2]-c.vertices.bounds[0],c.vertices.bounds[3]-c.vertices.bounds[1]]), triggercells))
     # Find neighbors of each cell
     print 'Finding nearest neighbors'
-    neighbor_indices, neighbor_ids = closest_neighbors(triggercells, max_distance=max_size)
+    neighbor_indices, neighbor_ids = closest_neighbors(triggercells, max_distance=max_size, method='topology')
     # Save mapping
     pickle.dump(neighbor_ids, open(output_file, 'wb'))
 
@@ -75,9 +77,10 @@ if __name__=='__main__':
     parser = optparse.OptionParser(usage)
     parser.add_option('--input_geometry', dest='input_file', help='Input geometry file')
     parser.add_option('--output', dest='output_file', help='Output pickle file', default='neighbors.pkl')
+    parser.add_option('--processes', dest='processes', type='int', help='Number of processes used to merge the trigger cells', default=1)
     (opt, args) = parser.parse_args()
     if not opt.input_file:
         parser.print_help()
         print 'Error: Missing input geometry file name'
         sys.exit(1)
-    main(opt.input_file, opt.output_file)
+    main(opt.input_file, opt.output_file, opt.processes)
@@ -19,7 +19,7 @@ def main(output_file):
     print max_size
     # Find neighbors of each cell
     print 'Finding nearest neighbors'
-    neighbor_indices, neighbor_ids = closest_neighbors(cells_in, max_distance=max_size)
+    neighbor_indices, neighbor_ids = closest_neighbors(cells_in, max_distance=max_size, method='topology')
 
     # Save mapping
     pickle.dump(neighbor_ids, open(output_file, 'wb'))
@@ -1,4 +1,7 @@
 import tensorflow as tf
+import numpy as np
+import struct
+import zlib
 
 def _binary_parse_function(serialized_example_protocol):
     '''
@@ -69,3 +72,111 @@ def get_tf_records_iterator(filename_list):
     next_element=iterator.get_next()
 
     return next_element
+
+def read_record_index(filename):
+    '''
+    DESCRIPTION:
+        This function reads the sidecar index (<filename>.index) of the
+        tfrecords file, written along with the dataset or by a one time
+        scan of the file (see record_writer of the interpolation).
+    USAGE:
+        INPUT:
+            filename    : the name of the tfrecords file
+        OUTPUT:
+            index       : dict of the offset, length and event arrays
+                            (one entry per record) and the compression
+                            ('ZLIB' or None) of the file
+    '''
+    with np.load(filename+'.index') as index_file:
+        index={name:index_file[name] for name in ['offset','length','event']}
+        compression=str(index_file['compression'])
+    index['compression']=None if compression=='NONE' else compression
+
+    return index
+
+def get_indexed_records(filename,event_list,index=None):
+    '''
+    DESCRIPTION:
+        This function reads directly the serialized examples of the given
+        events from the tfrecords file using its index, without decoding
+        the records before them.
+    USAGE:
+        INPUT:
+            filename    : the name of the indexed tfrecords file
+            event_list  : the list of event number to read
+            index       : the index of the file if already read
+                            (see read_record_index)
+        OUTPUT:
+            record_list : the serialized examples of the events (in the
+                            order of event_list)
+    '''
+    if index is None:
+        index=read_record_index(filename)
+    record_position={event:position for position,event in
+                                        enumerate(index['event'].tolist())}
+
+    #Reading the records in the order of the file
+    records={}
+    with open(filename,'rb') as record_file:
+        for event in sorted(set(event_list),
+                    key=lambda event:record_position.get(event,-1)):
+            if event not in record_position:
+                raise KeyError('Event %s not in the index of %s'%(
+                                                        event,filename))
+            position=record_position[event]
+            record_file.seek(index['offset'][position])
+            data=record_file.read(index['length'][position])
+            #Each record is an independent deflate chunk in the ZLIB file
+            if index['compression']=='ZLIB':
+                data=zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+            length=struct.unpack('<Q',data[0:8])[0]
+            if len(data)!=length+16:
+                raise IOError('Record of event %s does not match the index'\
+                                ' of %s'%(event,filename))
+            records[event]=data[12:12+length]
+
+    return [records[event] for event in event_list]
+
+def get_indexed_events(filename,event_list,image_shape=(514,513,40),
+                        image_format='dense',index=None):
+    '''
+    DESCRIPTION:
+        This function gives directly the images and labels of the given
+        events of an indexed tfrecords file (see get_indexed_records)
+        decoded as numpy array, for looking at some events without going
+        through the whole file.
+    USAGE:
+        INPUT:
+            filename    : the name of the indexed tfrecords file
+            event_list  : the list of event number to read
+            image_shape : the (height,width,depth) of the saved images
+            image_format: the format ('dense' or 'sparse') of the images
+            index       : the index of the file if already read
+        OUTPUT:
+            images      : the (events,height,width,depth) images
+            labels      : the (events,6) labels of the events
+    '''
+    record_list=get_indexed_records(filename,event_list,index)
+    images=np.zeros((len(record_list),)+tuple(image_shape),dtype=np.float32)
+    labels=[]
+    for record_idx,record in enumerate(record_list):
+        example=tf.train.Example()
+        example.ParseFromString(record)
+        feature=example.features.feature
+        if image_format=='dense':
+            images[record_idx]=np.frombuffer(
+                                feature['image'].bytes_list.value[0],
+                                dtype=np.float32).reshape(image_shape)
+        elif image_format=='sparse':
+            #Scattering back the non zero pixels (c-order flat index)
+            images[record_idx].reshape((-1,))[
+                        np.array(feature['image_index'].int64_list.value,
+                                    dtype=np.int64)]=\
+                        np.array(feature['image_energy'].float_list.value,
+                                    dtype=np.float32)
+        else:
+            raise ValueError('Unknown image format: %s'%(image_format))
+        labels.append(np.frombuffer(feature['label'].bytes_list.value[0],
+                                    dtype=np.float32))
+
+    return images,np.array(labels,dtype=np.float32).reshape((-1,6))
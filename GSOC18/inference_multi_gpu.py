@@ -117,7 +117,8 @@ def infer(run_number,
             calculate_model_accuracy,
             calculate_total_loss,
             infer_filename_pattern,inference_mode,
-            mini_batch_size,checkpoint_epoch_number):
+            mini_batch_size,checkpoint_epoch_number,image_format='dense',
+            image_shape=(514,513,40)):
     '''
     DESCRIPTION:
         This function will now control the whole inference process
@@ -143,6 +144,10 @@ def infer(run_number,
             mini_batch_size          : the size of image to process parallely
             checkpoint_epoch_number  : the checkpoint number of the file
                                         saved at that epoch
+            image_format             : the format ('dense' or 'sparse') in
+                                        which the images of dataset are saved
+            image_shape              : the (height,width,depth) of the images
+                                        of dataset
 
     '''
     #Setting up the required directory for saving the results and loading checkpoints
@@ -158,7 +163,9 @@ def infer(run_number,
     #Getting the one-shot-iterator of the testing dataset
     with tf.device('/cpu:0'):
         os_iterator=parse_tfrecords_file_inference(infer_filename_pattern,
-                                                mini_batch_size)
+                                                mini_batch_size,
+                                                image_format=image_format,
+                                                image_shape=image_shape)
 
     #Creating the graph for inference
     label_pred_ops,accuracy_ops=create_inference_graph(
@@ -9,6 +9,7 @@ from tensorflow.python.client import timeline
 
 #import models here(need to be defined separetely in model file)
 from CNN_Module.utils.io_pipeline import parse_tfrecords_file
+from CNN_Module.utils.io_pipeline import get_steps_per_epoch
 # from test import make_model_conv,make_model_conv3d,make_model_linear
 # from test import calculate_model_accuracy,calculate_total_loss
 # from model1_definition import model7 as model_function_handle
@@ -251,7 +252,8 @@ def train(run_number,
             epochs,mini_batch_size,shuffle_buffer_size,
             init_learning_rate,decay_step,decay_rate,
             train_filename_list,test_filename_list,
-            log_frequency,restore_epoch_number=None):
+            log_frequency,restore_epoch_number=None,image_format='dense',
+            image_shape=(514,513,40),manifest_filename=None):
     '''
     DESCRIPTION:
         This function will finally take the graph created for training
@@ -299,6 +301,17 @@ def train(run_number,
 
             restore_epoch_number      : the number if given will be used for
                                         restoring the training.
+            image_format              : the format ('dense' or 'sparse') in
+                                        which the images of dataset are saved
+            image_shape               : the (height,width,depth) of the images
+                                        of dataset (smaller if cropped to the
+                                        region of interest)
+            manifest_filename         : the manifest.json of the dataset if
+                                        it was made in shards (read in a
+                                        balanced way and giving the number
+                                        of minibatches per epoch, which
+                                        bounds each epoch and numbers its
+                                        progress and summaries)
         OUTPUT:
             nothing
             later checkpoints saving will be added
@@ -337,7 +350,10 @@ def train(run_number,
                                                     train_filename_list,
                                                     test_filename_list,
                                                     mini_batch_size,
-                                                    shuffle_buffer_size=shuffle_buffer_size)
+                                                    shuffle_buffer_size=shuffle_buffer_size,
+                                                    image_format=image_format,
+                                                    image_shape=image_shape,
+                                                    manifest_filename=manifest_filename)
 
     #Creating the multi-GPU training graph
     train_track_ops=create_training_graph(model_function_handle,
@@ -378,6 +394,15 @@ def train(run_number,
         train_writer.add_graph(sess.graph)
         test_writer.add_graph(sess.graph)
 
+        #Number of minibatches per epoch (one per tower at each step),
+        #known from the manifest of a sharded dataset
+        steps_per_epoch=None
+        if manifest_filename is not None:
+            steps_per_epoch=get_steps_per_epoch(manifest_filename,
+                                    train_filename_list,
+                                    mini_batch_size*max(1,len(_get_available_gpus())))
+            print 'Minibatches per epoch: ',steps_per_epoch
+
         #Starting the training epochs
         for i in range(epochs):
             ############################# TRAINING #############################
@@ -386,7 +411,14 @@ def train(run_number,
             sess.run(train_iter_init_op) #we need the is_training placeholder
             bno=1                        #writing the batch number
             t_epoch_start=datetime.datetime.now()
-            while True:
+            while steps_per_epoch is None or bno<=steps_per_epoch:
+                #The progress in the epoch and the step of the summaries
+                #(continuing over the epochs if the epoch length is known)
+                progress=bno
+                summary_step=bno
+                if steps_per_epoch is not None:
+                    progress='{}/{}'.format(bno,steps_per_epoch)
+                    summary_step=i*steps_per_epoch+bno
                 try:
                     #Giving the option for manually setting up the learning rate
                     if bno%log_frequency['lr_tune']==0:
@@ -416,7 +448,8 @@ def train(run_number,
                             print "Resuming the Learning without changes"
 
                     #Running the train op and optionally the tracer bullet
-                    if bno%log_frequency['summary']==0:
+                    #(the summary also at the end of each known epoch)
+                    if bno%log_frequency['summary']==0 or bno==steps_per_epoch:
                         #Starting the timer
                         t0=datetime.datetime.now()
                         #Running the op
@@ -427,8 +460,8 @@ def train(run_number,
                         t1=datetime.datetime.now()
 
                         #Now the last op has the merged_summary evaluated.So, write it.
-                        train_writer.add_summary(track_results[-1],bno)
-                        print 'Training loss @epoch: ',i,' @minibatch: ',bno,track_results[1:-1],'in ',t1-t0
+                        train_writer.add_summary(track_results[-1],summary_step)
+                        print 'Training loss @epoch: ',i,' @minibatch: ',progress,track_results[1:-1],'in ',t1-t0
 
                     #Use this only for testing. This leaks memory
                     elif log_frequency['statistics']!=None and bno%log_frequency['statistics']==0:
@@ -460,8 +493,8 @@ def train(run_number,
                             f.write(ctf)
 
                         #Now the last op has the merged_summary evaluated.So, write it.
-                        train_writer.add_summary(track_results[-1],bno)
-                        print 'Training loss @epoch: ',i,' @minibatch: ',bno,track_results[1:-1],'in ',t1-t0
+                        train_writer.add_summary(track_results[-1],summary_step)
+                        print 'Training loss @epoch: ',i,' @minibatch: ',progress,track_results[1:-1],'in ',t1-t0
 
                     else:
                         #Starting the timer
@@ -473,16 +506,16 @@ def train(run_number,
                                                     learning_rate:learning_rate_val},
                                                 )
                         t1=datetime.datetime.now()
-                        print 'Training loss @epoch: ',i,' @minibatch: ',bno,track_results[1:],'in ',t1-t0
+                        print 'Training loss @epoch: ',i,' @minibatch: ',progress,track_results[1:],'in ',t1-t0
 
                     #Incrementing the minibatch number
                     bno+=1
                 #Finally when we are out of the examples
                 except tf.errors.OutOfRangeError:
-                    t_epoch_end=datetime.datetime.now()
-                    print 'Training one epoch completed in: {}\n'.format(
-                                    t_epoch_end-t_epoch_start)
                     break
+            t_epoch_end=datetime.datetime.now()
+            print 'Training one epoch completed in: {}\n'.format(
+                            t_epoch_end-t_epoch_start)
 
             ###################### VALIDATION ################################
             #get the validation accuracy,starting the validation/test iterator
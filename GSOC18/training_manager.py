@@ -14,14 +14,25 @@ from train_multi_gpu import train
 from inference_multi_gpu import infer
 #import the gradient calulation function
 from get_saliency_map import get_gradient
+from CNN_Module.utils.io_pipeline import get_shard_manifest_filename
 
 ###################### RUN CONFIGURATION #####################
 run_number=63
 #the regex pattern for the dataset filename
-train_filename_pattern='pu/train/*'
-test_filename_pattern='pu/valid/*'
-test_pu_filename_pattern='pu/valid/*'
-viz_filename_pattern='pu/valid/*'
+#(only the .tfrecords, not their .index files)
+train_filename_pattern='pu/train/*.tfrecords'
+test_filename_pattern='pu/valid/*.tfrecords'
+test_pu_filename_pattern='pu/valid/*.tfrecords'
+viz_filename_pattern='pu/valid/*.tfrecords'
+#the format of the images in the dataset (dense/sparse) as made by
+#compute_energy_map during dataset generation
+image_format='dense'
+#the shape of the images in the dataset (smaller than the full 514,513,40
+#if the images were cropped to the region of interest)
+image_shape=(514,513,40)
+#if the dataset was made in shards (with --dataset_dir), each zside and
+#pyramid level is in its own directory (eg. pu/zside_0/train/*.tfrecords)
+#and its manifest is found next to the train/valid directory of the patterns
 
 if __name__=='__main__':
 
@@ -45,6 +56,12 @@ if __name__=='__main__':
     test_filename_pattern=dataset_directory+test_filename_pattern
     test_pu_filename_pattern=dataset_directory+test_pu_filename_pattern
     viz_filename_pattern=dataset_directory+viz_filename_pattern
+    manifest_filename=get_shard_manifest_filename(train_filename_pattern)
+    if manifest_filename is not None and \
+            manifest_filename!=get_shard_manifest_filename(
+                                                test_filename_pattern):
+        raise ValueError('The train and test patterns are not in the same '
+                        'sharded dataset: %s'%(manifest_filename))
 
 
     ################## TRAINING HANDLE ####################
@@ -86,7 +103,10 @@ if __name__=='__main__':
                 init_learning_rate,decay_step,decay_rate,
                 train_filename_pattern,test_filename_pattern,
                 log_frequency,
-                restore_epoch_number=restore_epoch_number)
+                restore_epoch_number=restore_epoch_number,
+                image_format=image_format,
+                image_shape=image_shape,
+                manifest_filename=manifest_filename)
 
     ############## INFERENCE HANDLE #######################
     '''
@@ -113,7 +133,9 @@ if __name__=='__main__':
                 train_filename_pattern,
                 inference_mode='train',#on the training dataset
                 mini_batch_size=mini_batch_size,
-                checkpoint_epoch_number=checkpoint_epoch_number)
+                checkpoint_epoch_number=checkpoint_epoch_number,
+                image_format=image_format,
+                image_shape=image_shape)
 
         #Now rerunning the inference on the test dataset
         tf.reset_default_graph()
@@ -124,7 +146,9 @@ if __name__=='__main__':
                 test_filename_pattern,
                 inference_mode='valid',
                 mini_batch_size=mini_batch_size,
-                checkpoint_epoch_number=checkpoint_epoch_number)
+                checkpoint_epoch_number=checkpoint_epoch_number,
+                image_format=image_format,
+                image_shape=image_shape)
 
         #Now running the inference on the PU dataset
         # tf.reset_default_graph()